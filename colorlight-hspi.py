@@ -1,31 +1,195 @@
 import os
+import operator
 import subprocess
+from abc       import ABC, abstractmethod
+from functools import reduce
 
 from amaranth          import *
 from amaranth.lib.cdc  import ResetSynchronizer
-from amaranth.lib.fifo import SyncFIFOBuffered
 
 from amaranth.build import *
 from amaranth.vendor.lattice_ecp5 import *
 
-from amlib.stream import connect_fifo_to_stream, connect_stream_to_fifo
-
 from usb_protocol.types                import USBRequestType, USBDirection, USBStandardRequests
 from usb_protocol.emitters             import DeviceDescriptorCollection
 
 from luna                                     import top_level_cli
 from luna.usb2                                import USBDevice
-from luna.gateware.usb.usb2.request           import StallOnlyRequestHandler
+from luna.gateware.usb.usb2.request           import USBRequestHandler, StallOnlyRequestHandler
 from luna.gateware.usb.usb2.endpoints.stream  import USBMultibyteStreamInEndpoint
+from luna.gateware.usb.stream                 import USBInStreamInterface
+from luna.gateware.stream.generator           import StreamSerializer
 
 from amlib.debug.ila     import StreamILA, ILACoreParameters
 
-from hspi import HSPITransmitter, HSPIReceiver
+from hspi          import HSPILoopback, HSPIARQ
+from hspi.counters import HSPILinkCounters, VENDOR_REQUEST_SNAPSHOT, VENDOR_REQUEST_READ, VENDOR_REQUEST_CLEAR
+from hspi.ecp5     import ECP5HSPIPads, PADS as HSPI_PADS
+from hspi.calibration import HSPIPhaseCalibration, VENDOR_REQUEST_CALIBRATION_START, \
+                             VENDOR_REQUEST_CALIBRATION_STATUS
+from hspi.latency  import HSPILatencyHistogram, VENDOR_REQUEST_HISTOGRAM_FREEZE, \
+                          VENDOR_REQUEST_HISTOGRAM_READ, VENDOR_REQUEST_HISTOGRAM_CLEAR
+
+class VendorRequestHandler(USBRequestHandler, ABC):
+    """ Handles the vendor requests in REQUESTS, which either have no data
+        or read the 32 bit value of read_value(), as four little endian bytes
+
+        Subclasses start a request in request_received(), which returns
+        whether the request reads the value.
+    """
+
+    REQUESTS = []
+
+    @classmethod
+    def handles(cls, setup):
+        return (setup.type == USBRequestType.VENDOR) & \
+               reduce(operator.or_, [setup.request == request for request in cls.REQUESTS])
+
+    @abstractmethod
+    def request_received(self, m, request, setup):
+        pass
+
+    @abstractmethod
+    def read_value(self):
+        pass
+
+    def elaborate(self, platform):
+        m = Module()
+
+        interface = self.interface
+        setup     = interface.setup
+
+        m.submodules.transmitter = transmitter = \
+            StreamSerializer(data_length=4, domain="usb", stream_type=USBInStreamInterface, max_length_width=3)
+
+        with m.FSM(domain="usb"):
+            with m.State("IDLE"):
+                with m.If(setup.received & self.handles(setup)):
+                    with m.Switch(setup.request):
+                        for request in self.REQUESTS:
+                            with m.Case(request):
+                                m.next = "READ" if self.request_received(m, request, setup) else "STATUS"
+
+            # requests without data only need their status stage acknowledged
+            with m.State("STATUS"):
+                with m.If(interface.status_requested):
+                    m.d.comb += self.send_zlp()
+                with m.If(interface.handshakes_in.ack):
+                    m.next = "IDLE"
+
+            with m.State("READ"):
+                m.d.comb += [
+                    transmitter.stream.attach(interface.tx),
+                    Cat(*transmitter.data).eq(self.read_value()),
+                    transmitter.max_length.eq(setup.length),
+                ]
+                with m.If(interface.data_requested):
+                    m.d.comb += transmitter.start.eq(1)
+                with m.If(interface.status_requested):
+                    m.d.comb += interface.handshakes_out.ack.eq(1)
+                    m.next = "IDLE"
+
+        return m
+
+class LinkCounterRequestHandler(VendorRequestHandler):
+    """ Handles the vendor requests of the link counters, see hspi/counters.py """
+
+    REQUESTS = [VENDOR_REQUEST_SNAPSHOT, VENDOR_REQUEST_READ, VENDOR_REQUEST_CLEAR]
+
+    def __init__(self, counters):
+        super().__init__()
+        self.counters = counters
+
+    def request_received(self, m, request, setup):
+        if request == VENDOR_REQUEST_SNAPSHOT:
+            m.d.comb += self.counters.snapshot_in.eq(1)
+        elif request == VENDOR_REQUEST_CLEAR:
+            m.d.comb += self.counters.clear_in.eq(1)
+        else:
+            m.d.usb += self.counters.select_in.eq(setup.index)
+        return request == VENDOR_REQUEST_READ
+
+    def read_value(self):
+        return self.counters.value_out
+
+class LatencyHistogramRequestHandler(VendorRequestHandler):
+    """ Handles the vendor requests of the latency histogram, see hspi/latency.py """
+
+    REQUESTS = [VENDOR_REQUEST_HISTOGRAM_FREEZE, VENDOR_REQUEST_HISTOGRAM_READ, VENDOR_REQUEST_HISTOGRAM_CLEAR]
+
+    def __init__(self, histogram):
+        super().__init__()
+        self.histogram = histogram
+
+    def request_received(self, m, request, setup):
+        if request == VENDOR_REQUEST_HISTOGRAM_FREEZE:
+            m.d.usb += self.histogram.freeze_in.eq(setup.value[0])
+        elif request == VENDOR_REQUEST_HISTOGRAM_CLEAR:
+            m.d.comb += self.histogram.clear_in.eq(1)
+        else:
+            m.d.usb += self.histogram.select_in.eq(setup.index)
+        return request == VENDOR_REQUEST_HISTOGRAM_READ
+
+    def read_value(self):
+        return self.histogram.value_out
+
+class PhaseCalibrationRequestHandler(VendorRequestHandler):
+    """ Handles the vendor requests of the HSPI phase calibration, see hspi/calibration.py """
+
+    REQUESTS = [VENDOR_REQUEST_CALIBRATION_START, VENDOR_REQUEST_CALIBRATION_STATUS]
+
+    def __init__(self, calibration):
+        super().__init__()
+        self.calibration = calibration
+
+    def request_received(self, m, request, setup):
+        if request == VENDOR_REQUEST_CALIBRATION_START:
+            m.d.comb += self.calibration.start_in.eq(1)
+        return request == VENDOR_REQUEST_CALIBRATION_STATUS
+
+    def read_value(self):
+        return self.calibration.status_out
 
 class ColorlightHSPI(Elaboratable):
+    # clock of the HSPI bus, as configured in the CH569 firmware
+    HSPI_FREQ = 96e6
     ILA_MAX_PACKET_SIZE = 512
     USE_ILA = True
+    ILA_SAMPLE_DEPTH = 8 * 6 * 1024
     USE_ACK = False
+    # sliding window acknowledgements and retransmission instead of USE_ACK,
+    # the CH569 firmware has to speak the same protocol
+    USE_ARQ = False
+    ARQ_WINDOW = 4
+    # register stages of the CRC data path in the HSPI cores
+    CRC_LATENCY = 0
+    # request the next frame right after the last one, without going idle in between
+    STREAMING = False
+    # loop back through the packet buffer of the receiver instead of a plain FIFO,
+    # which only sends back frames with a correct CRC
+    RX_BUFFER_FRAMES = 0
+    # words of a frame which have to be in the loopback FIFO before it is sent back,
+    # None waits for the whole frame
+    LOOPBACK_THRESHOLD = 0
+    # words of the loopback FIFO
+    LOOPBACK_DEPTH = 4096
+    # put the HSPI inputs and outputs through the registers in the IO cells,
+    # which delays them by one cycle, with optional input delays in taps, see hspi/ecp5.py
+    IO_REGISTERS         = False
+    HD_INPUT_DELAYS      = None
+    CONTROL_INPUT_DELAYS = None
+    # move the phase of the hspi clock into the middle of the eye of the data bus
+    # after the HSPI PLL locked, while the CH569 firmware sends training frames
+    # of CALIBRATION_FRAME_WORDS words, its result is shown by hspi-calibration.py
+    USE_PHASE_CALIBRATION   = False
+    CALIBRATION_FRAME_WORDS = 64
+    # link counters, readable with hspi-counters.py
+    USE_LINK_COUNTERS = False
+    # histogram of the cycles from receiving a frame to sending it back,
+    # readable with hspi-latency.py
+    USE_LATENCY_HISTOGRAM = False
+    LATENCY_BINS      = 1024
+    LATENCY_BIN_SHIFT = 3
 
     def create_descriptors(self):
         """ Creates the descriptors that describe our audio topology. """
@@ -62,30 +226,51 @@ class ColorlightHSPI(Elaboratable):
         m = Module()
 
         # Generate our domain clocks/resets.
-        m.submodules.car = platform.clock_domain_generator()
+        m.submodules.car = car = \
+            platform.clock_domain_generator(hspi_freq=self.HSPI_FREQ, phase_calibration=self.USE_PHASE_CALIBRATION)
+
+        if self.IO_REGISTERS:
+            m.submodules.hspi_io = hspi_io = \
+                ECP5HSPIPads(platform.request("hspi", 0, dir={pad: "-" for pad in HSPI_PADS}), domain="hspi",
+                             hd_delays=self.HD_INPUT_DELAYS, control_delays=self.CONTROL_INPUT_DELAYS)
+            hspi_pads = hspi_io.hspi
+        else:
+            hspi_pads = platform.request("hspi", 0)
 
-        hspi_pads = platform.request("hspi", 0)
+        if self.USE_ARQ:
+            # everything which arrives goes back the same way
+            m.submodules.arq = arq = HSPIARQ(domain="hspi", window=self.ARQ_WINDOW,
+                                             crc_latency=self.CRC_LATENCY, streaming=self.STREAMING)
+            hspi_tx = arq.tx
+            hspi_rx = arq.rx
 
-        m.submodules.hspi_tx      = hspi_tx       = HSPITransmitter(domain="hspi")
-        m.submodules.hspi_rx      = hspi_rx       = HSPIReceiver(domain="hspi")
-        m.submodules.looback_fifo = loopback_fifo = DomainRenamer("hspi")(SyncFIFOBuffered(width=34, depth=4096))
+            m.d.comb += [
+                *arq.connect_to_pads(hspi_pads),
+                *arq.stream_in.stream_eq(arq.stream_out),
 
-        m.d.comb += [
-            ## connect HSPI receiver
-            *hspi_rx.connect_to_pads(hspi_pads),
-            *connect_stream_to_fifo(hspi_rx.stream_out, loopback_fifo, firstBit=-2, lastBit=-1),
+                arq.user_id0_in.eq(0x3ABCDEF),
+                arq.user_id1_in.eq(0x3456789),
+                arq.tll_2b_in.eq(0b11),
+            ]
+        else:
+            m.submodules.loopback = loopback = HSPILoopback(domain="hspi", depth=self.LOOPBACK_DEPTH,
+                                                            threshold=self.LOOPBACK_THRESHOLD,
+                                                            buffer_frames=self.RX_BUFFER_FRAMES,
+                                                            crc_latency=self.CRC_LATENCY,
+                                                            streaming=self.STREAMING)
+            hspi_tx = loopback.tx
+            hspi_rx = loopback.rx
 
-            ## connect HSPI transmitter
-            hspi_tx.user_id0_in.eq(0x3ABCDEF),
-            hspi_tx.user_id1_in.eq(0x3456789),
-            hspi_tx.tll_2b_in.eq(0b11),
-            hspi_tx.sequence_nr_in.eq(hspi_rx.sequence_nr_out),
+            m.d.comb += [
+                *loopback.connect_to_pads(hspi_pads),
 
-            *hspi_tx.connect_to_pads(hspi_pads),
-            *connect_fifo_to_stream(loopback_fifo, hspi_tx.stream_in, firstBit=-2, lastBit=-1),
-        ]
+                hspi_tx.user_id0_in.eq(0x3ABCDEF),
+                hspi_tx.user_id1_in.eq(0x3456789),
+                hspi_tx.tll_2b_in.eq(0b11),
+                hspi_tx.sequence_nr_in.eq(hspi_rx.sequence_nr_out),
+            ]
 
-        if self.USE_ACK:
+        if self.USE_ACK and not self.USE_ARQ:
             with m.FSM(domain="hspi"):
                 with m.State("WAIT_RX"):
                     with m.If(hspi_rx.stream_out.first & hspi_rx.stream_out.valid):
@@ -102,12 +287,18 @@ class ColorlightHSPI(Elaboratable):
         else:
             m.d.comb += hspi_tx.send_ack.eq(0)
 
-        if self.USE_ILA:
-            trace_transmit = False
-            trace_receive  = False
-            trace_loopback = False
-            use_enable     = False
+        if self.USE_PHASE_CALIBRATION:
+            m.submodules.calibration = calibration = \
+                HSPIPhaseCalibration(steps=car.hspi_phase_steps, domain="hspi", read_domain="usb",
+                                     frame_words=self.CALIBRATION_FRAME_WORDS)
+            m.d.comb += [
+                *calibration.connect(hspi_rx),
+                calibration.lock_in    .eq(car.hspi_locked),
+                car.hspi_phase_step    .eq(calibration.phase_step_out),
+                car.hspi_phase_dir     .eq(calibration.phase_dir_out),
+            ]
 
+        if self.USE_ILA or self.USE_LINK_COUNTERS or self.USE_LATENCY_HISTOGRAM or self.USE_PHASE_CALIBRATION:
             ulpi = platform.request(platform.default_usb_connection)
             m.submodules.usb = usb = USBDevice(bus=ulpi)
 
@@ -125,13 +316,41 @@ class ColorlightHSPI(Elaboratable):
                               & (setup.request == USBStandardRequests.SET_INTERFACE)
             ])
 
-            # Attach class-request handlers that stall any vendor or reserved requests,
+            handlers = []
+
+            if self.USE_LINK_COUNTERS:
+                m.submodules.counters = counters = HSPILinkCounters(domain="hspi", read_domain="usb")
+                m.d.comb += counters.connect(hspi_tx, hspi_rx)
+                control_ep.add_request_handler(LinkCounterRequestHandler(counters))
+                handlers.append(LinkCounterRequestHandler)
+
+            if self.USE_LATENCY_HISTOGRAM:
+                m.submodules.latency = latency = \
+                    HSPILatencyHistogram(domain="hspi", read_domain="usb",
+                                         bins=self.LATENCY_BINS, bin_shift=self.LATENCY_BIN_SHIFT)
+                m.d.comb += latency.connect(hspi_tx, hspi_rx)
+                control_ep.add_request_handler(LatencyHistogramRequestHandler(latency))
+                handlers.append(LatencyHistogramRequestHandler)
+
+            if self.USE_PHASE_CALIBRATION:
+                control_ep.add_request_handler(PhaseCalibrationRequestHandler(calibration))
+                handlers.append(PhaseCalibrationRequestHandler)
+
+            is_ours = lambda setup: reduce(operator.or_, [handler.handles(setup) for handler in handlers], Const(0))
+
+            # Attach class-request handlers that stall any other vendor or reserved requests,
             # as we don't have or need any.
             stall_condition = lambda setup : \
-                (setup.type == USBRequestType.VENDOR) | \
+                ((setup.type == USBRequestType.VENDOR) & ~is_ours(setup)) | \
                 (setup.type == USBRequestType.RESERVED)
             control_ep.add_request_handler(StallOnlyRequestHandler(stall_condition))
 
+        if self.USE_ILA:
+            trace_transmit = False
+            trace_receive  = False
+            trace_loopback = False
+            use_enable     = False
+
             debug = platform.request("debug")
 
             signals = [
@@ -182,12 +401,11 @@ class ColorlightHSPI(Elaboratable):
                 ]
 
             signals_bits = sum([s.width for s in signals])
-            depth = 8 * 6 * 1024 #int(33*8*1024/signals_bits)
             m.submodules.ila = ila = \
                 StreamILA(
                     signals=signals,
-                    sample_rate=96e6,
-                    sample_depth=depth,
+                    sample_rate=self.HSPI_FREQ,
+                    sample_depth=self.ILA_SAMPLE_DEPTH,
                     domain="hspi", o_domain="usb",
                     samples_pretrigger=256,
                     with_enable=use_enable)
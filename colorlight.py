@@ -11,34 +11,125 @@ from amaranth_boards.colorlight_qmtech import ColorlightQMTechPlatform
 
 from luna.gateware.platform.core       import LUNAPlatform
 
-class ColorlightDomainGenerator(Elaboratable):
-    HSPI_FREQ_MHZ="96"
-
-    """ Clock generator for the Colorlight I5/I9 board. """
-    def __init__(self, clock_frequencies=None):
-        pass
-
-    def elaborate(self, platform):
-        m = Module()
-
-        # Create our domains.
-        m.domains.sync   = ClockDomain("sync")
-        m.domains.usb    = ClockDomain("usb")
-        m.domains.hspi   = ClockDomain("hspi")
-
+# limits of the EHXPLLL of the ECP5, from the sysCLOCK PLL design guide (TN1263)
+ECP5_PLL_INPUT_RANGE  = (8e6,     400e6)
+ECP5_PLL_PFD_RANGE    = (3.125e6, 400e6)
+ECP5_PLL_VCO_RANGE    = (400e6,   800e6)
+ECP5_PLL_OUTPUT_RANGE = (3.125e6, 400e6)
+ECP5_PLL_CLKI_DIVS    = range(1, 129)
+ECP5_PLL_CLKFB_DIVS   = range(1, 81)
+ECP5_PLL_CLKOP_DIVS   = range(1, 129)
+
+def solve_ecp5_pll(f_in, f_out, *, tolerance=0.0):
+    """ Finds dividers for an EHXPLLL which makes f_out on CLKOP from f_in on CLKI,
+        with CLKOP as the feedback path
+
+        Returns a dict of CLKI_DIV, CLKFB_DIV, CLKOP_DIV and the resulting
+        frequencies of the VCO and of CLKOP. Among the solutions within tolerance,
+        relative to f_out, the one closest to f_out and then with the fastest VCO wins,
+        which has the least jitter. Raises ValueError if there is none.
+    """
+    if not ECP5_PLL_INPUT_RANGE[0] <= f_in <= ECP5_PLL_INPUT_RANGE[1]:
+        raise ValueError(f"PLL input frequency {f_in / 1e6:g} MHz is outside of "
+                         f"{ECP5_PLL_INPUT_RANGE[0] / 1e6:g} - {ECP5_PLL_INPUT_RANGE[1] / 1e6:g} MHz")
+    if not ECP5_PLL_OUTPUT_RANGE[0] <= f_out <= ECP5_PLL_OUTPUT_RANGE[1]:
+        raise ValueError(f"PLL output frequency {f_out / 1e6:g} MHz is outside of "
+                         f"{ECP5_PLL_OUTPUT_RANGE[0] / 1e6:g} - {ECP5_PLL_OUTPUT_RANGE[1] / 1e6:g} MHz")
+
+    best = None
+    for clki_div in ECP5_PLL_CLKI_DIVS:
+        f_pfd = f_in / clki_div
+        if not ECP5_PLL_PFD_RANGE[0] <= f_pfd <= ECP5_PLL_PFD_RANGE[1]:
+            continue
+
+        for clkfb_div in ECP5_PLL_CLKFB_DIVS:
+            f_clkop = f_pfd * clkfb_div
+            error   = abs(f_clkop - f_out)
+            # also covers rounding errors of the floating point frequencies
+            if error > f_out * tolerance + 1:
+                continue
+
+            for clkop_div in ECP5_PLL_CLKOP_DIVS:
+                f_vco = f_clkop * clkop_div
+                if not ECP5_PLL_VCO_RANGE[0] <= f_vco <= ECP5_PLL_VCO_RANGE[1]:
+                    continue
+
+                if best is None or (error, -f_vco) < (best["error"], -best["vco"]):
+                    best = dict(CLKI_DIV=clki_div, CLKFB_DIV=clkfb_div, CLKOP_DIV=clkop_div,
+                                vco=f_vco, clkop=f_clkop, error=error)
+
+    if best is None:
+        raise ValueError(f"no ECP5 PLL dividers make {f_out / 1e6:g} MHz from {f_in / 1e6:g} MHz "
+                         f"within a tolerance of {tolerance:g}")
+    return best
 
-        # Grab our clock and global reset signals.
-        clk25 = platform.request(platform.default_clk)
-
-        main_locked   = Signal()
-        hspi_locked   = Signal()
-        reset         = Signal()
+class ColorlightDomainGenerator(Elaboratable):
+    CLK_FREQ  = 25e6
+    HSPI_FREQ = 96e6
+    USB_FREQ  = 60e6
+
+    """ Clock generator for the Colorlight I5/I9 board.
+
+        The usb and sync domains run at usb_freq, made from the 25 MHz clock of the board,
+        and the hspi domain at hspi_freq, made from the HSPI clock of the CH569,
+        which has to run at that frequency. The PLL dividers for both are found
+        by solve_ecp5_pll(), so elaboration fails if one of them is not possible.
+
+        With phase_calibration=True, the hspi domain runs on CLKOS of the HSPI PLL,
+        whose phase moves by one of hspi_phase_steps steps of a clock period
+        for every pulse on hspi_phase_step, in the direction of hspi_phase_dir,
+        see HSPIPhaseCalibration.
+        hspi_locked is the lock of the HSPI PLL.
+    """
+    def __init__(self, clock_frequencies=None, *, hspi_freq=None, usb_freq=None, tolerance=0.0,
+                 phase_calibration=False):
+        self.hspi_freq = self.HSPI_FREQ if hspi_freq is None else hspi_freq
+        self.usb_freq  = self.USB_FREQ  if usb_freq  is None else usb_freq
+        self.tolerance = tolerance
+
+        self.usb_dividers  = solve_ecp5_pll(self.CLK_FREQ,  self.usb_freq,  tolerance=tolerance)
+        self.hspi_dividers = solve_ecp5_pll(self.hspi_freq, self.hspi_freq, tolerance=tolerance)
+
+        self.phase_calibration = phase_calibration
+        # every step moves the phase by an eighth of a VCO period
+        self.hspi_phase_steps  = 8 * self.hspi_dividers["CLKOP_DIV"]
+        self.hspi_phase_step   = Signal()
+        self.hspi_phase_dir    = Signal()
+        self.hspi_locked       = Signal()
+
+    def pll(self, *, clki, clkop, locked, reset, f_in, dividers, clkos=None, phase_step=None, phase_dir=None):
+        """ an EHXPLLL making the frequency of dividers on clkop from f_in on clki,
+            and the same on clkos, if given, with its phase moved by phase_step and phase_dir
+        """
+        if clkos is None:
+            dynamic_phase = dict(
+                i_PHASESEL0=0,
+                i_PHASESEL1=0,
+                i_PHASEDIR=1,
+                i_PHASESTEP=1,
+                i_PHASELOADREG=1,
+            )
+        else:
+            dynamic_phase = dict(
+                p_CLKOS_ENABLE = "ENABLED",
+                p_CLKOS_DIV = dividers["CLKOP_DIV"],
+                p_CLKOS_CPHASE = dividers["CLKOP_DIV"] - 1,
+                p_CLKOS_FPHASE = 0,
+                o_CLKOS=clkos,
+                i_ENCLKOS=0,
+                a_FREQUENCY_PIN_CLKOS=f"{dividers['clkop'] / 1e6:g}",
+
+                # PHASESEL 0 selects CLKOS, PHASESTEP idles high and steps on its falling edge
+                i_PHASESEL0=0,
+                i_PHASESEL1=0,
+                i_PHASEDIR=phase_dir,
+                i_PHASESTEP=~phase_step,
+                i_PHASELOADREG=1,
+            )
 
-        # USB PLL
-        main_feedback    = Signal()
-        m.submodules.main_pll = Instance("EHXPLLL",
+        return Instance("EHXPLLL",
                 # Status.
-                o_LOCK=main_locked,
+                o_LOCK=locked,
 
                 # PLL parameters...
                 p_PLLRST_ENA="DISABLED",
@@ -50,29 +141,25 @@ class ColorlightDomainGenerator(Elaboratable):
                 p_OUTDIVIDER_MUXC="DIVC",
                 p_OUTDIVIDER_MUXD="DIVD",
 
-                # 60 MHz
-                p_CLKI_DIV = 5,
+                p_CLKI_DIV = dividers["CLKI_DIV"],
+
                 p_CLKOP_ENABLE = "ENABLED",
-                p_CLKOP_DIV = 10,
-                p_CLKOP_CPHASE = 15,
+                p_CLKOP_DIV = dividers["CLKOP_DIV"],
+                # no phase shift
+                p_CLKOP_CPHASE = dividers["CLKOP_DIV"] - 1,
                 p_CLKOP_FPHASE = 0,
 
                 p_FEEDBK_PATH = "CLKOP",
-                p_CLKFB_DIV = 12,
+                p_CLKFB_DIV = dividers["CLKFB_DIV"],
 
                 # Clock in.
-                i_CLKI=clk25,
+                i_CLKI=clki,
 
                 # Internal feedback.
-                i_CLKFB=main_feedback,
+                i_CLKFB=clkop,
 
                 # Control signals.
                 i_RST=reset,
-                i_PHASESEL0=0,
-                i_PHASESEL1=0,
-                i_PHASEDIR=1,
-                i_PHASESTEP=1,
-                i_PHASELOADREG=1,
                 i_STDBY=0,
                 i_PLLWAKESYNC=0,
 
@@ -80,84 +167,60 @@ class ColorlightDomainGenerator(Elaboratable):
                 i_ENCLKOP=0,
 
                 # Generated clock outputs.
-                o_CLKOP=main_feedback,
+                o_CLKOP=clkop,
 
                 # Synthesis attributes.
-                a_FREQUENCY_PIN_CLKI="25",
-                a_FREQUENCY_PIN_CLKOP="60",
+                a_FREQUENCY_PIN_CLKI=f"{f_in / 1e6:g}",
+                a_FREQUENCY_PIN_CLKOP=f"{dividers['clkop'] / 1e6:g}",
 
                 a_ICP_CURRENT="6",
                 a_LPF_RESISTOR="16",
                 a_MFG_ENABLE_FILTEROPAMP="1",
-                a_MFG_GMCREF_SEL="2"
-        )
+                a_MFG_GMCREF_SEL="2",
 
-        # HSPI PLL
-        hspi_clocks = platform.request("hspi-clocks", 0)
-        hspi_feedback = Signal()
-        m.submodules.hspi_pll = Instance("EHXPLLL",
-                # Status.
-                o_LOCK=hspi_locked,
-
-                # PLL parameters...
-                p_PLLRST_ENA="DISABLED",
-                p_INTFB_WAKE="DISABLED",
-                p_STDBY_ENABLE="DISABLED",
-                p_DPHASE_SOURCE="DISABLED",
-                p_OUTDIVIDER_MUXA="DIVA",
-                p_OUTDIVIDER_MUXB="DIVB",
-                p_OUTDIVIDER_MUXC="DIVC",
-                p_OUTDIVIDER_MUXD="DIVD",
-
-                p_CLKI_DIV = 1,
-
-                p_CLKOP_ENABLE = "ENABLED",
-                p_CLKOP_DIV = 10,
-                p_CLKOP_CPHASE = 15,
-                p_CLKOP_FPHASE = 0,
-
-                p_FEEDBK_PATH = "CLKOP",
-                p_CLKFB_DIV = 1,
+                **dynamic_phase
+        )
 
-                # Clock in.
-                i_CLKI=hspi_clocks.rx_clk,
+    def elaborate(self, platform):
+        m = Module()
 
-                # Internal feedback.
-                i_CLKFB=hspi_feedback,
+        # Create our domains.
+        m.domains.sync   = ClockDomain("sync")
+        m.domains.usb    = ClockDomain("usb")
+        m.domains.hspi   = ClockDomain("hspi")
 
-                # Control signals.
-                i_RST=reset,
-                i_PHASESEL0=0,
-                i_PHASESEL1=0,
-                i_PHASEDIR=1,
-                i_PHASESTEP=1,
-                i_PHASELOADREG=1,
-                i_STDBY=0,
-                i_PLLWAKESYNC=0,
 
-                # Output Enables.
-                i_ENCLKOP=0,
+        # Grab our clock and global reset signals.
+        clk25 = platform.request(platform.default_clk)
 
-                # Generated clock outputs.
-                o_CLKOP=hspi_feedback,
+        main_locked   = Signal()
+        hspi_locked   = self.hspi_locked
+        reset         = Signal()
 
-                # Synthesis attributes.
-                a_FREQUENCY_PIN_CLKI=self.HSPI_FREQ_MHZ,
-                a_FREQUENCY_PIN_CLKOP=self.HSPI_FREQ_MHZ,
+        # USB PLL
+        main_feedback    = Signal()
+        m.submodules.main_pll = self.pll(clki=clk25, clkop=main_feedback, locked=main_locked, reset=reset,
+                                         f_in=self.CLK_FREQ, dividers=self.usb_dividers)
 
-                a_ICP_CURRENT="6",
-                a_LPF_RESISTOR="16",
-                a_MFG_ENABLE_FILTEROPAMP="1",
-                a_MFG_GMCREF_SEL="2"
-        )
+        # HSPI PLL
+        hspi_clocks = platform.request("hspi-clocks", 0)
+        hspi_feedback = Signal()
+        if self.phase_calibration:
+            hspi_clock = Signal()
+            m.submodules.hspi_pll = self.pll(clki=hspi_clocks.rx_clk, clkop=hspi_feedback, locked=hspi_locked, reset=reset,
+                                             f_in=self.hspi_freq, dividers=self.hspi_dividers, clkos=hspi_clock,
+                                             phase_step=self.hspi_phase_step, phase_dir=self.hspi_phase_dir)
+        else:
+            hspi_clock = hspi_feedback
+            m.submodules.hspi_pll = self.pll(clki=hspi_clocks.rx_clk, clkop=hspi_feedback, locked=hspi_locked, reset=reset,
+                                             f_in=self.hspi_freq, dividers=self.hspi_dividers)
 
 
-        reset = Signal()
         # Control our resets.
         m.d.comb += [
             ClockSignal("usb")     .eq(main_feedback),
             ClockSignal("sync")    .eq(ClockSignal("usb")),
-            ClockSignal("hspi")    .eq(hspi_feedback),
+            ClockSignal("hspi")    .eq(hspi_clock),
 
             hspi_clocks.tx_clk.eq(ClockSignal("hspi")),
 
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import sys
+import csv
+import json
+import time
+import argparse
+
+from hspi.benchmark import DESIGNS, LENGTHS, GAPS, HANDSHAKES, ACKS, METRICS, BenchmarkPoint, \
+                           points, run_point, compare, python_simulator
+from hspi.cxxrtl    import CXXRTLSimulator
+
+FIELDS = [*BenchmarkPoint._fields, "frames", "cycles", *METRICS]
+
+def frames_for(frame_words, words):
+    """ enough frames to send about words payload words, but at least 4 and at most 64 """
+    return max(4, min(64, words // frame_words))
+
+def write_csv(path, results):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="measures the throughput of the HSPI cores in simulation")
+    parser.add_argument("--designs",    nargs="+", choices=DESIGNS, default=DESIGNS)
+    parser.add_argument("--lengths",    nargs="+", type=int, default=LENGTHS, help="payload words per frame")
+    parser.add_argument("--gaps",       nargs="+", choices=GAPS, default=list(GAPS),
+                        help="gaps in the data going into the core")
+    parser.add_argument("--handshakes", nargs="+", choices=HANDSHAKES, default=list(HANDSHAKES),
+                        help="timing of the handshakes of the CH569")
+    parser.add_argument("--acks",       nargs="+", choices=ACKS, default=ACKS,
+                        help="when the transmitters send ACK frames")
+    parser.add_argument("--words",      type=int, default=16384, help="payload words to send for each point")
+    parser.add_argument("--seed",       type=int, default=0)
+    parser.add_argument("--backend",    choices=["cxxrtl", "python"], default="cxxrtl", help="the simulator to use")
+    parser.add_argument("--build-dir",  default="build/cxxrtl", help="where the compiled designs are kept")
+    parser.add_argument("--json",       help="write the results to this JSON file")
+    parser.add_argument("--csv",        help="write the results to this CSV file")
+    parser.add_argument("--baseline",   help="JSON file of an earlier run to compare with")
+    parser.add_argument("--tolerance",  type=float, default=0.02, help="relative change which counts as a regression")
+    args = parser.parse_args()
+
+    if args.backend == "cxxrtl":
+        simulator = lambda dut, ports: CXXRTLSimulator(dut, ports=ports, build_dir=args.build_dir)
+    else:
+        simulator = python_simulator
+
+    results = []
+    start   = time.perf_counter()
+    print(f"{'design':>22} {'words':>5} {'gap':>5} {'handshake':>9} {'ack':>7} {'words/cycle':>11} {'overhead':>8} {'latency':>8} {'max':>6}")
+    for point in points(args.designs, args.lengths, args.gaps, args.handshakes, args.acks):
+        result = run_point(point, frames=frames_for(point.frame_words, args.words), simulator=simulator, seed=args.seed)
+        results.append(result)
+        print(f"{point.design:>22} {point.frame_words:>5} {point.gap:>5} {point.handshake:>9} {point.ack:>7} "
+              f"{result['words_per_cycle']:>11.4f} {result['overhead_per_frame']:>8.1f} "
+              f"{result['latency_mean']:>8.1f} {result['latency_max']:>6}")
+    print(f"{len(results)} points in {time.perf_counter() - start:.0f} s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(backend=args.backend, seed=args.seed, words=args.words, results=results), f, indent=2)
+    if args.csv:
+        write_csv(args.csv, results)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["backend"] != args.backend:
+            print(f"the baseline was measured with {baseline['backend']}, "
+                  f"which can differ from {args.backend} by a cycle here and there")
+        baseline = baseline["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for point, metric, old, new in regressions:
+            print(f"REGRESSION {point.design} {point.frame_words} words, {point.gap} gaps, "
+                  f"{point.handshake} handshake: {metric} {old:.4f} -> {new:.4f}")
+        if regressions:
+            sys.exit(1)
+        print("no regressions")
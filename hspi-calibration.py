@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import sys
+import time
+import struct
+import argparse
+
+import usb
+
+from hspi.calibration import HSPIPhaseCalibration, VENDOR_REQUEST_CALIBRATION_START, VENDOR_REQUEST_CALIBRATION_STATUS
+
+VENDOR_OUT = usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE
+VENDOR_IN  = usb.util.CTRL_IN  | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE
+
+def read_status(dev):
+    """ the fields of the status word of the phase calibration """
+    status = struct.unpack("<I", bytes(dev.ctrl_transfer(VENDOR_IN, VENDOR_REQUEST_CALIBRATION_STATUS, 0, 0, 4)))[0]
+    fields = {}
+    for name, width in HSPIPhaseCalibration.STATUS_LAYOUT:
+        fields[name] = status & ((1 << width) - 1)
+        status >>= width
+    return fields
+
+def print_status(fields):
+    if fields["calibrating"]:
+        print("phase calibration still running")
+    elif fields["failed"]:
+        print("phase calibration failed, no phase receives the training frames")
+    elif fields["done"]:
+        print(f"phase window from step {fields['window_start']}, {fields['window_length']} steps long, "
+              f"settled on step {fields['phase']}")
+    else:
+        print("phase calibration has not run")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="shows the result of the HSPI phase calibration of the Colorlight board")
+    parser.add_argument("--recalibrate", action="store_true", help="run the phase calibration again before showing its result")
+    parser.add_argument("--wait", type=float, default=0.5, metavar="SECONDS",
+                        help="time to give the calibration with --recalibrate")
+    args = parser.parse_args()
+
+    dev = usb.core.find(idVendor=0x1209, idProduct=0x4711)
+    if dev is None:
+        sys.exit("HSPI board not found")
+
+    if args.recalibrate:
+        dev.ctrl_transfer(VENDOR_OUT, VENDOR_REQUEST_CALIBRATION_START, 0, 0)
+        time.sleep(args.wait)
+
+    print_status(read_status(dev))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import sys
+import time
+import struct
+import argparse
+
+import usb
+
+from hspi.counters import counter_names, VENDOR_REQUEST_SNAPSHOT, VENDOR_REQUEST_READ, VENDOR_REQUEST_CLEAR
+
+VENDOR_OUT = usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE
+VENDOR_IN  = usb.util.CTRL_IN  | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE
+
+def read_counters(dev):
+    dev.ctrl_transfer(VENDOR_OUT, VENDOR_REQUEST_SNAPSHOT, 0, 0)
+    return {
+        name: struct.unpack("<I", bytes(dev.ctrl_transfer(VENDOR_IN, VENDOR_REQUEST_READ, 0, n, 4)))[0]
+        for n, name in enumerate(counter_names())
+    }
+
+def print_counters(counters, previous=None):
+    for name, value in counters.items():
+        line = f"{name:24} {value:12}"
+        if previous is not None:
+            line += f" {(value - previous[name]) % (1 << 32):+12}"
+        print(line)
+
+    for direction in ("tx", "rx"):
+        words = counters[f"{direction}_words"]
+        busy  = words + counters[f"{direction}_idle"]
+        if busy:
+            print(f"{direction} bus efficiency: {100 * words / busy:.1f}% of the cycles with {'tx_req' if direction == 'tx' else 'rx_act'}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="reads the HSPI link counters of the Colorlight board")
+    parser.add_argument("--clear", action="store_true", help="set all counters to zero after reading them")
+    parser.add_argument("--watch", type=float, metavar="SECONDS", help="read again every SECONDS, showing the differences")
+    args = parser.parse_args()
+
+    dev = usb.core.find(idVendor=0x1209, idProduct=0x4711)
+    if dev is None:
+        sys.exit("HSPI board not found")
+
+    previous = None
+    while True:
+        counters = read_counters(dev)
+        print_counters(counters, previous)
+        if args.clear:
+            dev.ctrl_transfer(VENDOR_OUT, VENDOR_REQUEST_CLEAR, 0, 0)
+        if args.watch is None:
+            break
+        previous = None if args.clear else counters
+        time.sleep(args.watch)
+        print()
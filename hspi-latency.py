@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import sys
+import struct
+import argparse
+from fractions import Fraction
+
+import usb
+
+from hspi.latency import HISTOGRAM_EXTRAS, VENDOR_REQUEST_HISTOGRAM_FREEZE, \
+                         VENDOR_REQUEST_HISTOGRAM_READ, VENDOR_REQUEST_HISTOGRAM_CLEAR
+
+VENDOR_OUT = usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE
+VENDOR_IN  = usb.util.CTRL_IN  | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE
+
+PERCENTILES = [50, 90, 99, 99.9, 99.99, 99.999]
+
+def read_value(dev, n):
+    return struct.unpack("<I", bytes(dev.ctrl_transfer(VENDOR_IN, VENDOR_REQUEST_HISTOGRAM_READ, 0, n, 4)))[0]
+
+def read_histogram(dev, bins, clear=False):
+    """ reads the bins and the values after them, with the histogram frozen in between """
+    dev.ctrl_transfer(VENDOR_OUT, VENDOR_REQUEST_HISTOGRAM_FREEZE, 1, 0)
+    try:
+        histogram = [read_value(dev, n) for n in range(bins)]
+        extras    = {name: read_value(dev, bins + n) for n, name in enumerate(HISTOGRAM_EXTRAS)}
+        if clear:
+            dev.ctrl_transfer(VENDOR_OUT, VENDOR_REQUEST_HISTOGRAM_CLEAR, 0, 0)
+    finally:
+        dev.ctrl_transfer(VENDOR_OUT, VENDOR_REQUEST_HISTOGRAM_FREEZE, 0, 0)
+    return histogram, extras
+
+def percentile(histogram, bin_shift, p):
+    """ upper bound in cycles of the bin the percentile p falls into,
+        None for the last bin, which has no upper bound
+    """
+    samples = sum(histogram)
+    rank    = Fraction(str(p)) / 100 * samples
+    count   = 0
+    for n, value in enumerate(histogram):
+        count += value
+        if count >= rank:
+            return None if n == len(histogram) - 1 else (n + 1) << bin_shift
+    return None
+
+def print_histogram(histogram, extras, freq_mhz):
+    bin_shift = extras["bin_shift"]
+    samples   = sum(histogram)
+    print(f"{samples} frames, {extras['unmatched']} sent without a matching received frame")
+    if not samples:
+        return
+
+    def cycles(value):
+        return f"{value:8} cycles {1000 * value / freq_mhz:10.1f} ns"
+
+    for p in PERCENTILES:
+        value = percentile(histogram, bin_shift, p)
+        if value is None:
+            print(f"p{p:<8} beyond the last bin, >= {cycles((len(histogram) - 1) << bin_shift)}")
+        else:
+            print(f"p{p:<8} <= {cycles(value)}")
+    print(f"{'max':9} {cycles(extras['max'])}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="reads the HSPI round trip latency histogram of the Colorlight board")
+    parser.add_argument("--bins",  type=int, default=1024, help="number of bins of the histogram in the gateware")
+    parser.add_argument("--freq",  type=float, default=96, metavar="MHZ", help="clock frequency of the hspi domain")
+    parser.add_argument("--clear", action="store_true", help="clear the histogram after reading it")
+    parser.add_argument("--dump",  action="store_true", help="also print all bins which are not empty")
+    args = parser.parse_args()
+
+    dev = usb.core.find(idVendor=0x1209, idProduct=0x4711)
+    if dev is None:
+        sys.exit("HSPI board not found")
+
+    histogram, extras = read_histogram(dev, args.bins, clear=args.clear)
+    if extras["samples"] != sum(histogram):
+        print(f"warning: {extras['samples']} samples, but {sum(histogram)} in the bins, is --bins right?")
+
+    if args.dump:
+        for n, value in enumerate(histogram):
+            if value:
+                print(f"{n << extras['bin_shift']:8} {value:12}")
+        print()
+
+    print_histogram(histogram, extras, args.freq)
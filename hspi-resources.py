@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import importlib.util
+
+from hspi.resources import VARIANTS, variant_name, synthesize_core, synthesize_platform
+
+# settings of ColorlightHSPI, see colorlight-hspi.py, the others are compared to the first one
+COLORLIGHT_VARIANTS = [
+    dict(),
+    dict(USE_ILA=False),
+    dict(ILA_SAMPLE_DEPTH=8 * 1024),
+    dict(LOOPBACK_DEPTH=1024),
+    dict(CRC_LATENCY=1),
+    dict(STREAMING=True),
+    dict(IO_REGISTERS=True),
+    dict(USE_ARQ=True),
+    dict(USE_LINK_COUNTERS=True),
+    dict(USE_LATENCY_HISTOGRAM=True),
+]
+
+DESIGNS   = [*VARIANTS, "colorlight"]
+RESOURCES = ["luts", "ffs", "brams", "lutrams", "dsps"]
+
+def colorlight_design(settings):
+    """ ColorlightHSPI with settings instead of its class attributes, and the platform to build it for """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    spec      = importlib.util.spec_from_file_location("colorlight_hspi", os.path.join(directory, "colorlight-hspi.py"))
+    module    = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    from colorlight import ColorlightHSPIPlatform
+    design = type("ColorlightHSPI", (module.ColorlightHSPI,), settings)
+    return ColorlightHSPIPlatform(), design()
+
+def print_table(results):
+    domains = sorted({domain for result in results for domain in result.get("fmax", {})})
+    print(f"{'design':>12} {'variant':<40}" + "".join(f" {resource:>6} {'':6}" for resource in RESOURCES)
+          + "".join(f" {'fmax ' + domain:>9} {'':8}" for domain in domains))
+
+    baseline = {}
+    for result in results:
+        base = baseline.setdefault(result["design"], result)
+        line = f"{result['design']:>12} {result['variant']:<40}"
+        for resource in RESOURCES:
+            change = f"({result[resource] - base[resource]:+})" if result is not base else ""
+            line  += f" {result[resource]:>6} {change:<6}"
+        for domain in domains:
+            value = result.get("fmax", {}).get(domain)
+            if value is None:
+                line += f" {'':>18}"
+                continue
+            reference = base.get("fmax", {}).get(domain)
+            change    = f"({value - reference:+.1f})" if result is not base and reference else ""
+            line     += f" {value:>9.1f} {change:<8}"
+        print(line)
+
+def write_csv(path, results):
+    domains = sorted({domain for result in results for domain in result.get("fmax", {})})
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["design", "variant", *RESOURCES, *(f"fmax_{domain}" for domain in domains)])
+        for result in results:
+            writer.writerow([result["design"], result["variant"], *(result[resource] for resource in RESOURCES),
+                             *(result.get("fmax", {}).get(domain, "") for domain in domains)])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="measures the FPGA resources and Fmax of configurations of the HSPI cores "
+                    "and of the Colorlight design with yosys and nextpnr-ecp5")
+    parser.add_argument("--designs",    nargs="+", choices=DESIGNS, default=DESIGNS)
+    parser.add_argument("--variants",   nargs="+", metavar="TEXT",
+                        help="only build the variants whose name contains one of these")
+    parser.add_argument("--synth-only", action="store_true", help="only count the resources, without place and route")
+    parser.add_argument("--seeds",      nargs="+", type=int, default=[1],
+                        help="nextpnr seeds to place each variant with, the median Fmax is reported")
+    parser.add_argument("--freq",       type=float, default=96, help="target frequency of the cores in MHz")
+    parser.add_argument("--build-dir",  default="build/resources")
+    parser.add_argument("--json",       help="write the results to this JSON file")
+    parser.add_argument("--csv",        help="write the results to this CSV file")
+    args = parser.parse_args()
+
+    builds = []
+    for design in args.designs:
+        for arguments in COLORLIGHT_VARIANTS if design == "colorlight" else VARIANTS[design]:
+            name = variant_name(arguments)
+            # the variant everything else is compared to is always built
+            if args.variants and arguments and not any(text in name for text in args.variants):
+                continue
+            builds.append((design, name, arguments))
+
+    results = []
+    start   = time.perf_counter()
+    for n, (design, name, arguments) in enumerate(builds):
+        print(f"[{n + 1}/{len(builds)}] {design} {name}", file=sys.stderr)
+        build_dir = os.path.join(args.build_dir, design, name.replace(" ", "_"))
+        if design == "colorlight":
+            platform, elaboratable = colorlight_design(arguments)
+            result = synthesize_platform(platform, elaboratable, build_dir, design=design, variant=name,
+                                         place=not args.synth_only, seeds=args.seeds)
+        else:
+            result = synthesize_core(design, arguments, build_dir,
+                                     place=not args.synth_only, freq=args.freq * 1e6, seeds=args.seeds)
+        results.append(result)
+
+    print_table(results)
+    print(f"{len(results)} variants in {time.perf_counter() - start:.0f} s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(seeds=args.seeds, freq=args.freq, results=results), f, indent=2)
+    if args.csv:
+        write_csv(args.csv, results)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import sys
+import time
+import random
+import argparse
+from collections import deque
+
+from amaranth.sim import Simulator, Passive
+
+from hspi          import HSPITransmitter, HSPIReceiver, HSPILoopback
+from hspi.bfm      import HSPIBusFunctionalModel
+from hspi.cxxrtl   import CXXRTLSimulator, signals
+
+CLOCK_PERIOD = 1 / 100e6
+
+def random_payload(rng, max_words):
+    return [rng.getrandbits(32) for _ in range(rng.randint(1, max_words))]
+
+def bus_model(hspi, rng, args):
+    return HSPIBusFunctionalModel(hspi, rng=rng, valid_gap=args.valid_gap, frame_gap=(0, args.frame_gap),
+                                  ready_delay=(0, args.ready_delay), release_delay=(0, args.release_delay))
+
+def forget(bfm):
+    """ drops the frames the model keeps, so that a long run does not fill the memory """
+    bfm.sent.clear()
+    bfm.received.clear()
+    bfm.acks.clear()
+
+def loopback_soak(args, rng):
+    dut = HSPILoopback(depth=4096, streaming=True)
+    bfm = bus_model(dut.hspi, rng, args)
+
+    def stimulus():
+        for n in range(args.frames):
+            while bfm.queued > 1:
+                yield
+                forget(bfm)
+            payload = random_payload(rng, args.max_words)
+            bfm.send(payload, sequence_nr=n % 16)
+            bfm.expect(payload)
+        while not bfm.idle:
+            yield
+
+    return dut, signals(dut.hspi), bfm, [stimulus]
+
+def transmitter_soak(args, rng):
+    dut = HSPITransmitter(streaming=True)
+    bfm = bus_model(dut.hspi_out, rng, args)
+    stream_in = dut.stream_in
+
+    def stimulus():
+        for n in range(args.frames):
+            payload = random_payload(rng, args.max_words)
+            bfm.expect(payload, sequence_nr=n % 16)
+            yield dut.sequence_nr_in.eq(n % 16)
+            for i, word in enumerate(payload):
+                while rng.random() < args.valid_gap:
+                    yield stream_in.valid.eq(0)
+                    yield
+                yield stream_in.payload.eq(word)
+                yield stream_in.valid.eq(1)
+                yield stream_in.first.eq(i == 0)
+                yield stream_in.last.eq(i == len(payload) - 1)
+                yield
+                while not (yield stream_in.ready):
+                    yield
+            yield stream_in.valid.eq(0)
+            forget(bfm)
+        while not bfm.idle:
+            yield
+
+    ports = [*signals(dut.hspi_out), *signals(stream_in),
+             dut.tll_2b_in, dut.sequence_nr_in, dut.user_id0_in, dut.user_id1_in]
+    return dut, ports, bfm, [stimulus]
+
+def receiver_soak(args, rng):
+    dut = HSPIReceiver()
+    bfm = bus_model(dut.hspi_in, rng, args)
+    stream_out = dut.stream_out
+    expected   = deque()
+
+    def stimulus():
+        for n in range(args.frames):
+            while bfm.queued > 1:
+                yield
+                forget(bfm)
+            payload = random_payload(rng, args.max_words)
+            corrupt = rng.random() < 0.01
+            bfm.send(payload, sequence_nr=n % 16, corrupt_crc=corrupt)
+            expected.append((payload, corrupt, n % 16))
+        while expected:
+            yield
+
+    def checker():
+        yield Passive()
+        frame = []
+        while True:
+            yield
+            if (yield stream_out.valid):
+                frame.append((yield stream_out.payload))
+            if (yield stream_out.last):
+                received = (frame, bool((yield stream_out.crc_error)), (yield dut.sequence_nr_out))
+                if received != expected[0]:
+                    raise AssertionError(f"received {received}, not {expected[0]}")
+                expected.popleft()
+                frame = []
+
+    ports = [*signals(dut.hspi_in), *signals(stream_out), dut.sequence_nr_out]
+    return dut, ports, bfm, [stimulus, checker]
+
+SOAKS = dict(loopback=loopback_soak, transmitter=transmitter_soak, receiver=receiver_soak)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="randomized soak test of the HSPI cores against a model of the CH569")
+    parser.add_argument("design", choices=SOAKS, help="the design to test")
+    parser.add_argument("--backend",       choices=["cxxrtl", "python"], default="cxxrtl", help="the simulator to use")
+    parser.add_argument("--frames",        type=int,   default=1000, help="number of frames to send")
+    parser.add_argument("--max-words",     type=int,   default=4096, help="maximum number of payload words of a frame")
+    parser.add_argument("--valid-gap",     type=float, default=0.05, help="probability of a gap before a word")
+    parser.add_argument("--frame-gap",     type=int,   default=16, help="maximum number of cycles between frames")
+    parser.add_argument("--ready-delay",   type=int,   default=4,  help="maximum number of cycles from tx_req to tx_ready")
+    parser.add_argument("--release-delay", type=int,   default=2,  help="maximum number of cycles tx_ready stays up after tx_req")
+    parser.add_argument("--seed",          type=int,   default=0)
+    parser.add_argument("--build-dir",     default="build/cxxrtl", help="where the compiled designs are kept")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    dut, ports, bfm, processes = SOAKS[args.design](args, rng)
+
+    if args.backend == "cxxrtl":
+        sim = CXXRTLSimulator(dut, ports=ports, build_dir=args.build_dir)
+    else:
+        sim = Simulator(dut)
+    sim.add_clock(CLOCK_PERIOD, domain="sync")
+
+    def run_bfm():
+        yield Passive()
+        yield from bfm.process()
+
+    sim.add_sync_process(run_bfm, domain="sync")
+    for process in processes:
+        sim.add_sync_process(process, domain="sync")
+
+    start = time.perf_counter()
+    try:
+        sim.run()
+    except AssertionError as error:
+        print(f"FAILED after {bfm.cycle} cycles: {error}")
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.frames} frames in {bfm.cycle} cycles, {elapsed:.1f} s")
+    print(f"{bfm.cycle / elapsed:.0f} simulated cycles per second")
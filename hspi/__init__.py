@@ -1,8 +1,48 @@
 # Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
 # SPDX-License-Identifier: BSD-3-Clause
 
-from .hspi import HSPIInterface, HSPITransmitter, HSPIReceiver, CRC
+""" HSPI cores for amaranth and the host side codec of their frames
+
+    The cores are imported when they are first used, so hspi.codec
+    works on a host with only numpy, without amaranth and amlib.
+"""
+
+from importlib import import_module
+
+_MODULES = dict(
+    HSPIInterface        = "hspi",
+    HSPITransmitter      = "hspi",
+    HSPIReceiver         = "hspi",
+    CRC                  = "hspi",
+    HSPIPacketBuffer     = "buffers",
+    HSPIFrameBuffer      = "buffers",
+    HSPILoopback         = "loopback",
+    HSPIARQ              = "arq",
+    HSPIDemultiplexer    = "demux",
+    HSPIScheduler        = "scheduler",
+    HSPIStreamBridge     = "cdc",
+    HSPILinkCounters     = "counters",
+    HSPILatencyHistogram = "latency",
+    WishboneInterface    = "dma",
+    HSPITransmitDMA      = "dma",
+    HSPIReceiveDMA       = "dma",
+    ECP5HSPIPads         = "ecp5",
+    HSPIPhaseCalibration = "calibration",
+)
+
+def __getattr__(name):
+    if name not in _MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(import_module(f".{_MODULES[name]}", __name__), name)
+
+def __dir__():
+    return [*globals(), *_MODULES]
 
 __all__ = [
-        "HSPIInterface", "HSPITransmitter", "HSPIReceiver", "CRC"
+        "HSPIInterface", "HSPITransmitter", "HSPIReceiver", "CRC",
+        "HSPIPacketBuffer", "HSPIFrameBuffer", "HSPILoopback",
+        "HSPIARQ", "HSPIDemultiplexer", "HSPIScheduler",
+        "WishboneInterface", "HSPITransmitDMA", "HSPIReceiveDMA",
+        "HSPIStreamBridge", "HSPILinkCounters", "HSPILatencyHistogram",
+        "ECP5HSPIPads", "HSPIPhaseCalibration",
     ]
@@ -0,0 +1,719 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+import random
+
+from amaranth import *
+
+from amlib.stream import StreamInterface
+
+from .hspi import HSPIInterface, HSPITransmitter, HSPIReceiver
+
+# user id in the header of the frames which carry acknowledgements,
+# data frames must not use it
+ACK_USER_ID = 0x3acc0de
+
+class HSPIRetransmitter(Elaboratable):
+    """ Sending side of HSPIARQ
+
+        Stores up to window frames of up to max_frame_words words from stream_in,
+        numbered with consecutive sequence numbers, and keeps them until the other side
+        has acknowledged them. Longer packets are cut into several frames,
+        and more_out is high with every frame but the last one of a packet.
+        Each word of the acknowledgements coming in on ack_in / nak_in has one bit per
+        sequence number, frames with a bit in nak_in are sent again. If nothing is
+        acknowledged for timeout cycles, all frames which are still outstanding are
+        sent again.
+
+        frame_out goes to a HSPITransmitter, with its sequence number on sequence_nr_out.
+        When send_ack_in is high, a frame with the single word ack_word_in is sent
+        before any other frame, with control_out high. ack_sent_out is high
+        when that word has been taken.
+    """
+    def __init__(self, *, window=4, max_frame_words=4096, timeout=65536):
+        if window & (window - 1) or not 0 < window <= 8:
+            raise ValueError(f"window must be a power of two of at most 8, not {window}")
+
+        self.stream_in       = StreamInterface(name="retransmit_in", payload_width=32)
+        self.frame_out       = StreamInterface(name="retransmit_out", payload_width=32)
+        self.sequence_nr_out = Signal(4)
+        self.more_out        = Signal()
+        self.control_out     = Signal()
+
+        self.ack_valid_in    = Signal()
+        self.ack_in          = Signal(16)
+        self.nak_in          = Signal(16)
+
+        self.send_ack_in     = Signal()
+        self.ack_word_in     = Signal(32)
+        self.ack_sent_out    = Signal()
+
+        self.resent_out      = Signal(16)
+        self.timeouts_out    = Signal(16)
+
+        self.window          = window
+        self.max_frame_words = max_frame_words
+        self.timeout         = timeout
+
+    def elaborate(self, platform):
+        m = Module()
+        comb = m.d.comb
+        sync = m.d.sync
+
+        window     = self.window
+        slot_bits  = (window - 1).bit_length()
+        index_bits = (self.max_frame_words - 1).bit_length()
+
+        memory = Memory(width=32, depth=window << index_bits)
+        m.submodules.write_port = write_port = memory.write_port()
+        m.submodules.read_port  = read_port  = memory.read_port(transparent=False)
+
+        lengths  = Array(Signal(range(self.max_frame_words + 1), name=f"length{n}") for n in range(window))
+        slot_seq = Array(Signal(4, name=f"slot_seq{n}") for n in range(window))
+        # frames which are followed by another one of the same packet
+        more     = Array(Signal(name=f"more{n}") for n in range(window))
+
+        # frames which have not been acknowledged yet, and those of them which have to be sent (again)
+        outstanding = Signal(window)
+        resend      = Signal(window)
+        sent        = Signal(window)
+
+        filled      = Signal(window)
+        picked      = Signal(window)
+        acked       = Signal(window)
+        naked       = Signal(window)
+        timed_out   = Signal(window)
+
+        base_seq    = Signal(4)
+        next_seq    = Signal(4)
+        in_flight   = Signal(4)
+
+        #
+        # take new frames into the window
+        #
+        fill_index = Signal(range(self.max_frame_words))
+        fill_slot  = Signal(slot_bits)
+        fill_beat  = Signal()
+        fill_done  = Signal()
+        send_slot  = Signal(slot_bits)
+        sending    = Signal()
+
+        comb += [
+            in_flight.eq(next_seq - base_seq),
+            fill_slot.eq(next_seq),
+
+            # a frame which was acknowledged while it is sent again
+            # must not be overwritten before it is through
+            self.stream_in.ready.eq((in_flight < window) & ~(sending & (send_slot == fill_slot))),
+            fill_beat.eq(self.stream_in.valid & self.stream_in.ready),
+            fill_done.eq(fill_beat & (self.stream_in.last | (fill_index == self.max_frame_words - 1))),
+            filled.eq(fill_done << fill_slot),
+
+            write_port.addr.eq(Cat(fill_index[:index_bits], fill_slot)),
+            write_port.data.eq(self.stream_in.payload),
+            write_port.en.eq(fill_beat),
+        ]
+
+        with m.If(fill_beat):
+            sync += fill_index.eq(fill_index + 1)
+        with m.If(fill_done):
+            sync += [
+                fill_index.eq(0),
+                lengths[fill_slot].eq(fill_index + 1),
+                slot_seq[fill_slot].eq(next_seq),
+                more[fill_slot].eq(~self.stream_in.last),
+                next_seq.eq(next_seq + 1),
+            ]
+
+        #
+        # process the acknowledgements
+        #
+        for n in range(window):
+            with m.If(self.ack_valid_in & outstanding[n]):
+                comb += [
+                    acked[n].eq(self.ack_in.bit_select(slot_seq[n], 1)),
+                    naked[n].eq(self.nak_in.bit_select(slot_seq[n], 1)),
+                ]
+
+        base_slot = Signal(slot_bits)
+        comb += base_slot.eq(base_seq)
+        with m.If((in_flight != 0) & ~outstanding.bit_select(base_slot, 1)):
+            sync += base_seq.eq(base_seq + 1)
+
+        # the oldest frame which has to be sent
+        pick_valid = Signal()
+        pick_seq   = Signal(4)
+        pick_slot  = Signal(slot_bits)
+        for n in reversed(range(window)):
+            seq = (base_seq + n)[:4]
+            with m.If((n < in_flight) & resend.bit_select(seq[:slot_bits], 1)):
+                comb += [
+                    pick_valid.eq(1),
+                    pick_seq.eq(seq),
+                ]
+        comb += pick_slot.eq(pick_seq)
+
+        #
+        # send frames
+        #
+        read_index = Signal(range(self.max_frame_words + 1))
+        load       = Signal()
+        beat_valid = Signal()
+        beat_first = Signal()
+        beat_last  = Signal()
+        frame_out  = self.frame_out
+
+        comb += [
+            send_slot.eq(self.sequence_nr_out),
+            self.more_out.eq(more[send_slot] & ~self.control_out),
+            read_port.addr.eq(Cat(read_index[:index_bits], send_slot)),
+            read_port.en.eq(load),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(self.send_ack_in):
+                    m.next = "ACK"
+                with m.Elif(pick_valid):
+                    comb += picked.eq(1 << pick_slot)
+                    sync += [
+                        self.sequence_nr_out.eq(pick_seq),
+                        read_index.eq(0),
+                    ]
+                    with m.If(sent.bit_select(pick_slot, 1)):
+                        sync += self.resent_out.eq(self.resent_out + 1)
+                    m.next = "DATA"
+
+            with m.State("DATA"):
+                comb += [
+                    sending.eq(1),
+                    load.eq((read_index < lengths[send_slot]) & (~beat_valid | frame_out.ready)),
+
+                    frame_out.payload.eq(read_port.data),
+                    frame_out.valid.eq(beat_valid),
+                    frame_out.first.eq(beat_first),
+                    frame_out.last.eq(beat_last),
+                ]
+
+                with m.If(load):
+                    sync += [
+                        read_index.eq(read_index + 1),
+                        beat_valid.eq(1),
+                        beat_first.eq(read_index == 0),
+                        beat_last.eq(read_index + 1 == lengths[send_slot]),
+                    ]
+                with m.Elif(frame_out.ready):
+                    sync += beat_valid.eq(0)
+
+                with m.If(frame_out.valid & frame_out.ready & frame_out.last):
+                    m.next = "IDLE"
+
+            with m.State("ACK"):
+                comb += [
+                    self.control_out.eq(1),
+                    frame_out.payload.eq(self.ack_word_in),
+                    frame_out.valid.eq(1),
+                    frame_out.first.eq(1),
+                    frame_out.last.eq(1),
+                ]
+                with m.If(frame_out.ready):
+                    comb += self.ack_sent_out.eq(1)
+                    m.next = "IDLE"
+
+        #
+        # send everything again if the acknowledgements stop coming
+        #
+        timer = Signal(range(self.timeout + 1))
+        with m.If(self.ack_valid_in | (in_flight == 0) | (resend != 0)):
+            sync += timer.eq(0)
+        with m.Elif(timer == self.timeout):
+            comb += timed_out.eq(outstanding)
+            sync += [
+                timer.eq(0),
+                self.timeouts_out.eq(self.timeouts_out + 1),
+            ]
+        with m.Else():
+            sync += timer.eq(timer + 1)
+
+        sync += [
+            outstanding.eq((outstanding | filled) & ~acked),
+            resend.eq(((resend & ~picked) | filled | naked | timed_out) & ~acked),
+            sent.eq((sent | picked) & ~filled),
+        ]
+
+        return m
+
+class HSPIReceiveWindow(Elaboratable):
+    """ Receiving side of HSPIARQ
+
+        Takes the frames of a HSPIReceiver, together with the sequence number and the user id
+        from their header. Data frames with a correct CRC are kept in one of window slots
+        until all frames before them have arrived, and are handed out on stream_out
+        in the order of their sequence numbers, each one exactly once.
+        more_in comes from the header like the sequence number, and is high in all frames
+        but the last one of a packet, whose frames come out as one packet on stream_out.
+
+        The sequence numbers of the frames which arrived are collected in ack_word_out,
+        in the lower half with a correct CRC, in the upper half without. As the sequence
+        number of a frame with a CRC error may be the broken bit, only the frame which
+        is expected next is acknowledged negatively, the others are left to the timeout
+        of the other side. send_ack_out
+        asks to send them when there is a CRC error, when ack_batch frames have arrived,
+        or when ack_timeout cycles have passed without a frame. Frames whose slot is
+        not free yet are neither kept nor acknowledged, frames which were already handed
+        out are acknowledged again.
+
+        Frames with ACK_USER_ID carry the acknowledgements of the other side,
+        which come out on ack_out, nak_out and ack_valid_out.
+    """
+    def __init__(self, *, window=4, max_frame_words=4096, ack_batch=2, ack_timeout=64):
+        if window & (window - 1) or not 0 < window <= 8:
+            raise ValueError(f"window must be a power of two of at most 8, not {window}")
+
+        self.stream_in      = StreamInterface(name="window_in", payload_width=32, extra_fields=[("crc_error", 1)])
+        self.user_id_in     = Signal(26)
+        self.sequence_nr_in = Signal(4)
+        self.more_in        = Signal()
+        self.stream_out     = StreamInterface(name="window_out", payload_width=32)
+
+        self.ack_valid_out  = Signal()
+        self.ack_out        = Signal(16)
+        self.nak_out        = Signal(16)
+
+        self.send_ack_out   = Signal()
+        self.ack_word_out   = Signal(32)
+        self.ack_sent_in    = Signal()
+
+        self.crc_errors_out = Signal(16)
+        self.duplicates_out = Signal(16)
+
+        self.window          = window
+        self.max_frame_words = max_frame_words
+        self.ack_batch       = ack_batch
+        self.ack_timeout     = ack_timeout
+
+    def elaborate(self, platform):
+        m = Module()
+        comb = m.d.comb
+        sync = m.d.sync
+
+        window     = self.window
+        slot_bits  = (window - 1).bit_length()
+        index_bits = (self.max_frame_words - 1).bit_length()
+        stream_in  = self.stream_in
+
+        memory = Memory(width=32, depth=window << index_bits)
+        m.submodules.write_port = write_port = memory.write_port()
+        m.submodules.read_port  = read_port  = memory.read_port(transparent=False)
+
+        lengths  = Array(Signal(range(self.max_frame_words + 1), name=f"length{n}") for n in range(window))
+        # frames which are followed by another one of the same packet
+        more     = Array(Signal(name=f"more{n}") for n in range(window))
+        # slots which hold a frame which has not been handed out yet
+        occupied = Signal(window)
+        stored   = Signal(window)
+        released = Signal(window)
+        expected = Signal(4)
+
+        ack_bits = Signal(16)
+        nak_bits = Signal(16)
+        ack_set  = Signal(16)
+        nak_set  = Signal(16)
+
+        #
+        # receive frames
+        #
+        in_frame    = Signal()
+        frame_ack   = Signal()
+        frame_seq   = Signal(4)
+        frame_keep  = Signal()
+        frame_more  = Signal()
+        ack_frame   = Signal()
+        seq         = Signal(4)
+        seq_more    = Signal()
+        slot        = Signal(slot_bits)
+        offset      = Signal(4)
+        ahead       = Signal()
+        behind      = Signal()
+        keep        = Signal()
+        index       = Signal(range(self.max_frame_words + 1))
+        frame_words = Signal.like(index)
+        ack_word    = Signal(32)
+        ack_payload = Signal(32)
+
+        comb += [
+            slot.eq(seq),
+            offset.eq(seq - expected),
+            ahead.eq(offset < window),
+            behind.eq(offset >= 16 - window),
+        ]
+
+        # the header fields could already belong to the next frame at the end of this one,
+        # and the window moves on while a frame comes in,
+        # so everything is decided at its first word
+        with m.If(in_frame):
+            comb += [
+                ack_frame.eq(frame_ack),
+                seq.eq(frame_seq),
+                seq_more.eq(frame_more),
+                keep.eq(frame_keep),
+            ]
+        with m.Else():
+            comb += [
+                ack_frame.eq(self.user_id_in == ACK_USER_ID),
+                seq.eq(self.sequence_nr_in),
+                seq_more.eq(self.more_in),
+                keep.eq(~ack_frame & ahead & ~occupied.bit_select(slot, 1)),
+            ]
+
+        comb += [
+            frame_words.eq(index + stream_in.valid),
+            ack_payload.eq(Mux(index == 0, stream_in.payload, ack_word)),
+
+            write_port.addr.eq(Cat(index[:index_bits], slot)),
+            write_port.data.eq(stream_in.payload),
+            write_port.en.eq(stream_in.valid & keep & (index < self.max_frame_words)),
+        ]
+
+        with m.If(stream_in.valid):
+            sync += [
+                in_frame.eq(1),
+                frame_ack.eq(ack_frame),
+                frame_seq.eq(seq),
+                frame_more.eq(seq_more),
+                frame_keep.eq(keep),
+                index.eq(index + 1),
+            ]
+            with m.If(index == 0):
+                sync += ack_word.eq(stream_in.payload)
+
+        with m.If(stream_in.last):
+            sync += [
+                in_frame.eq(0),
+                index.eq(0),
+            ]
+
+            with m.If(ack_frame):
+                with m.If(~stream_in.crc_error):
+                    comb += [
+                        self.ack_valid_out.eq(1),
+                        self.ack_out.eq(ack_payload[:16]),
+                        self.nak_out.eq(ack_payload[16:]),
+                    ]
+
+            with m.Elif(stream_in.crc_error):
+                sync += self.crc_errors_out.eq(self.crc_errors_out + 1)
+                with m.If(keep & (offset == 0)):
+                    comb += nak_set.eq(1 << seq)
+
+            with m.Elif(keep & (frame_words != 0) & (frame_words <= self.max_frame_words)):
+                comb += [
+                    stored.eq(1 << slot),
+                    ack_set.eq(1 << seq),
+                ]
+                sync += [
+                    lengths[slot].eq(frame_words),
+                    more[slot].eq(seq_more),
+                ]
+
+            with m.Elif(behind | (ahead & occupied.bit_select(slot, 1))):
+                # we have this one already, the acknowledgement must have been lost
+                comb += ack_set.eq(1 << seq)
+                sync += self.duplicates_out.eq(self.duplicates_out + 1)
+
+        #
+        # send acknowledgements
+        #
+        pending = Signal(range(self.ack_batch + 1))
+        idle    = Signal(range(self.ack_timeout + 1))
+
+        comb += [
+            self.ack_word_out.eq(Cat(ack_bits, nak_bits)),
+            self.send_ack_out.eq((nak_bits != 0) | (pending == self.ack_batch) |
+                                 ((ack_bits != 0) & (idle == self.ack_timeout))),
+        ]
+
+        with m.If(self.ack_sent_in):
+            sync += [
+                ack_bits.eq(ack_set),
+                nak_bits.eq(nak_set),
+                pending.eq(ack_set != 0),
+            ]
+        with m.Else():
+            sync += [
+                ack_bits.eq(ack_bits | ack_set),
+                nak_bits.eq(nak_bits | nak_set),
+            ]
+            with m.If((ack_set != 0) & (pending != self.ack_batch)):
+                sync += pending.eq(pending + 1)
+
+        with m.If(stream_in.valid | in_frame):
+            sync += idle.eq(0)
+        with m.Elif(idle != self.ack_timeout):
+            sync += idle.eq(idle + 1)
+
+        #
+        # hand out the frames in order
+        #
+        read_slot  = Signal(slot_bits)
+        read_index = Signal(range(self.max_frame_words + 1))
+        load       = Signal()
+        beat_valid = Signal()
+        beat_first = Signal()
+        beat_last  = Signal()
+        # the frame which is handed out continues the packet of the one before
+        continued  = Signal()
+        stream_out = self.stream_out
+
+        comb += [
+            read_slot.eq(expected),
+            load.eq(occupied.bit_select(read_slot, 1) & (read_index < lengths[read_slot]) &
+                    (~beat_valid | stream_out.ready)),
+            read_port.addr.eq(Cat(read_index[:index_bits], read_slot)),
+            read_port.en.eq(load),
+
+            stream_out.payload.eq(read_port.data),
+            stream_out.valid.eq(beat_valid),
+            stream_out.first.eq(beat_first),
+            stream_out.last.eq(beat_last),
+        ]
+
+        with m.If(load):
+            sync += [
+                read_index.eq(read_index + 1),
+                beat_valid.eq(1),
+                beat_first.eq((read_index == 0) & ~continued),
+                beat_last.eq((read_index + 1 == lengths[read_slot]) & ~more[read_slot]),
+            ]
+            with m.If(read_index + 1 == lengths[read_slot]):
+                comb += released.eq(1 << read_slot)
+                sync += [
+                    read_index.eq(0),
+                    expected.eq(expected + 1),
+                    continued.eq(more[read_slot]),
+                ]
+        with m.Elif(stream_out.ready):
+            sync += beat_valid.eq(0)
+
+        sync += occupied.eq((occupied | stored) & ~released)
+
+        return m
+
+class HSPIARQ(Elaboratable):
+    """ Reliable delivery over HSPI, with a sliding window of outstanding frames
+
+        Packets from stream_in are sent in frames of up to max_frame_words words with
+        consecutive sequence numbers, and kept until the other side acknowledges them.
+        The upper bit of tll_2b in the header marks the frames which are followed by
+        another one of the same packet, only the lower bit of tll_2b_in is sent.
+        The frame which is expected next is acknowledged negatively when it arrives with
+        a CRC error, and then sent again by the other side, as are the frames whose
+        acknowledgement does not come within timeout cycles.
+        Other frames with a CRC error are not, since their sequence number
+        could be wrong, and are left to the timeout. Received packets come out on stream_out in order.
+        The acknowledgements are batched into frames with the user id ACK_USER_ID,
+        the other side has to speak the same protocol.
+
+        A window of at most 8 frames is possible with the 4 bit sequence numbers of HSPI.
+    """
+    def __init__(self, domain=None, window=4, max_frame_words=4096, ack_batch=None, ack_timeout=64,
+                 timeout=None, crc_latency=0, streaming=True):
+        self.hspi        = HSPIInterface()
+        self.stream_in   = StreamInterface(name="arq_in", payload_width=32)
+        self.stream_out  = StreamInterface(name="arq_out", payload_width=32)
+        self.tll_2b_in   = Signal(2)
+        self.user_id0_in = Signal(26)
+        self.user_id1_in = Signal(26)
+
+        if ack_batch is None:
+            ack_batch = max(1, window // 2)
+        if timeout is None:
+            # a whole window has to be able to get across, and its acknowledgement back
+            timeout = (window + 1) * (max_frame_words + 16) + 2 * ack_timeout
+
+        self.tx          = HSPITransmitter(domain=domain, crc_latency=crc_latency, streaming=streaming,
+                                           max_frame_words=max_frame_words)
+        self.rx          = HSPIReceiver(domain=domain, crc_latency=crc_latency)
+        self.retransmit  = HSPIRetransmitter(window=window, max_frame_words=max_frame_words, timeout=timeout)
+        self.receive     = HSPIReceiveWindow(window=window, max_frame_words=max_frame_words,
+                                             ack_batch=ack_batch, ack_timeout=ack_timeout)
+
+        self.resent_out     = self.retransmit.resent_out
+        self.timeouts_out   = self.retransmit.timeouts_out
+        self.crc_errors_out = self.receive.crc_errors_out
+        self.duplicates_out = self.receive.duplicates_out
+
+        self.domain = domain
+
+    def connect_to_pads(self, hspi_pads):
+        hspi = self.hspi
+
+        return [
+            # HSPI inputs
+            hspi.tx_ready .eq(hspi_pads.tx_ready),
+            hspi.rx_act   .eq(hspi_pads.rx_act),
+            hspi.rx_valid .eq(hspi_pads.rx_valid),
+            hspi.hd.i     .eq(hspi_pads.hd.i),
+
+            # HSPI outputs
+            hspi_pads.tx_req   .eq(hspi.tx_req),
+            hspi_pads.tx_valid .eq(hspi.tx_valid),
+            hspi_pads.tx_ack   .eq(hspi.tx_ack),
+            hspi_pads.hd.oe    .eq(hspi.hd.oe),
+            hspi_pads.hd.o     .eq(hspi.hd.o),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        domain = "sync" if self.domain is None else self.domain
+        comb   = m.d.comb
+
+        m.submodules.hspi_rx    = rx         = self.rx
+        m.submodules.hspi_tx    = tx         = self.tx
+        m.submodules.retransmit = DomainRenamer(domain)(self.retransmit)
+        m.submodules.receive    = DomainRenamer(domain)(self.receive)
+
+        retransmit = self.retransmit
+        receive    = self.receive
+
+        comb += [
+            *rx.connect_to_pads(self.hspi),
+            *tx.connect_to_pads(self.hspi),
+
+            # sending side
+            *retransmit.stream_in.stream_eq(self.stream_in),
+            *tx.stream_in.stream_eq(retransmit.frame_out),
+            tx.sequence_nr_in.eq(retransmit.sequence_nr_out),
+            tx.tll_2b_in.eq(Cat(self.tll_2b_in[0], retransmit.more_out)),
+            tx.user_id0_in.eq(Mux(retransmit.control_out, ACK_USER_ID, self.user_id0_in)),
+            tx.user_id1_in.eq(Mux(retransmit.control_out, ACK_USER_ID, self.user_id1_in)),
+
+            # receiving side
+            receive.stream_in.payload   .eq(rx.stream_out.payload),
+            receive.stream_in.valid     .eq(rx.stream_out.valid),
+            receive.stream_in.first     .eq(rx.stream_out.first),
+            receive.stream_in.last      .eq(rx.stream_out.last),
+            receive.stream_in.crc_error .eq(rx.stream_out.crc_error),
+            receive.user_id_in.eq(rx.user_data_out),
+            receive.sequence_nr_in.eq(rx.sequence_nr_out),
+            receive.more_in.eq(rx.tll_2b_out[1]),
+            *self.stream_out.stream_eq(receive.stream_out),
+
+            # acknowledgements
+            retransmit.ack_valid_in.eq(receive.ack_valid_out),
+            retransmit.ack_in.eq(receive.ack_out),
+            retransmit.nak_in.eq(receive.nak_out),
+            retransmit.send_ack_in.eq(receive.send_ack_out),
+            retransmit.ack_word_in.eq(receive.ack_word_out),
+            receive.ack_sent_in.eq(retransmit.ack_sent_out),
+        ]
+
+        return m
+
+from amaranth.sim import Passive
+from amlib.test   import GatewareTestCase, sync_test_case
+
+class _ARQLink(Elaboratable):
+    """ two HSPIARQ cores with their buses connected to each other,
+        where the bits in corrupt_ab or corrupt_ba are flipped on the way from a to b or from b to a
+    """
+    def __init__(self, **kwargs):
+        self.a = HSPIARQ(**kwargs)
+        self.b = HSPIARQ(**kwargs)
+        self.corrupt_ab = Signal(32)
+        self.corrupt_ba = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.a = a = self.a
+        m.submodules.b = b = self.b
+
+        for tx, rx, corrupt in [(a.hspi, b.hspi, self.corrupt_ab), (b.hspi, a.hspi, self.corrupt_ba)]:
+            m.d.comb += [
+                rx.rx_act   .eq(tx.tx_req),
+                rx.rx_valid .eq(tx.tx_valid),
+                rx.hd.i     .eq(tx.hd.o ^ Mux(tx.tx_valid, corrupt, 0)),
+                tx.tx_ready .eq(rx.tx_ack),
+            ]
+
+        return m
+
+class HSPIARQTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = _ARQLink
+    FRAGMENT_ARGUMENTS  = dict(window=4, max_frame_words=16, timeout=400)
+    PACKETS             = 24
+    MAX_PACKET_WORDS    = 16
+    CYCLES              = 6000
+
+    def setUp(self):
+        super().setUp()
+        self.rng      = random.Random(0)
+        self.packets  = [[n << 8 | i for i in range(1 + self.rng.randrange(self.MAX_PACKET_WORDS))]
+                         for n in range(self.PACKETS)]
+        self.received = []
+        self.sim.add_sync_process(self.send_packets)
+        self.sim.add_sync_process(self.receive_packets)
+
+    def send_packets(self):
+        yield Passive()
+        stream = self.dut.a.stream_in
+        for packet in self.packets:
+            for i, word in enumerate(packet):
+                yield stream.valid.eq(1)
+                yield stream.first.eq(i == 0)
+                yield stream.last.eq(i == len(packet) - 1)
+                yield stream.payload.eq(word)
+                yield
+                while not (yield stream.ready):
+                    yield
+        yield stream.valid.eq(0)
+
+    def receive_packets(self):
+        yield Passive()
+        stream = self.dut.b.stream_out
+        while True:
+            ready = self.rng.random() < 0.8
+            yield stream.ready.eq(ready)
+            yield
+            if ready and (yield stream.valid):
+                if (yield stream.first):
+                    self.received.append([])
+                self.received[-1].append((yield stream.payload))
+
+    def corrupt(self, cycle):
+        """ the bits to flip in this cycle, on the way there and on the way back """
+        # break some data frames on the way there, and some acknowledgements on the way back
+        return int(cycle % 500 == 60 or cycle % 700 == 90), int(cycle % 900 == 300)
+
+    @sync_test_case
+    def test_arq(self):
+        dut = self.dut
+        for cycle in range(self.CYCLES):
+            corrupt_ab, corrupt_ba = self.corrupt(cycle)
+            yield dut.corrupt_ab.eq(corrupt_ab)
+            yield dut.corrupt_ba.eq(corrupt_ba)
+            yield
+            if self.received == self.packets and not (yield dut.b.stream_out.valid):
+                break
+
+        self.assertEqual(self.received, self.packets)
+        self.assertGreater((yield dut.b.crc_errors_out), 0)
+        self.assertGreater((yield dut.a.resent_out), 0)
+
+class HSPIARQHeaderTest(HSPIARQTest):
+    """ frames whose sequence number is broken, which must not be acknowledged negatively """
+    def corrupt(self, cycle):
+        # the lowest bit of the sequence number, for long enough to catch a header
+        return (1 << 26) * (cycle % 600 in range(60, 100)), 0
+
+class HSPIARQLongPacketTest(HSPIARQTest):
+    """ packets of several frames, which have to come out in one piece """
+    PACKETS          = 10
+    MAX_PACKET_WORDS = 56
+    CYCLES           = 12000
+
+    def setUp(self):
+        super().setUp()
+        self.packets[0] = list(range(40))
+        # exactly two frames
+        self.packets[1] = list(range(32))
@@ -0,0 +1,250 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+import random
+from collections import namedtuple
+
+from amaranth.sim import Simulator, Passive
+
+from .hspi     import HSPITransmitter, HSPIReceiver
+from .loopback import HSPILoopback
+from .bfm      import HSPIBusFunctionalModel
+from .cxxrtl   import signals
+
+# payload words per frame
+LENGTHS = [1, 2, 4, 16, 64, 256, 1024, 4096]
+
+# probability of a gap before each word, from the producer on stream_in
+# for the transmitter and from the CH569 on the bus for the receiver
+GAPS = dict(none=0.0, light=0.05, heavy=0.3)
+
+# how quickly the CH569 answers tx_req with tx_ready, drops it again,
+# and starts the next frame of its own
+HANDSHAKES = dict(
+    fast    = dict(ready_delay=0,       release_delay=0,      frame_gap=0),
+    typical = dict(ready_delay=(1, 4),  release_delay=(0, 2), frame_gap=(0, 4)),
+    slow    = dict(ready_delay=(8, 16), release_delay=(4, 8), frame_gap=(8, 16)),
+)
+
+# when the transmitter is asked to send an ACK frame with send_ack: never, after every frame
+# once its last word has gone in, or halfway through every frame, which goes out after it
+ACKS = ["none", "between", "during"]
+
+# the transmitter passes the words through as they come, unless it has a frame buffer,
+# in which case it only starts a frame when the whole frame is in the buffer
+DESIGNS = ["transmitter", "streaming-transmitter", "buffered-transmitter", "receiver", "loopback"]
+TRANSMITTERS = DESIGNS[:3]
+
+# metrics and whether bigger is better
+METRICS = dict(words_per_cycle=True, overhead_per_frame=False, latency_mean=False, latency_max=False)
+
+BenchmarkPoint = namedtuple("BenchmarkPoint", ["design", "frame_words", "gap", "handshake", "ack"])
+
+def points(designs=DESIGNS, lengths=LENGTHS, gaps=GAPS, handshakes=HANDSHAKES, acks=ACKS):
+    """ all combinations, where only the transmitters send ACK frames """
+    return [BenchmarkPoint(design, frame_words, gap, handshake, ack)
+            for design in designs for frame_words in lengths for gap in gaps for handshake in handshakes
+            for ack in acks if design in TRANSMITTERS or ack == "none"]
+
+def python_simulator(dut, ports):
+    return Simulator(dut)
+
+def _transmitter(point, frames, rng, **arguments):
+    dut = HSPITransmitter(**arguments)
+    bfm = HSPIBusFunctionalModel(dut.hspi_out, rng=rng, **HANDSHAKES[point.handshake])
+    stream_in = dut.stream_in
+    offered   = []
+    # the number of ACK frames asked for so far
+    acks      = [0]
+
+    def stimulus():
+        for _ in range(frames):
+            payload = [rng.getrandbits(32) for _ in range(point.frame_words)]
+            bfm.expect(payload)
+            for i, word in enumerate(payload):
+                while rng.random() < GAPS[point.gap]:
+                    yield stream_in.valid.eq(0)
+                    yield
+                if i == 0:
+                    offered.append(bfm.cycle)
+                if point.ack == "during" and i == len(payload) // 2:
+                    acks[0] += 1
+                yield stream_in.payload.eq(word)
+                yield stream_in.valid.eq(1)
+                yield stream_in.first.eq(i == 0)
+                yield stream_in.last.eq(i == len(payload) - 1)
+                yield
+                while not (yield stream_in.ready):
+                    yield
+            yield stream_in.valid.eq(0)
+            if point.ack == "between":
+                acks[0] += 1
+        while not bfm.idle or len(bfm.acks) < acks[0]:
+            yield
+
+    def send_acks():
+        # send_ack stays up until the transmitter has sent the ACK frame
+        yield Passive()
+        sent = 0
+        while True:
+            yield
+            if sent < acks[0]:
+                yield dut.send_ack.eq(1)
+            if (yield dut.ack_done):
+                yield dut.send_ack.eq(0)
+                sent += 1
+
+    def result():
+        received = bfm.received
+        if len(bfm.acks) != acks[0]:
+            raise AssertionError(f"{len(bfm.acks)} ACK frames were sent instead of {acks[0]}")
+        return offered[0], received[-1].end, [frame.end - start for frame, start in zip(received, offered)]
+
+    ports = [*signals(dut.hspi_out), *signals(stream_in), dut.send_ack, dut.ack_done]
+    return dut, ports, bfm, [stimulus, send_acks], result
+
+def _receiver(point, frames, rng):
+    dut = HSPIReceiver()
+    bfm = HSPIBusFunctionalModel(dut.hspi_in, rng=rng, valid_gap=GAPS[point.gap], **HANDSHAKES[point.handshake])
+    stream_out = dut.stream_out
+    done       = []
+
+    for _ in range(frames):
+        bfm.send([rng.getrandbits(32) for _ in range(point.frame_words)])
+
+    def stimulus():
+        while len(done) < frames:
+            yield
+
+    def checker():
+        yield Passive()
+        while True:
+            yield
+            if (yield stream_out.last):
+                if (yield stream_out.crc_error):
+                    raise AssertionError(f"frame {len(done)} has a CRC error")
+                done.append(bfm.cycle)
+
+    def result():
+        return bfm.sent[0][1], done[-1], [end - start for (_, start, _), end in zip(bfm.sent, done)]
+
+    ports = [*signals(dut.hspi_in), *signals(stream_out)]
+    return dut, ports, bfm, [stimulus, checker], result
+
+def _loopback(point, frames, rng):
+    dut = HSPILoopback(depth=4096, streaming=True)
+    bfm = HSPIBusFunctionalModel(dut.hspi, rng=rng, valid_gap=GAPS[point.gap], **HANDSHAKES[point.handshake])
+
+    # the loopback can only hold one frame of the maximum size,
+    # so the next frame is only sent when the last one has come back
+    def stimulus():
+        for _ in range(frames):
+            payload = [rng.getrandbits(32) for _ in range(point.frame_words)]
+            bfm.send(payload)
+            bfm.expect(payload)
+            while not bfm.idle:
+                yield
+
+    def result():
+        return bfm.sent[0][1], bfm.received[-1].end, \
+            [frame.end - start for frame, (_, start, _) in zip(bfm.received, bfm.sent)]
+
+    return dut, signals(dut.hspi), bfm, [stimulus], result
+
+def run_point(point, *, frames, simulator=python_simulator, seed=0):
+    """ runs frames frames of point through its design and returns the point and the metrics as a dict
+
+        words_per_cycle counts the payload words from the first word going in to the end of
+        the last frame coming out, overhead_per_frame is the number of cycles of that time
+        which did not carry a payload word, per frame, including the ACK frames of point.ack.
+        The latency is the time from the first word of a frame going in to its end coming out.
+    """
+    rng = random.Random(seed)
+    if point.design == "transmitter":
+        dut, ports, bfm, processes, result = _transmitter(point, frames, rng)
+    elif point.design == "streaming-transmitter":
+        dut, ports, bfm, processes, result = _transmitter(point, frames, rng, streaming=True)
+    elif point.design == "buffered-transmitter":
+        dut, ports, bfm, processes, result = _transmitter(point, frames, rng, frame_buffer=True)
+    elif point.design == "receiver":
+        dut, ports, bfm, processes, result = _receiver(point, frames, rng)
+    elif point.design == "loopback":
+        dut, ports, bfm, processes, result = _loopback(point, frames, rng)
+    else:
+        raise ValueError(f"unknown design {point.design}, it has to be one of {', '.join(DESIGNS)}")
+
+    sim = simulator(dut, ports)
+    sim.add_clock(1e-8, domain="sync")
+
+    def run_bfm():
+        yield Passive()
+        yield from bfm.process()
+
+    sim.add_sync_process(run_bfm, domain="sync")
+    for process in processes:
+        sim.add_sync_process(process, domain="sync")
+    sim.run()
+
+    start, end, latencies = result()
+    cycles = end - start + 1
+    words  = frames * point.frame_words
+    return dict(point._asdict(),
+        frames             = frames,
+        cycles             = cycles,
+        words_per_cycle    = words / cycles,
+        overhead_per_frame = (cycles - words) / frames,
+        latency_mean       = sum(latencies) / len(latencies),
+        latency_max        = max(latencies),
+    )
+
+def _key(result):
+    # results from before there were ACK frames did not have any
+    return BenchmarkPoint(*(result.get(field, "none") for field in BenchmarkPoint._fields))
+
+def compare(results, baseline, tolerance=0.02):
+    """ the metrics of results which are worse than in baseline by more than tolerance, relative,
+        as a list of (point, metric, baseline value, value)
+    """
+    old         = {_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = old.get(_key(result))
+        if reference is None:
+            continue
+        for metric, bigger_is_better in METRICS.items():
+            change = result[metric] - reference[metric]
+            if not bigger_is_better:
+                change = -change
+            if change < -tolerance * abs(reference[metric]):
+                regressions.append((_key(result), metric, reference[metric], result[metric]))
+    return regressions
+
+import unittest
+
+class BenchmarkTest(unittest.TestCase):
+    def test_designs(self):
+        for design in DESIGNS:
+            result = run_point(BenchmarkPoint(design, 16, "light", "typical", "none"), frames=3)
+            self.assertEqual(result["frames"], 3)
+            self.assertGreater(result["words_per_cycle"], 0.1)
+            self.assertLessEqual(result["words_per_cycle"], 1.0)
+            self.assertGreater(result["latency_max"], 16)
+
+    def test_compare(self):
+        point    = BenchmarkPoint("receiver", 16, "none", "fast", "none")
+        baseline = [dict(point._asdict(), words_per_cycle=0.8, overhead_per_frame=4.0, latency_mean=20, latency_max=22)]
+        results  = [dict(baseline[0], words_per_cycle=0.79, latency_max=30)]
+        self.assertEqual(compare(results, baseline), [(point, "latency_max", 22, 30)])
+        self.assertEqual(compare(baseline, baseline), [])
+
+    def test_acks(self):
+        for ack in ACKS[1:]:
+            plain  = run_point(BenchmarkPoint("transmitter", 16, "none", "fast", "none"), frames=4)
+            result = run_point(BenchmarkPoint("transmitter", 16, "none", "fast", ack), frames=4)
+            # every ACK frame takes the bus for a few cycles
+            self.assertGreater(result["overhead_per_frame"], plain["overhead_per_frame"])
+
+    def test_points(self):
+        selected = points(["transmitter", "receiver"], [16], ["none"], ["fast"])
+        self.assertEqual([(point.design, point.ack) for point in selected],
+                         [("transmitter", ack) for ack in ACKS] + [("receiver", "none")])
@@ -0,0 +1,313 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+import random
+import struct
+import zlib
+from collections import deque, namedtuple
+
+# the word the transmitter sends in an ACK frame, which has no header and no CRC
+ACK_WORD = 0xf0
+
+HSPIFrame = namedtuple("HSPIFrame", ["tll_2b", "sequence_nr", "user_data", "payload", "crc_ok", "start", "end"])
+
+def frame_words(payload, *, tll_2b=0, sequence_nr=0, user_data=0):
+    """ the words of a frame on the bus: header, payload and CRC """
+    header = (tll_2b << 30) | (sequence_nr << 26) | user_data
+    words  = [header] + list(payload)
+    return words + [zlib.crc32(struct.pack(f"<{len(words)}I", *words))]
+
+class HSPIBusFunctionalModel:
+    """ Model of the CH569 side of the HSPI bus for simulation
+
+        hspi is the bus of the cores, seen from the FPGA: a HSPIInterface like
+        the one of HSPILoopback, or the hspi_out of a HSPITransmitter or the hspi_in of a HSPIReceiver.
+        process() has to be added as a sync process of the domain the bus runs in.
+        The model only drives tx_ready, rx_act, rx_valid and hd.i. With a bus narrower
+        than 32 bits, every word takes 32 // width bus cycles, lowest bits first.
+
+        As master, it sends the frames queued with send() to the receiver: it raises rx_act,
+        waits for tx_ack, sends the words with rx_valid, leaving a gap before each bus cycle
+        with the probability valid_gap, drops rx_act and waits for tx_ack to drop.
+        Between frames it waits frame_gap cycles.
+
+        As slave, it takes the frames of the transmitter: tx_ready comes up ready_delay cycles
+        after tx_req, and goes down release_delay cycles after tx_req has dropped.
+        Every frame goes into received, and ACK frames into acks. A frame with a wrong CRC,
+        or a frame which does not match the next one queued with expect(), fails the simulation.
+
+        The bus is half duplex, so a frame of the transmitter is only taken between
+        two frames of the master. The delays are a number of cycles, or a (min, max) range
+        to draw them from at random.
+    """
+    def __init__(self, hspi, *, rng=None, valid_gap=0.0, frame_gap=1, ack_timeout=64,
+                 ready_delay=1, release_delay=0, check_crc=True):
+        self.hspi          = hspi
+        self.rng           = random.Random(0) if rng is None else rng
+        self.width         = len(hspi.hd.i)
+        self.valid_gap     = valid_gap
+        self.frame_gap     = frame_gap
+        self.ack_timeout   = ack_timeout
+        self.ready_delay   = ready_delay
+        self.release_delay = release_delay
+        self.check_crc     = check_crc
+
+        self.cycle     = 0
+        self.sent      = []
+        self.received  = []
+        self.acks      = []
+        self._to_send  = deque()
+        self._expected = deque()
+
+    def send(self, payload, *, tll_2b=0, sequence_nr=0, user_data=0, corrupt_crc=False):
+        """ queues a frame for the receiver, with a wrong CRC if corrupt_crc is set """
+        words = frame_words(payload, tll_2b=tll_2b, sequence_nr=sequence_nr, user_data=user_data)
+        if corrupt_crc:
+            words[-1] ^= 1
+        self._to_send.append(words)
+
+    def expect(self, payload, **header):
+        """ the next frame from the transmitter has to have this payload, and the header fields given """
+        self._expected.append((list(payload), header))
+
+    @property
+    def queued(self):
+        """ the number of frames queued with send() which have not been sent yet """
+        return len(self._to_send)
+
+    @property
+    def idle(self):
+        """ whether all queued frames have been sent and all expected ones received """
+        return not self._to_send and not self._expected
+
+    def words_per_cycle(self, frames=None):
+        """ payload words per cycle from the start of the first to the end of the last of frames,
+            by default of all received ones
+        """
+        frames = self.received if frames is None else frames
+        if not frames:
+            return 0.0
+        cycles = frames[-1].end - frames[0].start + 1
+        return sum(len(frame.payload) for frame in frames) / cycles
+
+    def _draw(self, delay):
+        return self.rng.randint(*delay) if isinstance(delay, tuple) else delay
+
+    def _tick(self, cycles=1):
+        for _ in range(cycles):
+            yield
+            self.cycle += 1
+
+    def _lanes(self, word):
+        lanes = 32 // self.width
+        mask  = (1 << self.width) - 1
+        return [(word >> (self.width * lane)) & mask for lane in range(lanes)]
+
+    def _master(self, words):
+        hspi  = self.hspi
+        start = self.cycle
+
+        yield hspi.rx_act.eq(1)
+        yield from self._tick()
+        while not (yield hspi.tx_ack):
+            if self.cycle - start > self.ack_timeout:
+                raise AssertionError(f"no tx_ack within {self.ack_timeout} cycles of rx_act")
+            yield from self._tick()
+
+        for word in words:
+            for lane in self._lanes(word):
+                while self.rng.random() < self.valid_gap:
+                    yield hspi.rx_valid.eq(0)
+                    yield from self._tick()
+                yield hspi.hd.i.eq(lane)
+                yield hspi.rx_valid.eq(1)
+                yield from self._tick()
+
+        yield hspi.rx_valid.eq(0)
+        yield hspi.rx_act.eq(0)
+        yield from self._tick()
+        while (yield hspi.tx_ack):
+            yield from self._tick()
+
+        self.sent.append((words, start, self.cycle))
+
+    def _slave(self):
+        hspi  = self.hspi
+        lanes = 32 // self.width
+        start = self.cycle
+        data  = []
+
+        yield from self._tick(self._draw(self.ready_delay))
+        yield hspi.tx_ready.eq(1)
+        while True:
+            yield from self._tick()
+            if (yield hspi.tx_valid):
+                data.append((yield hspi.hd.o))
+            if not (yield hspi.tx_req):
+                break
+        end = self.cycle
+
+        yield from self._tick(self._draw(self.release_delay))
+        yield hspi.tx_ready.eq(0)
+        yield from self._tick()
+
+        if len(data) % lanes:
+            raise AssertionError(f"frame of {len(data)} bus cycles is not a whole number of words")
+        words = [sum(lane << (self.width * n) for n, lane in enumerate(data[i:i + lanes]))
+                 for i in range(0, len(data), lanes)]
+        self._check(words, start, end)
+
+    def _check(self, words, start, end):
+        if words == [ACK_WORD]:
+            self.acks.append(end)
+            return
+        if len(words) < 2:
+            raise AssertionError(f"frame of {len(words)} words is too short")
+
+        header, payload, crc = words[0], words[1:-1], words[-1]
+        crc_ok = zlib.crc32(struct.pack(f"<{len(words) - 1}I", *words[:-1])) == crc
+        frame  = HSPIFrame(tll_2b=header >> 30, sequence_nr=(header >> 26) & 0xf, user_data=header & 0x3ffffff,
+                           payload=payload, crc_ok=crc_ok, start=start, end=end)
+        self.received.append(frame)
+
+        if self.check_crc and not crc_ok:
+            raise AssertionError(f"frame {len(self.received) - 1} has a wrong CRC: {crc:#010x}")
+        if self._expected:
+            expected, fields = self._expected.popleft()
+            if payload != expected:
+                raise AssertionError(f"frame {len(self.received) - 1} has the payload {payload}, not {expected}")
+            for name, value in fields.items():
+                if getattr(frame, name) != value:
+                    raise AssertionError(f"frame {len(self.received) - 1} has the {name} "
+                                         f"{getattr(frame, name)}, not {value}")
+
+    def process(self):
+        hspi = self.hspi
+        gap  = 0
+
+        while True:
+            if (yield hspi.tx_req):
+                yield from self._slave()
+            elif self._to_send and gap <= 0:
+                yield from self._master(self._to_send.popleft())
+                gap = self._draw(self.frame_gap)
+            else:
+                yield from self._tick()
+                gap -= 1
+
+from amaranth.sim import Passive
+from amlib.test   import GatewareTestCase, sync_test_case
+
+from .hspi     import HSPITransmitter, HSPIReceiver
+from .loopback import HSPILoopback
+
+class HSPIBusFunctionalModelTransmitterTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPITransmitter
+    FRAGMENT_ARGUMENTS  = dict(crc_latency=1)
+    PAYLOADS            = [list(range(n, 2 * n)) for n in [1, 2, 7, 0x40]]
+
+    def setUp(self):
+        super().setUp()
+        self.bfm = HSPIBusFunctionalModel(self.dut.hspi_out, rng=random.Random(1),
+                                          ready_delay=(0, 6), release_delay=(0, 4))
+        self.sim.add_sync_process(self.run_bfm)
+
+    def run_bfm(self):
+        yield Passive()
+        yield from self.bfm.process()
+
+    def test_frame_words(self):
+        # the frame of HSPIReceiverTest
+        words = frame_words(range(0x80), tll_2b=0b11, user_data=0x3abcdef)
+        self.assertEqual(words[0], 0xc3abcdef)
+        self.assertEqual(words[-1], 0x1106c501)
+
+    @sync_test_case
+    def test_transmit(self):
+        dut       = self.dut
+        stream_in = dut.stream_in
+        rng       = random.Random(2)
+
+        yield dut.tll_2b_in.eq(0b01)
+        yield dut.user_id0_in.eq(0x1234567)
+        yield dut.user_id1_in.eq(0x3456789)
+        for n, payload in enumerate(self.PAYLOADS):
+            self.bfm.expect(payload, tll_2b=0b01, sequence_nr=n, user_data=0x3456789 if n & 1 else 0x1234567)
+            yield dut.sequence_nr_in.eq(n)
+            for i, word in enumerate(payload):
+                while rng.random() < 0.2:
+                    yield stream_in.valid.eq(0)
+                    yield
+                yield stream_in.payload.eq(word)
+                yield stream_in.valid.eq(1)
+                yield stream_in.first.eq(i == 0)
+                yield stream_in.last.eq(i == len(payload) - 1)
+                yield
+                while not (yield stream_in.ready):
+                    yield
+            yield stream_in.valid.eq(0)
+
+        while not self.bfm.idle:
+            yield
+        self.assertEqual([frame.payload for frame in self.bfm.received], self.PAYLOADS)
+
+class HSPIBusFunctionalModelReceiverTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPIReceiver
+    FRAGMENT_ARGUMENTS  = dict()
+    PAYLOADS            = [list(range(n, 2 * n)) for n in [1, 3, 0x20, 0x41]]
+
+    def setUp(self):
+        super().setUp()
+        self.bfm = HSPIBusFunctionalModel(self.dut.hspi_in, rng=random.Random(3), valid_gap=0.25, frame_gap=(0, 8))
+        self.sim.add_sync_process(self.run_bfm)
+
+    def run_bfm(self):
+        yield Passive()
+        yield from self.bfm.process()
+
+    @sync_test_case
+    def test_receive(self):
+        dut    = self.dut
+        frames = []
+        frame  = []
+
+        for n, payload in enumerate(self.PAYLOADS):
+            self.bfm.send(payload, sequence_nr=n, corrupt_crc=(n == 2))
+
+        while len(frames) < len(self.PAYLOADS):
+            yield
+            if (yield dut.stream_out.valid):
+                frame.append((yield dut.stream_out.payload))
+            if (yield dut.stream_out.last):
+                frames.append((frame, (yield dut.stream_out.crc_error), (yield dut.sequence_nr_out)))
+                frame = []
+
+        self.assertEqual(frames, [(payload, int(n == 2), n) for n, payload in enumerate(self.PAYLOADS)])
+
+class HSPIBusFunctionalModelLoopbackTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPILoopback
+    FRAGMENT_ARGUMENTS  = dict(depth=256, streaming=True)
+    PAYLOADS            = [list(range(n, 2 * n)) for n in [1, 5, 0x30, 0x10, 0x40]]
+
+    def setUp(self):
+        super().setUp()
+        self.bfm = HSPIBusFunctionalModel(self.dut.hspi, rng=random.Random(4), valid_gap=0.1,
+                                          frame_gap=(2, 10), ready_delay=(0, 3), release_delay=(0, 2))
+        self.sim.add_sync_process(self.run_bfm)
+
+    def run_bfm(self):
+        yield Passive()
+        yield from self.bfm.process()
+
+    @sync_test_case
+    def test_loopback(self):
+        yield self.dut.tx.user_id0_in.eq(0x2222222)
+        for payload in self.PAYLOADS:
+            self.bfm.send(payload, user_data=0x1111111)
+            self.bfm.expect(payload)
+
+        while not self.bfm.idle:
+            yield
+
+        self.assertEqual([frame.payload for frame in self.bfm.received], self.PAYLOADS)
+        self.assertGreater(self.bfm.words_per_cycle(), 0.1)
@@ -0,0 +1,403 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+import random
+
+from amaranth import *
+from amaranth.lib.fifo import SyncFIFO
+
+from amlib.stream import StreamInterface
+
+class HSPIPacketBuffer(Elaboratable):
+    """ Store and forward buffer for received HSPI frames
+
+        Takes the stream of a HSPIReceiver, which can not be stalled, and writes it into a
+        block RAM of depth beats. A frame is only handed to stream_out when its last beat
+        came without crc_error. Frames with a CRC error, frames which did not fit into
+        the memory and frames arriving while max_frames frames are waiting are dropped
+        and counted. last may come with or after the last valid beat of a frame,
+        good frames without any valid beats are ignored.
+
+        stream_out honors ready, and always has crc_error low.
+    """
+    def __init__(self, *, depth, max_frames=16, payload_width=32, valid_width=1):
+        if depth & (depth - 1):
+            raise ValueError(f"the depth of the packet buffer must be a power of two, not {depth}")
+
+        self.stream_in  = StreamInterface(name="buffer_in",  payload_width=payload_width, valid_width=valid_width,
+                                          extra_fields=[("crc_error", 1)])
+        self.stream_out = StreamInterface(name="buffer_out", payload_width=payload_width, valid_width=valid_width,
+                                          extra_fields=[("crc_error", 1)])
+
+        self.frames_out           = Signal(16)
+        self.dropped_crc_out      = Signal(16)
+        self.dropped_overflow_out = Signal(16)
+
+        self.depth      = depth
+        self.max_frames = max_frames
+
+    def elaborate(self, platform):
+        m = Module()
+        stream_in   = self.stream_in
+        stream_out  = self.stream_out
+        valid_width = len(stream_in.valid)
+
+        # the valid mask of a beat only has to be stored if there is more than one word per beat
+        width = len(stream_in.payload) + (valid_width if valid_width > 1 else 0)
+
+        memory = Memory(width=width, depth=self.depth)
+        m.submodules.write_port = write_port = memory.write_port()
+        m.submodules.read_port  = read_port  = memory.read_port(transparent=False)
+
+        # lengths of the frames which passed the CRC check, in beats
+        m.submodules.lengths = lengths = SyncFIFO(width=self.depth.bit_length(), depth=self.max_frames)
+
+        # the pointers have one bit more than the address,
+        # so that a full buffer can be told from an empty one
+        write_ptr   = Signal(range(2 * self.depth))
+        frame_start = Signal.like(write_ptr)
+        read_ptr    = Signal.like(write_ptr)
+        overflow    = Signal()
+
+        write_beat  = Signal()
+        frame_ptr   = Signal.like(write_ptr)
+        full        = Signal()
+
+        comb = m.d.comb
+        sync = m.d.sync
+
+        comb += [
+            full.eq((write_ptr - read_ptr)[:len(write_ptr)] == self.depth),
+            write_beat.eq(stream_in.valid.any() & ~full & ~overflow),
+            frame_ptr.eq(write_ptr + write_beat),
+
+            write_port.addr.eq(write_ptr),
+            write_port.data.eq(Cat(stream_in.payload, stream_in.valid) if valid_width > 1 else stream_in.payload),
+            write_port.en.eq(write_beat),
+        ]
+
+        with m.If(write_beat):
+            sync += write_ptr.eq(write_ptr + 1)
+        with m.If(stream_in.valid.any() & full):
+            sync += overflow.eq(1)
+
+        with m.If(stream_in.last):
+            frame_length = (frame_ptr - frame_start)[:len(write_ptr)]
+
+            with m.If(stream_in.crc_error | overflow | (stream_in.valid.any() & full) | ~lengths.w_rdy):
+                # throw the frame away
+                sync += [
+                    write_ptr.eq(frame_start),
+                    overflow.eq(0),
+                ]
+                with m.If(stream_in.crc_error):
+                    sync += self.dropped_crc_out.eq(self.dropped_crc_out + 1)
+                with m.Else():
+                    sync += self.dropped_overflow_out.eq(self.dropped_overflow_out + 1)
+
+            with m.Elif(frame_length != 0):
+                comb += [
+                    lengths.w_data.eq(frame_length),
+                    lengths.w_en.eq(1),
+                ]
+                sync += [
+                    frame_start.eq(frame_ptr),
+                    self.frames_out.eq(self.frames_out + 1),
+                ]
+
+        remaining  = Signal.like(lengths.r_data)
+        first      = Signal()
+        load       = Signal()
+        beat_valid = Signal()
+
+        comb += [
+            load.eq((remaining != 0) & (~beat_valid | stream_out.ready)),
+            read_port.addr.eq(read_ptr),
+            read_port.en.eq(load),
+            stream_out.payload.eq(read_port.data[:len(stream_out.payload)]),
+        ]
+
+        if valid_width > 1:
+            comb += stream_out.valid.eq(Mux(beat_valid, read_port.data[len(stream_out.payload):], 0))
+        else:
+            comb += stream_out.valid.eq(beat_valid)
+
+        with m.If(load):
+            sync += [
+                read_ptr.eq(read_ptr + 1),
+                remaining.eq(remaining - 1),
+                beat_valid.eq(1),
+                stream_out.first.eq(first),
+                stream_out.last.eq(remaining == 1),
+                first.eq(0),
+            ]
+        with m.Elif(stream_out.ready):
+            sync += [
+                beat_valid.eq(0),
+                stream_out.first.eq(0),
+                stream_out.last.eq(0),
+            ]
+
+        with m.If((remaining == 0) & lengths.r_rdy):
+            comb += lengths.r_en.eq(1)
+            sync += [
+                remaining.eq(lengths.r_data),
+                first.eq(1),
+            ]
+
+        return m
+
+class HSPIFrameBuffer(Elaboratable):
+    """ Double buffered frame memory in front of a HSPITransmitter
+
+        Collects up to max_frame_words words of a packet in one of two banks, while the
+        frame in the other bank goes out on stream_out. Packets longer than that are cut
+        into several frames, keeping the first and last flags of the packet, which is what
+        a HSPITransmitter with segment=True and the same max_frame_words expects.
+
+        A frame is only offered on stream_out once it is complete, so that it can go
+        out without gaps, and frame_words_out holds its length in words while
+        frame_complete_out is high. With a threshold, a frame is already offered
+        after that many words, which saves latency, but can leave gaps if the producer
+        does not keep up.
+    """
+    def __init__(self, *, max_frame_words=4096, threshold=None, payload_width=32, valid_width=1):
+        if max_frame_words % valid_width:
+            raise ValueError(f"max_frame_words must be a multiple of {valid_width}, not {max_frame_words}")
+
+        self.stream_in  = StreamInterface(name="frame_buffer_in",  payload_width=payload_width, valid_width=valid_width)
+        self.stream_out = StreamInterface(name="frame_buffer_out", payload_width=payload_width, valid_width=valid_width)
+
+        self.frame_words_out    = Signal(range(max_frame_words + 1))
+        self.frame_complete_out = Signal()
+
+        self.max_frame_words = max_frame_words
+        self.threshold       = threshold
+
+    def elaborate(self, platform):
+        m = Module()
+        stream_in   = self.stream_in
+        stream_out  = self.stream_out
+        valid_width = len(stream_in.valid)
+        max_beats   = self.max_frame_words // valid_width
+        threshold   = max_beats if self.threshold is None else min(max_beats, -(-self.threshold // valid_width))
+
+        comb = m.d.comb
+        sync = m.d.sync
+
+        # first and last of every beat are stored with it,
+        # and the valid mask if there is more than one word per beat
+        payload_width = len(stream_in.payload)
+        width = payload_width + 2 + (valid_width if valid_width > 1 else 0)
+        beat_bits = (max_beats - 1).bit_length()
+
+        memory = Memory(width=width, depth=2 << beat_bits)
+        m.submodules.write_port = write_port = memory.write_port()
+        m.submodules.read_port  = read_port  = memory.read_port(transparent=False)
+
+        # a bank is complete from the end of its frame until the frame has been read
+        complete = Array(Signal(name=f"complete{n}") for n in range(2))
+        beats    = Array(Signal(range(max_beats + 1), name=f"beats{n}") for n in range(2))
+        words    = Array(Signal.like(self.frame_words_out, name=f"words{n}") for n in range(2))
+
+        write_bank  = Signal()
+        write_index = Signal(range(max_beats + 1))
+        write_words = Signal.like(self.frame_words_out)
+        write_beat  = Signal()
+        frame_done  = Signal()
+
+        stored = Cat(stream_in.payload, stream_in.first, stream_in.last)
+        if valid_width > 1:
+            stored = Cat(stored, stream_in.valid)
+
+        comb += [
+            stream_in.ready.eq(~complete[write_bank]),
+            write_beat.eq(stream_in.ready & stream_in.valid.any()),
+            frame_done.eq(stream_in.last | (write_index + 1 == max_beats)),
+
+            write_port.addr.eq(Cat(write_index[:beat_bits], write_bank)),
+            write_port.data.eq(stored),
+            write_port.en.eq(write_beat),
+        ]
+
+        with m.If(write_beat):
+            sync += [
+                write_index.eq(write_index + 1),
+                write_words.eq(write_words + sum(stream_in.valid)),
+            ]
+            with m.If(frame_done):
+                sync += [
+                    complete[write_bank].eq(1),
+                    beats[write_bank].eq(write_index + 1),
+                    words[write_bank].eq(write_words + sum(stream_in.valid)),
+                    write_bank.eq(~write_bank),
+                    write_index.eq(0),
+                    write_words.eq(0),
+                ]
+
+        read_bank  = Signal()
+        read_index = Signal(range(max_beats + 1))
+        readable   = Signal()
+        load       = Signal()
+        beat_valid = Signal()
+        read_first = Signal()
+        read_last  = Signal()
+
+        with m.If(complete[read_bank]):
+            comb += readable.eq(read_index < beats[read_bank])
+        with m.Elif(write_bank == read_bank):
+            # cut through, once enough of the frame is there
+            comb += readable.eq((read_index < write_index) & ((read_index != 0) | (write_index >= threshold)))
+
+        comb += [
+            load.eq(readable & (~beat_valid | stream_out.ready)),
+            read_port.addr.eq(Cat(read_index[:beat_bits], read_bank)),
+            read_port.en.eq(load),
+
+            Cat(stream_out.payload, read_first, read_last).eq(read_port.data),
+            stream_out.first.eq(beat_valid & read_first),
+            stream_out.last.eq(beat_valid & read_last),
+
+            self.frame_words_out.eq(words[read_bank]),
+            self.frame_complete_out.eq(complete[read_bank]),
+        ]
+
+        if valid_width > 1:
+            comb += stream_out.valid.eq(Mux(beat_valid, read_port.data[payload_width + 2:], 0))
+        else:
+            comb += stream_out.valid.eq(beat_valid)
+
+        with m.If(load):
+            sync += [
+                beat_valid.eq(1),
+                read_index.eq(read_index + 1),
+            ]
+            with m.If(complete[read_bank] & (read_index + 1 == beats[read_bank])):
+                sync += [
+                    complete[read_bank].eq(0),
+                    read_bank.eq(~read_bank),
+                    read_index.eq(0),
+                ]
+        with m.Elif(stream_out.ready):
+            sync += beat_valid.eq(0)
+
+        return m
+
+from amaranth.sim import Passive
+from amlib.test   import GatewareTestCase, sync_test_case
+
+class HSPIPacketBufferTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPIPacketBuffer
+    FRAGMENT_ARGUMENTS  = dict(depth=16, max_frames=4)
+
+    def setUp(self):
+        super().setUp()
+        self.received = []
+        self.rng      = random.Random(0)
+        self.sim.add_sync_process(self.collect_frames)
+
+    def collect_frames(self):
+        yield Passive()
+        stream = self.dut.stream_out
+        frame  = []
+        while True:
+            ready = self.rng.random() < 0.6
+            yield stream.ready.eq(ready)
+            yield
+            if ready and (yield stream.valid):
+                if (yield stream.first):
+                    self.assertEqual(frame, [])
+                self.assertEqual((yield stream.crc_error), 0)
+                frame.append((yield stream.payload))
+                if (yield stream.last):
+                    self.received.append(frame)
+                    frame = []
+
+    def send_frame(self, words, crc_error=False, separate_last=False):
+        stream = self.dut.stream_in
+        for i, word in enumerate(words):
+            yield stream.valid.eq(1)
+            yield stream.first.eq(i == 0)
+            yield stream.last.eq(i == len(words) - 1 and not separate_last)
+            yield stream.crc_error.eq(crc_error and i == len(words) - 1 and not separate_last)
+            yield stream.payload.eq(word)
+            yield
+        yield stream.valid.eq(0)
+        yield stream.first.eq(0)
+        if separate_last:
+            yield stream.last.eq(1)
+            yield stream.crc_error.eq(crc_error)
+            yield
+        yield stream.last.eq(0)
+        yield stream.crc_error.eq(0)
+        yield from self.advance_cycles(2)
+
+    @sync_test_case
+    def test_packet_buffer(self):
+        dut  = self.dut
+        good = [list(range(0x10, 0x15)), list(range(0x20, 0x2c)), list(range(0x30, 0x38))]
+
+        yield from self.send_frame(good[0])
+        yield from self.send_frame(list(range(0x40, 0x48)), crc_error=True)
+        yield from self.send_frame(good[1], separate_last=True)
+        yield from self.send_frame(list(range(0x50, 0x50 + 16)))
+        yield from self.advance_cycles(80)
+        yield from self.send_frame(good[2])
+        yield from self.advance_cycles(60)
+
+        self.assertEqual(self.received, good)
+        self.assertEqual((yield dut.frames_out), 3)
+        self.assertEqual((yield dut.dropped_crc_out), 1)
+        self.assertEqual((yield dut.dropped_overflow_out), 1)
+
+class HSPIFrameBufferTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPIFrameBuffer
+    FRAGMENT_ARGUMENTS  = dict(max_frame_words=8)
+
+    def setUp(self):
+        super().setUp()
+        self.rng     = random.Random(0)
+        self.packets = [list(range(0x10, 0x15)), list(range(0x20, 0x34)), list(range(0x40, 0x48))]
+        self.sim.add_sync_process(self.send_packets)
+
+    def send_packets(self):
+        stream = self.dut.stream_in
+        for packet in self.packets:
+            for i, word in enumerate(packet):
+                while self.rng.random() < 0.5:
+                    yield stream.valid.eq(0)
+                    yield
+                yield stream.valid.eq(1)
+                yield stream.first.eq(i == 0)
+                yield stream.last.eq(i == len(packet) - 1)
+                yield stream.payload.eq(word)
+                yield
+                while not (yield stream.ready):
+                    yield
+        yield stream.valid.eq(0)
+
+    @sync_test_case
+    def test_frame_buffer(self):
+        dut    = self.dut
+        stream = dut.stream_out
+        frames = []
+        length = None
+
+        yield stream.ready.eq(1)
+        for _ in range(300):
+            yield
+            valid = (yield stream.valid)
+            if length is None and valid:
+                # a frame only starts when it is complete, and then goes out without gaps
+                self.assertEqual((yield dut.frame_complete_out), 1)
+                length = (yield dut.frame_words_out)
+                frames.append([])
+            if length is not None:
+                self.assertEqual(valid, 1)
+                frames[-1].append(((yield stream.payload), (yield stream.first), (yield stream.last)))
+                if len(frames[-1]) == length:
+                    length = None
+
+        expected = [(word, i == 0, i == len(packet) - 1) for packet in self.packets for i, word in enumerate(packet)]
+        self.assertEqual([len(frame) for frame in frames], [5, 8, 8, 4, 8])
+        self.assertEqual(sum(frames, []), expected)
@@ -0,0 +1,397 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+import random
+
+from amaranth         import *
+from amaranth.lib.cdc import FFSynchronizer, PulseSynchronizer
+
+from .hspi import HSPIReceiver
+
+# vendor requests for the calibration over USB:
+# START runs it again, STATUS returns status_out as four little endian bytes
+VENDOR_REQUEST_CALIBRATION_START  = 0x16
+VENDOR_REQUEST_CALIBRATION_STATUS = 0x17
+
+class HSPIPhaseCalibration(Elaboratable):
+    """ Finds the phase of the HSPI sampling clock in the middle of the eye of the data bus
+
+        Drives the dynamic phase shift of the PLL output which clocks domain,
+        with phase_step_out high for step_cycles cycles for every step of
+        1 / steps of a clock period, always in the same direction,
+        while the CH569 keeps sending training frames.
+
+        After lock_in goes high, or a pulse on start_in in read_domain,
+        it goes once around all steps phases. At each of them, it waits settle_cycles,
+        drops the frame in flight and then checks the next frames of the receiver.
+        A phase passes if all of them come with a correct CRC, and with frame_words data words,
+        if that is given, before timeout cycles without a frame have gone by.
+        Then it moves to the middle of the longest run of passing phases,
+        seen as a circle, and reports it on window_start_out and window_length_out,
+        with the phase it settled on in phase_out, counted from where it started.
+        If no phase passes, it stays where it started and sets failed_out.
+
+        status_out has all of this for reading from read_domain, see STATUS_LAYOUT.
+        It only changes while calibrating_out is high.
+    """
+    # fields of status_out, from bit 0 up
+    STATUS_LAYOUT = [
+        ("window_start",  8),
+        ("window_length", 8),
+        ("phase",         8),
+        ("calibrating",   1),
+        ("done",          1),
+        ("failed",        1),
+    ]
+
+    def __init__(self, *, steps, domain=None, read_domain=None, frames=4, frame_words=None,
+                 settle_cycles=256, step_cycles=4, timeout=1 << 16):
+        if not 1 < steps <= 255:
+            raise ValueError(f"steps must be between 2 and 255, not {steps}")
+
+        self.lock_in         = Signal()
+        self.start_in        = Signal()
+        self.frame_done_in   = Signal()
+        self.crc_error_in    = Signal()
+        self.num_words_in    = Signal(13)
+
+        self.phase_step_out  = Signal()
+        self.phase_dir_out   = Signal()
+
+        self.calibrating_out   = Signal()
+        self.done_out          = Signal()
+        self.failed_out        = Signal()
+        self.phase_out         = Signal(range(steps))
+        self.window_start_out  = Signal(range(steps))
+        self.window_length_out = Signal(range(steps + 1))
+        self.status_out        = Signal(32)
+
+        self.steps         = steps
+        self.domain        = domain
+        self.read_domain   = read_domain
+        self.frames        = frames
+        self.frame_words   = frame_words
+        self.settle_cycles = settle_cycles
+        self.step_cycles   = step_cycles
+        self.timeout       = timeout
+
+    def connect(self, receiver: HSPIReceiver):
+        """ checks the frames coming out of receiver """
+        return [
+            self.frame_done_in .eq(receiver.packet_done_out),
+            self.crc_error_in  .eq(receiver.crc_error_out),
+            self.num_words_in  .eq(receiver.num_words_out),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        domain = "sync" if self.domain is None else self.domain
+        sync   = m.d.__getattr__(domain)
+        comb   = m.d.comb
+
+        steps = self.steps
+
+        lock  = Signal()
+        start = Signal()
+        m.submodules.lock_synchronizer = FFSynchronizer(self.lock_in, lock, o_domain=domain)
+        if self.read_domain is None or self.read_domain == domain:
+            comb += start.eq(self.start_in)
+        else:
+            m.submodules.start_synchronizer = start_synchronizer = \
+                PulseSynchronizer(i_domain=self.read_domain, o_domain=domain)
+            comb += [
+                start_synchronizer.i.eq(self.start_in),
+                start.eq(start_synchronizer.o),
+            ]
+
+        lock_last = Signal()
+        sync += lock_last.eq(lock)
+
+        position  = self.phase_out
+        passes    = Signal(steps)
+        timer     = Signal(range(max(self.settle_cycles, self.step_cycles, self.timeout) + 1))
+        frames    = Signal(range(self.frames + 2))
+        failed    = Signal()
+        centering = Signal()
+        target    = Signal(range(steps))
+
+        # longest run of passing phases, going around the circle twice
+        index     = Signal(range(2 * steps))
+        wrapped   = Signal(range(steps))
+        run       = Signal(range(2 * steps + 1))
+        best      = Signal(range(2 * steps + 1))
+        best_end  = Signal(range(2 * steps))
+        # start and middle of the window before taking them modulo steps
+        start_sum  = Signal(range(3 * steps + 1))
+        middle_sum = Signal(range(3 * steps + 1))
+
+        good_frame = Signal()
+        if self.frame_words is None:
+            comb += good_frame.eq(~self.crc_error_in)
+        else:
+            # num_words_out of the receiver includes the CRC word
+            comb += good_frame.eq(~self.crc_error_in & (self.num_words_in == self.frame_words + 1))
+
+        comb += [
+            self.phase_dir_out.eq(0),
+            self.status_out.eq(Cat(self.window_start_out, Const(0, 8 - len(self.window_start_out)),
+                                   self.window_length_out, Const(0, 8 - len(self.window_length_out)),
+                                   position, Const(0, 8 - len(position)),
+                                   self.calibrating_out, self.done_out, self.failed_out)),
+        ]
+
+        with m.FSM(domain=domain):
+            with m.State("IDLE"):
+                with m.If((lock & ~lock_last) | start):
+                    sync += [
+                        self.calibrating_out.eq(1),
+                        self.done_out.eq(0),
+                        self.failed_out.eq(0),
+                        position.eq(0),
+                        passes.eq(0),
+                        centering.eq(0),
+                        timer.eq(0),
+                    ]
+                    m.next = "SETTLE"
+
+            with m.State("SETTLE"):
+                sync += timer.eq(timer + 1)
+                with m.If(timer == self.settle_cycles - 1):
+                    sync += [
+                        timer.eq(0),
+                        frames.eq(0),
+                        failed.eq(0),
+                    ]
+                    m.next = "MEASURE"
+
+            with m.State("MEASURE"):
+                sync += timer.eq(timer + 1)
+                with m.If(self.frame_done_in):
+                    sync += [
+                        timer.eq(0),
+                        frames.eq(frames + 1),
+                    ]
+                    # the first frame may have been in flight while the phase moved
+                    with m.If((frames > 0) & ~good_frame):
+                        sync += failed.eq(1)
+
+                with m.If((frames == self.frames + 1) | (timer == self.timeout - 1)):
+                    sync += [
+                        passes.bit_select(position, 1).eq(~failed & (frames == self.frames + 1)),
+                        timer.eq(0),
+                    ]
+                    m.next = "STEP"
+
+            with m.State("STEP"):
+                comb += self.phase_step_out.eq(1)
+                sync += timer.eq(timer + 1)
+                with m.If(timer == self.step_cycles - 1):
+                    sync += [
+                        timer.eq(0),
+                        position.eq(Mux(position == steps - 1, 0, position + 1)),
+                    ]
+                    with m.If(centering):
+                        m.next = "CENTER"
+                    with m.Elif(position == steps - 1):
+                        sync += [
+                            index.eq(0),
+                            wrapped.eq(0),
+                            run.eq(0),
+                            best.eq(0),
+                            best_end.eq(0),
+                        ]
+                        m.next = "EVALUATE"
+                    with m.Else():
+                        m.next = "SETTLE"
+
+            with m.State("EVALUATE"):
+                with m.If(passes.bit_select(wrapped, 1)):
+                    sync += run.eq(run + 1)
+                    with m.If(run + 1 > best):
+                        sync += [
+                            best.eq(run + 1),
+                            best_end.eq(index),
+                        ]
+                with m.Else():
+                    sync += run.eq(0)
+
+                sync += [
+                    index.eq(index + 1),
+                    wrapped.eq(Mux(wrapped == steps - 1, 0, wrapped + 1)),
+                ]
+                with m.If(index == 2 * steps - 1):
+                    m.next = "WINDOW"
+
+            with m.State("WINDOW"):
+                # with all phases passing, the run goes on through the second time around
+                with m.If(best >= steps):
+                    sync += [
+                        start_sum.eq(0),
+                        middle_sum.eq(steps // 2),
+                        self.window_length_out.eq(steps),
+                    ]
+                with m.Else():
+                    sync += [
+                        start_sum.eq(best_end + steps + 1 - best),
+                        middle_sum.eq(best_end + steps + 1 - best + (best >> 1)),
+                        self.window_length_out.eq(best),
+                    ]
+                m.next = "MODULO"
+
+            with m.State("MODULO"):
+                with m.If(start_sum >= steps):
+                    sync += start_sum.eq(start_sum - steps)
+                with m.If(middle_sum >= steps):
+                    sync += middle_sum.eq(middle_sum - steps)
+                with m.If((start_sum < steps) & (middle_sum < steps)):
+                    sync += [
+                        self.window_start_out.eq(start_sum),
+                        target.eq(middle_sum),
+                        centering.eq(1),
+                    ]
+                    with m.If(best == 0):
+                        sync += [
+                            self.failed_out.eq(1),
+                            target.eq(0),
+                        ]
+                    m.next = "CENTER"
+
+            with m.State("CENTER"):
+                with m.If(position == target):
+                    sync += [
+                        self.calibrating_out.eq(0),
+                        self.done_out.eq(1),
+                    ]
+                    m.next = "IDLE"
+                with m.Else():
+                    m.next = "STEP"
+
+        return m
+
+from amaranth.sim import Passive
+from amlib.test   import GatewareTestCase, sync_test_case
+
+from .hspi import HSPITransmitter
+
+class _SkewedLink(Elaboratable):
+    """ a transmitter sending training frames to a receiver over a data bus whose bits are skewed
+
+        The sampling phase of the receiver moves by one of steps with each phase_step_out
+        of the calibration. Bit n of hd is sampled right while (phase - skews[n]) % steps
+        is less than eye, otherwise the receiver still sees the bit of the word before.
+    """
+    def __init__(self, *, steps, skews, eye):
+        self.tx          = HSPITransmitter()
+        self.rx          = HSPIReceiver()
+        self.calibration = HSPIPhaseCalibration(steps=steps, read_domain="usb", frames=3, frame_words=8,
+                                                settle_cycles=16, timeout=256)
+        self.phase       = Signal(range(steps))
+        self.steps       = steps
+        self.skews       = skews
+        self.eye         = eye
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.tx          = tx          = self.tx
+        m.submodules.rx          = rx          = self.rx
+        m.submodules.calibration = calibration = self.calibration
+
+        step_last = Signal()
+        m.d.sync += step_last.eq(calibration.phase_step_out)
+        with m.If(step_last & ~calibration.phase_step_out):
+            m.d.sync += self.phase.eq(Mux(self.phase == self.steps - 1, 0, self.phase + 1))
+
+        hd_last = Signal(32)
+        m.d.sync += hd_last.eq(tx.hspi_out.hd.o)
+
+        hd = []
+        for bit, skew in enumerate(self.skews):
+            offset = Signal(range(self.steps), name=f"offset{bit}")
+            m.d.comb += offset.eq(Mux(self.phase >= skew, self.phase - skew, self.phase + self.steps - skew))
+            hd.append(Mux(offset < self.eye, tx.hspi_out.hd.o[bit], hd_last[bit]))
+
+        m.d.comb += [
+            rx.hspi_in.rx_act   .eq(tx.hspi_out.tx_req),
+            rx.hspi_in.rx_valid .eq(tx.hspi_out.tx_valid),
+            rx.hspi_in.hd.i     .eq(Cat(hd)),
+            tx.hspi_out.tx_ready.eq(rx.hspi_in.tx_ack),
+            *calibration.connect(rx),
+        ]
+
+        return m
+
+class HSPIPhaseCalibrationTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = _SkewedLink
+    STEPS               = 24
+    EYE                 = 13
+    FRAGMENT_ARGUMENTS  = dict(steps=STEPS, skews=random.Random(0).choices(range(18, 23), k=32), eye=EYE)
+
+    def setUp(self):
+        super().setUp()
+        self.sim.add_sync_process(self.training)
+
+    def training(self):
+        """ the CH569 sending training frames all the time """
+        yield Passive()
+        rng    = random.Random(0)
+        dut    = self.dut
+        stream = dut.tx.stream_in
+        yield dut.tx.tll_2b_in.eq(0b11)
+        yield dut.tx.user_id0_in.eq(0x3abcdef)
+        yield dut.tx.user_id1_in.eq(0x3456789)
+        while True:
+            for i in range(8):
+                yield stream.valid.eq(1)
+                yield stream.first.eq(i == 0)
+                yield stream.last.eq(i == 7)
+                # every bit has to toggle now and then for the skew to show
+                yield stream.payload.eq(rng.getrandbits(32))
+                yield
+                while not (yield stream.ready):
+                    yield
+            yield stream.valid.eq(0)
+            yield from self.advance_cycles(4)
+
+    def expected_window(self):
+        """ the phases at which every bit is sampled right, as start and length """
+        skews = self.FRAGMENT_ARGUMENTS["skews"]
+        good  = [all((phase - skew) % self.STEPS < self.EYE for skew in skews) for phase in range(self.STEPS)]
+        for start in range(self.STEPS):
+            if good[start] and not good[start - 1]:
+                length = 0
+                while good[(start + length) % self.STEPS]:
+                    length += 1
+                return start, length
+
+    @sync_test_case
+    def test_calibration(self):
+        dut         = self.dut
+        calibration = dut.calibration
+        yield calibration.lock_in.eq(1)
+        yield from self.advance_cycles(4)
+        self.assertEqual((yield calibration.calibrating_out), 1)
+        while (yield calibration.calibrating_out):
+            yield
+
+        start, length = self.expected_window()
+        # the window wraps around the end of the circle
+        self.assertGreater(start + length, self.STEPS)
+        self.assertEqual((yield calibration.failed_out), 0)
+        self.assertEqual((yield calibration.window_start_out), start)
+        self.assertEqual((yield calibration.window_length_out), length)
+        self.assertEqual((yield calibration.phase_out), (start + length // 2) % self.STEPS)
+        self.assertEqual((yield dut.phase), (yield calibration.phase_out))
+
+        status = yield calibration.status_out
+        self.assertEqual(status & 0xff, start)
+        self.assertEqual(status >> 8 & 0xff, length)
+        self.assertEqual(status >> 25 & 0b11, 0b01)
+
+        # frames come through at the phase found
+        yield from self.advance_cycles(64)
+        errors = 0
+        for _ in range(300):
+            yield
+            if (yield dut.rx.packet_done_out) and (yield dut.rx.crc_error_out):
+                errors += 1
+        self.assertEqual(errors, 0)
@@ -0,0 +1,284 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+import math
+import random
+
+from amaranth          import *
+from amaranth.lib.fifo import AsyncFIFO
+
+from amlib.stream import StreamInterface
+
+class HSPIStreamBridge(Elaboratable):
+    """ Carries a packet stream from i_domain into o_domain
+
+        stream_in has i_words and stream_out o_words 32 bit words per beat, with one valid
+        bit per word, and first, last and crc_error, like the streams of the HSPI cores.
+        Only the last beat of a packet may have less valid words, which have to be the lowest
+        ones, and last may also come after it, on a beat without valid words.
+        One of i_words and o_words has to be a multiple of the other.
+
+        The packets go through an AsyncFIFO of the wider of both, so the width is
+        converted on the side of the narrower stream, which usually is the faster clock.
+        The words of a packet are only written into the FIFO once the beat after them is known,
+        so that last always comes with a valid beat on stream_out, unless the packet has no words.
+        stream_in.ready is low for one cycle after a beat which has both valid words and last,
+        for the HSPI cores there always are some cycles between frames.
+
+        Unless depth is given, the FIFO is made deep enough from the clock frequencies
+        i_freq and o_freq to cover the round trip through its synchronizers,
+        so that it does not stall stream_in as long as stream_out can take the words
+        at least as fast as they come in.
+    """
+    # register stages a FIFO pointer goes through on the way into the other domain
+    SYNC_STAGES = 3
+
+    def __init__(self, *, i_domain, o_domain, i_freq, o_freq, i_words=1, o_words=1, depth=None):
+        if max(i_words, o_words) % min(i_words, o_words):
+            raise ValueError(f"one of i_words and o_words must be a multiple of the other, "
+                             f"not {i_words} and {o_words}")
+
+        self.stream_in  = StreamInterface(name="bridge_in",  payload_width=32 * i_words, valid_width=i_words,
+                                          extra_fields=[("crc_error", 1)])
+        self.stream_out = StreamInterface(name="bridge_out", payload_width=32 * o_words, valid_width=o_words,
+                                          extra_fields=[("crc_error", 1)])
+
+        self.i_domain = i_domain
+        self.o_domain = o_domain
+        self.i_words  = i_words
+        self.o_words  = o_words
+        self.words    = max(i_words, o_words)
+
+        if depth is None:
+            depth = self.fifo_depth(i_freq=i_freq, o_freq=o_freq, i_words=i_words, o_words=o_words)
+        self.depth = depth
+
+    @classmethod
+    def fifo_depth(cls, *, i_freq, o_freq, i_words=1, o_words=1):
+        """ number of FIFO entries which keep a bridge from stalling its input """
+        # one entry is written at most every beats cycles of i_domain
+        beats      = max(i_words, o_words) // i_words
+        # a freed entry is only seen by the writer after the pointers went
+        # through the synchronizers into o_domain and back
+        round_trip = (cls.SYNC_STAGES + 1) * (1 / i_freq + 1 / o_freq)
+        entries    = math.ceil(round_trip * i_freq / beats) + 2
+        return 1 << (entries - 1).bit_length()
+
+    def elaborate(self, platform):
+        m = Module()
+        comb = m.d.comb
+        i_sync = m.d.__getattr__(self.i_domain)
+        o_sync = m.d.__getattr__(self.o_domain)
+
+        stream_in  = self.stream_in
+        stream_out = self.stream_out
+        words      = self.words
+
+        # payload, valid, first, last, crc_error
+        width = 32 * words + words + 3
+        m.submodules.fifo = fifo = AsyncFIFO(width=width, depth=self.depth,
+                                             w_domain=self.i_domain, r_domain=self.o_domain)
+
+        #
+        # collect i_words beats into entries of words in i_domain
+        #
+        i_beats   = words // self.i_words
+        payload   = Signal(32 * words)
+        valid     = Signal(words)
+        first     = Signal()
+        count     = Signal(range(i_beats + 1))
+        flush     = Signal()
+        crc_error = Signal()
+
+        # the word collected so far, with the input beat put in after it
+        merged_payload = Signal.like(payload)
+        merged_valid   = Signal.like(valid)
+        complete       = Signal()
+        beat           = Signal()
+        data           = Signal()
+
+        comb += [
+            complete.eq(count == i_beats),
+            data.eq(stream_in.valid.any()),
+            beat.eq(stream_in.ready & (data | stream_in.last)),
+            stream_in.ready.eq(~flush & fifo.w_rdy),
+
+            merged_payload.eq(payload),
+            merged_valid.eq(valid),
+        ]
+
+        with m.Switch(count):
+            for n in range(i_beats):
+                with m.Case(n):
+                    comb += [
+                        merged_payload.word_select(n, 32 * self.i_words).eq(stream_in.payload),
+                        merged_valid.word_select(n, self.i_words).eq(stream_in.valid),
+                    ]
+
+        def start(with_beat):
+            """ starts the next word, with the input beat in it or empty """
+            if not with_beat:
+                return [
+                    valid.eq(0),
+                    first.eq(0),
+                    count.eq(0),
+                ]
+            return [
+                payload[:32 * self.i_words].eq(stream_in.payload),
+                valid.eq(stream_in.valid),
+                first.eq(stream_in.first),
+                count.eq(1),
+            ]
+
+        with m.If(flush):
+            comb += [
+                fifo.w_data.eq(Cat(payload, valid, first, 1, crc_error)),
+                fifo.w_en.eq(1),
+            ]
+            with m.If(fifo.w_rdy):
+                i_sync += start(with_beat=False)
+                i_sync += flush.eq(0)
+
+        with m.Elif(beat & complete):
+            comb += [
+                fifo.w_data.eq(Cat(payload, valid, first, stream_in.last & ~data, stream_in.crc_error & ~data)),
+                fifo.w_en.eq(1),
+            ]
+            with m.If(data):
+                i_sync += start(with_beat=True)
+                i_sync += [
+                    flush.eq(stream_in.last),
+                    crc_error.eq(stream_in.crc_error),
+                ]
+            with m.Else():
+                i_sync += start(with_beat=False)
+
+        with m.Elif(beat & stream_in.last):
+            comb += [
+                fifo.w_data.eq(Cat(merged_payload, merged_valid, first | stream_in.first, 1, stream_in.crc_error)),
+                fifo.w_en.eq(1),
+            ]
+            i_sync += start(with_beat=False)
+
+        with m.Elif(beat):
+            i_sync += [
+                payload.eq(merged_payload),
+                valid.eq(merged_valid),
+                first.eq(first | stream_in.first),
+                count.eq(count + 1),
+            ]
+
+        #
+        # hand out the entries in beats of o_words in o_domain
+        #
+        o_beats      = words // self.o_words
+        slot         = Signal(range(o_beats))
+        entry_valid  = fifo.r_data[32 * words:33 * words]
+        entry_first  = fifo.r_data[-3]
+        entry_last   = fifo.r_data[-2]
+        entry_error  = fifo.r_data[-1]
+        slot_valid   = Signal(self.o_words)
+        final        = Signal()
+
+        with m.Switch(slot):
+            for n in range(o_beats):
+                with m.Case(n):
+                    comb += [
+                        stream_out.payload.eq(fifo.r_data.word_select(n, 32 * self.o_words)),
+                        slot_valid.eq(entry_valid.word_select(n, self.o_words)),
+                        # the valid words of an entry are always the lowest ones
+                        final.eq(entry_valid[(n + 1) * self.o_words:] == 0 if n < o_beats - 1 else 1),
+                    ]
+
+        comb += [
+            stream_out.valid     .eq(Mux(fifo.r_rdy, slot_valid, 0)),
+            stream_out.first     .eq(fifo.r_rdy & entry_first & (slot == 0)),
+            stream_out.last      .eq(fifo.r_rdy & entry_last & final),
+            stream_out.crc_error .eq(fifo.r_rdy & entry_error & final),
+        ]
+
+        with m.If(fifo.r_rdy & stream_out.ready):
+            with m.If(final):
+                comb += fifo.r_en.eq(1)
+                o_sync += slot.eq(0)
+            with m.Else():
+                o_sync += slot.eq(slot + 1)
+
+        return m
+
+from amaranth.sim import Passive
+from amlib.test   import GatewareTestCase, sync_test_case
+
+class HSPIStreamBridgeTest(GatewareTestCase):
+    """ a receiver in sync hands its frames to a four times wider stream in usb """
+    FRAGMENT_UNDER_TEST = HSPIStreamBridge
+    FRAGMENT_ARGUMENTS  = dict(i_domain="sync", o_domain="usb", i_freq=120e6, o_freq=60e6, i_words=1, o_words=4)
+
+    def setUp(self):
+        super().setUp()
+        self.rng      = random.Random(0)
+        self.received = []
+        self.frames   = [([self.rng.getrandbits(32) for _ in range(self.rng.randint(1, 20))], self.rng.random() < 0.3)
+                         for _ in range(40)]
+
+        args = self.FRAGMENT_ARGUMENTS
+        self.sim.add_sync_process(self.collect, domain=args["o_domain"])
+        if args["i_domain"] != "sync":
+            self.sim.add_sync_process(self.send, domain=args["i_domain"])
+
+    def send(self):
+        """ sends the frames back to back as far as ready allows, the HSPI way """
+        dut    = self.dut
+        stream = dut.stream_in
+        words  = dut.i_words
+        for payload, crc_error in self.frames:
+            beats = [payload[i:i + words] for i in range(0, len(payload), words)]
+            for n, beat in enumerate(beats):
+                yield stream.payload.eq(sum(word << (32 * i) for i, word in enumerate(beat)))
+                yield stream.valid.eq((1 << len(beat)) - 1)
+                yield stream.first.eq(n == 0)
+                # like from the receiver, last and crc_error come with the last beat
+                last = n == len(beats) - 1
+                yield stream.last.eq(last)
+                yield stream.crc_error.eq(last and crc_error)
+                yield
+                self.assertEqual((yield stream.ready), 1)
+            yield stream.valid.eq(0)
+            yield stream.first.eq(0)
+            yield stream.last.eq(0)
+            yield stream.crc_error.eq(0)
+            yield
+        yield from self.advance_cycles(100)
+        self.done = True
+
+    def collect(self):
+        yield Passive()
+        stream = self.dut.stream_out
+        words  = self.dut.o_words
+        while True:
+            yield stream.ready.eq(1)
+            yield
+            valid = yield stream.valid
+            if valid:
+                if (yield stream.first):
+                    self.received.append(([], False))
+                payload = yield stream.payload
+                self.received[-1][0].extend(payload >> (32 * i) & 0xffffffff for i in range(words) if valid >> i & 1)
+            if (yield stream.last):
+                self.assertTrue(valid)
+                self.received[-1] = (self.received[-1][0], bool((yield stream.crc_error)))
+
+    @sync_test_case
+    def test_bridge(self):
+        self.done = False
+        if self.FRAGMENT_ARGUMENTS["i_domain"] == "sync":
+            yield from self.send()
+        while not self.done:
+            yield
+
+        # all frames came through without ever stalling the input
+        self.assertEqual(self.received, self.frames)
+
+class HSPIStreamBridgeTransmitTest(HSPIStreamBridgeTest):
+    """ a producer in usb feeds a transmitter in sync with two words per cycle """
+    FRAGMENT_ARGUMENTS  = dict(i_domain="usb", o_domain="sync", i_freq=60e6, o_freq=120e6, i_words=2, o_words=1)
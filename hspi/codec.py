@@ -0,0 +1,173 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Host side codec for HSPI frames, which works on many frames at once.
+# A frame on the bus is a header word, the payload and the CRC word.
+# Frames are passed around as a two dimensional uint32 array with one frame per row,
+# padded at the end, together with an array of the number of words in each row.
+# split_frames() and join_frames() convert between that and the words as they are on the bus.
+
+from collections import namedtuple
+from functools   import lru_cache
+
+import numpy as np
+
+POLYNOMIAL = 0x04C11DB7
+# the CRC of a frame including its CRC word, which is the same for all frames
+RESIDUE    = 0x2144DF1C
+
+HSPIFrames = namedtuple("HSPIFrames", ["tll_2b", "sequence_nr", "user_data", "payload", "lengths", "crc_ok"])
+
+@lru_cache(maxsize=None)
+def crc32_tables(polynomial=POLYNOMIAL):
+    """ The four tables of a slice-by-4 CRC-32, which processes a 32 bit word per step.
+
+        Like the CRC core, the CRC takes in the lowest bit of a word first,
+        so the tables are those of the reflected polynomial.
+    """
+    reflected = int(f"{polynomial:032b}"[::-1], 2)
+    tables    = np.zeros((4, 256), dtype=np.uint32)
+
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (reflected if crc & 1 else 0)
+        tables[0, byte] = crc
+    for n in range(1, 4):
+        tables[n] = (tables[n - 1] >> 8) ^ tables[0][tables[n - 1] & 0xff]
+
+    return tables
+
+def crc32(frames, lengths=None, *, polynomial=POLYNOMIAL):
+    """ CRC-32 of each row of frames, the same as crc_out of
+        CRC(polynomial=polynomial, crc_size=32, datawidth=32) after the words of the row.
+
+        Only the first lengths words of every row count, by default all of them.
+        A one dimensional frames is a single frame, whose CRC is returned as an int.
+        The rows are processed side by side, one word of every row per step,
+        so the more rows, the faster.
+    """
+    frames = np.asarray(frames, dtype=np.uint32)
+    single = frames.ndim == 1
+    frames = np.atleast_2d(frames)
+    if lengths is None:
+        lengths = np.full(len(frames), frames.shape[1])
+    lengths = np.asarray(lengths)
+
+    t0, t1, t2, t3 = crc32_tables(polynomial)
+    crc = np.full(len(frames), 0xffffffff, dtype=np.uint32)
+
+    for column in range(int(lengths.max(initial=0))):
+        state = crc ^ frames[:, column]
+        state = t3[state & 0xff] ^ t2[(state >> 8) & 0xff] ^ t1[(state >> 16) & 0xff] ^ t0[state >> 24]
+        crc   = np.where(column < lengths, state, crc)
+
+    crc ^= np.uint32(0xffffffff)
+    return int(crc[0]) if single else crc
+
+def pack_headers(tll_2b=0, sequence_nr=0, user_data=0):
+    """ Header words, Cat(user_data, sequence_nr, tll_2b) like the cores, broadcast over arrays """
+    tll_2b      = np.asarray(tll_2b,      dtype=np.uint32)
+    sequence_nr = np.asarray(sequence_nr, dtype=np.uint32)
+    user_data   = np.asarray(user_data,   dtype=np.uint32)
+    return (tll_2b & 0x3) << 30 | (sequence_nr & 0xf) << 26 | (user_data & 0x3ffffff)
+
+def unpack_headers(headers):
+    """ The tll_2b, sequence_nr and user_data fields of header words """
+    headers = np.asarray(headers, dtype=np.uint32)
+    return headers >> 30, (headers >> 26) & 0xf, headers & 0x3ffffff
+
+def build_frames(payloads, lengths=None, *, tll_2b=0, sequence_nr=0, user_data=0, polynomial=POLYNOMIAL):
+    """ Frames with header and CRC around each row of payloads
+
+        lengths is the number of payload words in each row, by default the whole row.
+        The header fields are numbers, or arrays with one for each frame.
+        Returns the frames, with two columns more than payloads, and the number of words in each.
+    """
+    payloads = np.atleast_2d(np.asarray(payloads, dtype=np.uint32))
+    count    = len(payloads)
+    if lengths is None:
+        lengths = np.full(count, payloads.shape[1])
+    lengths = np.asarray(lengths)
+    rows    = np.arange(count)
+
+    frames = np.zeros((count, payloads.shape[1] + 2), dtype=np.uint32)
+    frames[:, 0]    = np.broadcast_to(pack_headers(tll_2b, sequence_nr, user_data), count)
+    frames[:, 1:-1] = np.where(np.arange(payloads.shape[1]) < lengths[:, None], payloads, 0)
+    frames[rows, lengths + 1] = crc32(frames, lengths + 1, polynomial=polynomial)
+
+    return frames, lengths + 2
+
+def parse_frames(frames, lengths, *, polynomial=POLYNOMIAL):
+    """ Splits each row of frames, of lengths words, into its header fields, payload and CRC check
+
+        The payload of a row is in the columns 1 to lengths - 2 of the payload array,
+        with lengths - 2 words. crc_ok tells which frames have the right CRC.
+    """
+    frames  = np.atleast_2d(np.asarray(frames, dtype=np.uint32))
+    lengths = np.asarray(lengths)
+    if (lengths < 2).any():
+        raise ValueError("a frame needs at least a header and a CRC word")
+
+    tll_2b, sequence_nr, user_data = unpack_headers(frames[:, 0])
+    crc_ok = crc32(frames, lengths - 1, polynomial=polynomial) == frames[np.arange(len(frames)), lengths - 1]
+
+    return HSPIFrames(tll_2b=tll_2b, sequence_nr=sequence_nr, user_data=user_data,
+                      payload=frames[:, 1:-1], lengths=lengths - 2, crc_ok=crc_ok)
+
+def join_frames(frames, lengths):
+    """ The words of the frames one after the other, as they go over the bus """
+    frames = np.atleast_2d(np.asarray(frames, dtype=np.uint32))
+    return frames[np.arange(frames.shape[1]) < np.asarray(lengths)[:, None]]
+
+def split_frames(words, lengths):
+    """ Cuts the words from the bus into frames of lengths words, the opposite of join_frames """
+    words   = np.asarray(words, dtype=np.uint32)
+    lengths = np.asarray(lengths)
+    if lengths.sum() != len(words):
+        raise ValueError(f"the frames have {lengths.sum()} words, but there are {len(words)}")
+
+    frames  = np.zeros((len(lengths), int(lengths.max(initial=0))), dtype=np.uint32)
+    frames[np.arange(frames.shape[1]) < lengths[:, None]] = words
+    return frames
+
+import struct
+import unittest
+import zlib
+
+class CodecTest(unittest.TestCase):
+    def test_crc(self):
+        # the frame of HSPIReceiverTest
+        frame = [0xc3abcdef] + list(range(0x80))
+        self.assertEqual(crc32(frame), 0x1106c501)
+        self.assertEqual(crc32(frame + [0x1106c501]), RESIDUE)
+
+        rng     = np.random.default_rng(0)
+        frames  = rng.integers(0, 1 << 32, size=(50, 40), dtype=np.uint32)
+        lengths = rng.integers(0, 41, size=50)
+        self.assertEqual(list(crc32(frames, lengths)),
+                         [zlib.crc32(frame[:length].astype("<u4").tobytes()) for frame, length in zip(frames, lengths)])
+
+    def test_frames(self):
+        rng      = np.random.default_rng(1)
+        payloads = rng.integers(0, 1 << 32, size=(20, 16), dtype=np.uint32)
+        lengths  = rng.integers(0, 17, size=20)
+        frames, frame_lengths = build_frames(payloads, lengths, tll_2b=0b11, sequence_nr=np.arange(20) % 16,
+                                             user_data=0x3abcdef)
+
+        for n, (frame, payload, length) in enumerate(zip(frames, payloads, lengths)):
+            words = [0b11 << 30 | (n % 16) << 26 | 0x3abcdef] + list(payload[:length])
+            self.assertEqual(list(frame[:length + 2]), words + [zlib.crc32(struct.pack(f"<{len(words)}I", *words))])
+
+        words = join_frames(frames, frame_lengths)
+        self.assertEqual(len(words), frame_lengths.sum())
+        # a wrong bit in the third frame
+        words[frame_lengths[:2].sum()] ^= 1 << 7
+
+        parsed = parse_frames(split_frames(words, frame_lengths), frame_lengths)
+        self.assertEqual(list(parsed.crc_ok), [n != 2 for n in range(20)])
+        self.assertEqual(list(parsed.sequence_nr), list(np.arange(20) % 16))
+        self.assertTrue((parsed.tll_2b == 0b11).all())
+        self.assertEqual(list(parsed.lengths), list(lengths))
+        for n in range(20):
+            self.assertEqual(list(parsed.payload[n, :lengths[n]]), list(payloads[n, :lengths[n]]))
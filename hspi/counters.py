@@ -0,0 +1,283 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+from amaranth         import *
+from amaranth.lib.cdc import PulseSynchronizer
+
+from .hspi import HSPITransmitter, HSPIReceiver
+
+# vendor requests to read the counters over USB:
+# SNAPSHOT copies all counters at once, READ returns the copy of the counter
+# with the number in wIndex as four little endian bytes, and CLEAR sets all counters to zero
+VENDOR_REQUEST_SNAPSHOT = 0x10
+VENDOR_REQUEST_READ     = 0x11
+VENDOR_REQUEST_CLEAR    = 0x12
+
+# the states of the HSPI cores, in the order of the bits of their states_out
+TX_STATES = HSPITransmitter.STATES
+RX_STATES = HSPIReceiver.STATES
+
+LINK_COUNTERS = [
+    # frames, words on the bus including header and CRC,
+    # cycles with tx_req but no word, and frames cut at max_frame_words
+    "tx_frames", "tx_words", "tx_idle", "tx_truncated",
+    # the same for the receiver, with frames of more than 4096 data words
+    # as the CH569 can not send those
+    "rx_frames", "rx_words", "rx_idle", "rx_crc_errors", "rx_oversized",
+]
+
+def counter_names():
+    """ names of the counters of HSPILinkCounters, by their number """
+    return LINK_COUNTERS + [f"tx_state_{state}" for state in TX_STATES] + [f"rx_state_{state}" for state in RX_STATES]
+
+class HSPILinkCounters(Elaboratable):
+    """ Counts what goes on on the HSPI bus
+
+        Counts frames, words, idle cycles and errors of both directions, and the
+        cycles the transmitter and receiver spend in each of their states, in domain.
+        The counters are numbered as in counter_names().
+
+        A pulse on snapshot_in copies all of them at once, and the copy of the counter
+        number select_in is then on value_out. A pulse on clear_in sets all counters to zero,
+        after taking their values into the copy, if snapshot_in comes at the same time.
+        These signals are in read_domain. The copy is not synchronized into it,
+        so it should only be read a few cycles of domain after the snapshot.
+    """
+    def __init__(self, *, domain=None, read_domain=None, width=32):
+        self.tx_req_in       = Signal()
+        self.tx_valid_in     = Signal()
+        self.tx_states_in    = Signal(len(TX_STATES))
+        self.tx_truncated_in = Signal()
+
+        self.rx_act_in       = Signal()
+        self.rx_valid_in     = Signal()
+        self.rx_states_in    = Signal(len(RX_STATES))
+        self.rx_done_in      = Signal()
+        self.rx_crc_error_in = Signal()
+        self.rx_words_in     = Signal(13)
+
+        self.snapshot_in = Signal()
+        self.clear_in    = Signal()
+        self.select_in   = Signal(range(len(counter_names())))
+        self.value_out   = Signal(width)
+
+        self.domain      = domain
+        self.read_domain = read_domain
+        self.width       = width
+
+    def connect(self, transmitter: HSPITransmitter, receiver: HSPIReceiver):
+        """ taps the bus and state of a transmitter and receiver with one word per cycle """
+        return [
+            self.tx_req_in       .eq(transmitter.hspi_out.tx_req),
+            self.tx_valid_in     .eq(transmitter.hspi_out.tx_valid),
+            self.tx_states_in    .eq(transmitter.states_out),
+            self.tx_truncated_in .eq(transmitter.truncated_out),
+
+            self.rx_act_in       .eq(receiver.hspi_in.rx_act),
+            self.rx_valid_in     .eq(receiver.hspi_in.rx_valid),
+            self.rx_states_in    .eq(receiver.states_out),
+            self.rx_done_in      .eq(receiver.packet_done_out),
+            self.rx_crc_error_in .eq(receiver.crc_error_out),
+            self.rx_words_in     .eq(receiver.num_words_out),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        domain = "sync" if self.domain is None else self.domain
+        sync   = m.d.__getattr__(domain)
+        comb   = m.d.comb
+
+        snapshot = Signal()
+        clear    = Signal()
+
+        if self.read_domain is None or self.read_domain == domain:
+            comb += [
+                snapshot.eq(self.snapshot_in),
+                clear.eq(self.clear_in),
+            ]
+        else:
+            for name, pulse_in, pulse in [("snapshot", self.snapshot_in, snapshot), ("clear", self.clear_in, clear)]:
+                synchronizer = PulseSynchronizer(i_domain=self.read_domain, o_domain=domain)
+                m.submodules[f"{name}_synchronizer"] = synchronizer
+                comb += [
+                    synchronizer.i.eq(pulse_in),
+                    pulse.eq(synchronizer.o),
+                ]
+
+        tx_req_last = Signal()
+        sync += tx_req_last.eq(self.tx_req_in)
+
+        events = [
+            # tx_frames
+            tx_req_last & ~self.tx_req_in,
+            # tx_words
+            self.tx_valid_in,
+            # tx_idle
+            self.tx_req_in & ~self.tx_valid_in,
+            # tx_truncated
+            self.tx_truncated_in,
+            # rx_frames
+            self.rx_done_in,
+            # rx_words
+            self.rx_act_in & self.rx_valid_in,
+            # rx_idle
+            self.rx_act_in & ~self.rx_valid_in,
+            # rx_crc_errors
+            self.rx_done_in & self.rx_crc_error_in,
+            # rx_oversized, num_words_out of the receiver includes the CRC word
+            self.rx_done_in & (self.rx_words_in > 4096 + 1),
+        ]
+        events += list(self.tx_states_in)
+        events += list(self.rx_states_in)
+
+        names    = counter_names()
+        counters = [Signal(self.width, name=name) for name in names]
+        copies   = [Signal(self.width, name=f"{name}_copy") for name in names]
+
+        for event, counter, copy in zip(events, counters, copies):
+            with m.If(clear):
+                sync += counter.eq(0)
+            with m.Elif(event):
+                sync += counter.eq(counter + 1)
+
+            with m.If(snapshot):
+                sync += copy.eq(counter)
+
+        comb += self.value_out.eq(Array(copies)[self.select_in])
+
+        return m
+
+from amaranth.sim import Passive
+from amlib.test   import GatewareTestCase, sync_test_case
+
+class _CountedLink(Elaboratable):
+    """ a transmitter sending to a receiver, with the counters on both of them,
+        read from the usb domain
+    """
+    def __init__(self, streaming=False):
+        self.tx       = HSPITransmitter(max_frame_words=16, streaming=streaming)
+        self.rx       = HSPIReceiver()
+        self.counters = HSPILinkCounters(read_domain="usb")
+        self.corrupt  = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.tx       = tx       = self.tx
+        m.submodules.rx       = rx       = self.rx
+        m.submodules.counters = counters = self.counters
+
+        m.d.comb += [
+            rx.hspi_in.rx_act   .eq(tx.hspi_out.tx_req),
+            rx.hspi_in.rx_valid .eq(tx.hspi_out.tx_valid),
+            rx.hspi_in.hd.i     .eq(tx.hspi_out.hd.o ^ (self.corrupt & tx.hspi_out.tx_valid)),
+            tx.hspi_out.tx_ready.eq(rx.hspi_in.tx_ack),
+
+            *counters.connect(tx, rx),
+        ]
+
+        return m
+
+class HSPILinkCountersTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = _CountedLink
+    FRAGMENT_ARGUMENTS  = dict()
+
+    def setUp(self):
+        super().setUp()
+        self.sent    = False
+        self.cleared = False
+        self.values  = None
+        self.sim.add_sync_process(self.reader, domain="usb")
+
+    def reader(self):
+        """ reads all counters, clears them, and reads them again, like the host would """
+        yield Passive()
+        counters = self.dut.counters
+        while not self.sent:
+            yield
+        self.values = yield from self.read_counters()
+        while not self.cleared:
+            yield
+        yield counters.clear_in.eq(1)
+        yield
+        yield counters.clear_in.eq(0)
+        yield from self.advance_cycles(8)
+        self.values = yield from self.read_counters()
+
+    def read_counters(self):
+        counters = self.dut.counters
+        yield counters.snapshot_in.eq(1)
+        yield
+        yield counters.snapshot_in.eq(0)
+        yield from self.advance_cycles(8)
+        values = {}
+        for n, name in enumerate(counter_names()):
+            yield counters.select_in.eq(n)
+            yield
+            values[name] = yield counters.value_out
+        return values
+
+    def send(self, packets):
+        dut    = self.dut
+        stream = dut.tx.stream_in
+        for n, packet in enumerate(packets):
+            yield dut.corrupt.eq(n == 1)
+            for i, word in enumerate(packet):
+                yield stream.valid.eq(1)
+                yield stream.first.eq(i == 0)
+                yield stream.last.eq(i == len(packet) - 1)
+                yield stream.payload.eq(word)
+                yield
+                while not (yield stream.ready):
+                    yield
+            yield stream.valid.eq(0)
+            yield from self.advance_cycles(20)
+        yield dut.corrupt.eq(0)
+
+    @sync_test_case
+    def test_counters(self):
+        dut = self.dut
+        yield dut.tx.tll_2b_in.eq(0b11)
+        yield dut.tx.user_id0_in.eq(0x3abcdef)
+        yield dut.tx.user_id1_in.eq(0x3456789)
+
+        # the second packet gets corrupted, the third one is too long
+        packets = [list(range(length)) for length in [3, 16, 20, 1, 8]]
+        yield from self.send(packets)
+        self.sent = True
+        while self.values is None:
+            yield
+
+        values = self.values
+        words  = sum(min(len(packet), 16) + 2 for packet in packets)
+        self.assertEqual(values["tx_frames"],     len(packets))
+        self.assertEqual(values["tx_words"],      words)
+        self.assertEqual(values["tx_truncated"],  1)
+        self.assertEqual(values["rx_frames"],     len(packets))
+        self.assertEqual(values["rx_words"],      words)
+        self.assertEqual(values["rx_crc_errors"], 1)
+        self.assertEqual(values["rx_oversized"],  0)
+        self.assertEqual(values["rx_idle"],       values["tx_idle"])
+        self.assertEqual(sum(values[f"tx_state_{state}"] for state in TX_STATES),
+                         sum(values[f"rx_state_{state}"] for state in RX_STATES))
+
+        # a data word in every cycle of TX_DATA, the rest of the long packet is thrown away in WAIT_LAST
+        streaming = self.FRAGMENT_ARGUMENTS.get("streaming", False)
+        self.assertEqual(values["tx_state_TX_DATA"],    sum(min(len(packet), 16) for packet in packets))
+        self.assertEqual(values["tx_state_WAIT_LAST"],  4)
+        self.assertEqual(values["tx_state_TX_CRC"],     len(packets))
+        # with streaming=True, the header goes out in WAIT_TX_READY
+        self.assertEqual(values["tx_state_TX_HEADER"],  0 if streaming else len(packets))
+        self.assertEqual(values["tx_state_START"],      0 if streaming else len(packets))
+        self.assertEqual(values["tx_state_TX_ACK"],     0)
+        self.assertEqual(values["tx_state_ACK_DONE"],   0)
+        self.assertEqual(values["rx_state_RX"],         values["rx_words"] + values["rx_idle"])
+
+        self.values  = None
+        self.cleared = True
+        while self.values is None:
+            yield
+        self.assertEqual(self.values["tx_frames"], 0)
+        self.assertEqual(self.values["rx_words"],  0)
+
+class HSPILinkCountersStreamingTest(HSPILinkCountersTest):
+    FRAGMENT_ARGUMENTS = dict(streaming=True)
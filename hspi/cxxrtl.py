@@ -0,0 +1,294 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+import ctypes
+import hashlib
+import os
+import subprocess
+import tempfile
+import time
+from pathlib   import Path
+
+from amaranth          import Fragment, Signal, Const
+from amaranth.hdl.ast  import Assign
+from amaranth.back     import rtlil
+from amaranth.sim      import Tick, Settle, Passive, Active
+from amaranth._toolchain.yosys import find_yosys
+
+class _CXXRTLObject(ctypes.Structure):
+    # the first fields of struct cxxrtl_object from cxxrtl_capi.h, which never change
+    _fields_ = [
+        ("type",    ctypes.c_uint32),
+        ("flags",   ctypes.c_uint32),
+        ("width",   ctypes.c_size_t),
+        ("lsb_at",  ctypes.c_size_t),
+        ("depth",   ctypes.c_size_t),
+        ("zero_at", ctypes.c_size_t),
+        ("curr",    ctypes.POINTER(ctypes.c_uint32)),
+        ("next",    ctypes.POINTER(ctypes.c_uint32)),
+        ("outline", ctypes.c_void_p),
+    ]
+
+def _runtime_sources(yosys):
+    """ the include directories and the C API sources of the CXXRTL runtime of yosys """
+    include = Path(yosys.data_dir()) / "include"
+    # since yosys 0.33, the runtime lives in its own directory
+    runtime = include / "backends" / "cxxrtl" / "runtime"
+    if runtime.is_dir():
+        return [include, runtime], [runtime / "cxxrtl" / "capi" / "cxxrtl_capi.cc"]
+    return [include], [include / "backends" / "cxxrtl" / "cxxrtl_capi.cc"]
+
+def signals(record):
+    """ all signals of a record, for the ports of a CXXRTLSimulator """
+    if isinstance(record, Signal):
+        return [record]
+    return [signal for field in record.fields.values() for signal in signals(field)]
+
+class CXXRTLSimulator:
+    """ Runs a design compiled with CXXRTL, driven by the same processes as the Python simulator
+
+        The design is converted with yosys write_cxxrtl and compiled with the C++ compiler
+        in the CXX environment variable, or c++, into a shared library in build_dir,
+        which is reused as long as the design and yosys do not change.
+
+        Like amaranth.sim.Simulator, it takes clocks with add_clock() and processes with
+        add_sync_process(), which can yield the same commands: nothing or Tick() to wait for
+        the next clock edge, a signal to read it, an assignment of a constant to a signal
+        to write it, Settle(), Passive() and Active(). Just like in the Python simulator,
+        after a clock edge, processes read the values from before it, and their writes
+        take effect after it. The processes can only read and write the signals in ports
+        and the clocks, because everything else may have been optimized away.
+
+        run() returns when all processes which are not passive are done.
+        cycles holds the number of cycles of each clock domain so far,
+        and cycles_per_second() the number of cycles of domain simulated per second of run().
+    """
+    def __init__(self, elaboratable, *, ports, build_dir=None):
+        fragment = Fragment.get(elaboratable, platform=None).prepare(ports=ports)
+        rtlil_source, name_map = rtlil.convert_fragment(fragment)
+
+        self._library = self._compile(rtlil_source, build_dir)
+        self._library.cxxrtl_design_create.restype = ctypes.c_void_p
+        self._library.cxxrtl_create.restype        = ctypes.c_void_p
+        self._library.cxxrtl_create.argtypes       = [ctypes.c_void_p]
+        self._library.cxxrtl_destroy.argtypes      = [ctypes.c_void_p]
+        self._library.cxxrtl_step.argtypes         = [ctypes.c_void_p]
+        self._library.cxxrtl_get_parts.restype     = ctypes.POINTER(_CXXRTLObject)
+        self._library.cxxrtl_get_parts.argtypes    = \
+            [ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t)]
+        self._library.cxxrtl_outline_eval.argtypes = [ctypes.c_void_p]
+
+        self._handle   = self._library.cxxrtl_create(self._library.cxxrtl_design_create())
+        self._name_map = name_map
+        self._domains  = fragment.domains
+        # the objects of the signals, by id() instead of the signal, which is much faster
+        self._objects  = {}
+
+        self._clocks    = {}
+        self._processes = []
+        self._writes    = []
+        self.cycles     = {}
+        self._elapsed   = 0.0
+
+    def __del__(self):
+        if getattr(self, "_handle", None):
+            self._library.cxxrtl_destroy(self._handle)
+
+    @staticmethod
+    def _compile(rtlil_source, build_dir):
+        yosys = find_yosys(lambda version: version >= (0, 10))
+
+        build_dir = Path(tempfile.gettempdir() if build_dir is None else build_dir)
+        build_dir.mkdir(parents=True, exist_ok=True)
+        digest  = hashlib.sha1(f"{yosys.version()}\n{rtlil_source}".encode()).hexdigest()[:16]
+        library = build_dir / f"cxxrtl_{digest}.so"
+
+        if not library.exists():
+            includes, sources = _runtime_sources(yosys)
+            # amaranth.back.cxxrtl still uses read_ilang, which newer versions of yosys do not have
+            cxx_source = yosys.run(["-q", "-"], f"read_rtlil <<rtlil\n{rtlil_source}\nrtlil\nwrite_cxxrtl\n")
+            source = build_dir / f"cxxrtl_{digest}.cc"
+            source.write_text(cxx_source)
+            subprocess.run([os.environ.get("CXX", "c++"), "-std=c++14", "-O2", "-shared", "-fPIC",
+                            *(f"-I{include}" for include in includes),
+                            str(source), *map(str, sources), "-o", str(library)],
+                           check=True)
+
+        return ctypes.CDLL(str(library))
+
+    def _object(self, signal):
+        obj = self._objects.get(id(signal))
+        if obj is None:
+            if signal not in self._name_map:
+                raise KeyError(f"{signal!r} is not part of the design, it has to be in ports")
+            name  = " ".join(self._name_map[signal][1:])
+            parts = ctypes.c_size_t()
+            found = self._library.cxxrtl_get_parts(self._handle, name.encode(), ctypes.byref(parts))
+            if not found:
+                raise KeyError(f"{signal!r} was optimized away, it has to be in ports")
+            found = found.contents
+            obj   = self._objects[id(signal)] = \
+                (signal, found.curr, found.next, (found.width + 31) // 32, (1 << found.width) - 1, found.outline)
+        return obj
+
+    def _read(self, signal):
+        _, curr, _, chunks, _, outline = self._object(signal)
+        if outline:
+            self._library.cxxrtl_outline_eval(outline)
+        if chunks == 1:
+            return curr[0]
+        return sum(curr[chunk] << (32 * chunk) for chunk in range(chunks))
+
+    def _write(self, signal, value):
+        _, _, next, chunks, mask, _ = self._object(signal)
+        if not next:
+            raise ValueError(f"{signal!r} is driven by the design and can not be written")
+        value &= mask
+        if chunks == 1:
+            next[0] = value
+            return
+        for chunk in range(chunks):
+            next[chunk] = (value >> (32 * chunk)) & 0xffffffff
+
+    def _step(self):
+        self._library.cxxrtl_step(self._handle)
+
+    def _settle(self):
+        for signal, value in self._writes:
+            self._write(signal, value)
+        self._writes = []
+        self._step()
+
+    def add_clock(self, period, *, phase=None, domain="sync"):
+        """ period and phase in seconds, phase defaults to half a period like in the Python simulator """
+        phase = period / 2 if phase is None else phase
+        # in femtoseconds, so that clocks from the same PLL stay aligned
+        self._clocks[domain] = (round(period * 1e15), round(phase * 1e15))
+        self.cycles[domain]  = 0
+
+    def add_sync_process(self, process, *, domain="sync"):
+        self._processes.append(dict(generator=process(), domain=domain, waiting=None, passive=False))
+
+    def _resume(self, process, value=None):
+        """ runs the process up to its next clock edge, returns False when it is done """
+        generator = process["generator"]
+        while True:
+            try:
+                command = generator.send(value)
+            except StopIteration:
+                return False
+            value = None
+
+            if command is None:
+                process["waiting"] = process["domain"]
+                return True
+            elif isinstance(command, Tick):
+                process["waiting"] = command.domain
+                return True
+            elif isinstance(command, Signal):
+                value = self._read(command)
+            elif isinstance(command, Assign):
+                if not isinstance(command.lhs, Signal) or not isinstance(command.rhs, Const):
+                    raise TypeError(f"only constants can be assigned to signals, not {command!r}")
+                self._writes.append((command.lhs, command.rhs.value))
+            elif isinstance(command, Settle):
+                self._settle()
+            elif isinstance(command, Passive):
+                process["passive"] = True
+            elif isinstance(command, Active):
+                process["passive"] = False
+            else:
+                raise TypeError(f"the CXXRTL simulator does not support the command {command!r}")
+
+    def run(self):
+        start = time.perf_counter()
+
+        self._step()
+        self._processes = [process for process in self._processes if self._resume(process)]
+        self._settle()
+
+        # the time of the next rising edge of every clock
+        edges = {domain: phase for domain, (period, phase) in self._clocks.items()}
+
+        while any(not process["passive"] for process in self._processes):
+            now     = min(edges.values())
+            domains = [domain for domain, edge in edges.items() if edge == now]
+
+            # the processes see the values from before the edge
+            running = []
+            for process in self._processes:
+                if process["waiting"] in domains and not self._resume(process):
+                    continue
+                running.append(process)
+            self._processes = running
+
+            for domain in domains:
+                self._write(self._domains[domain].clk, 1)
+                self.cycles[domain] += 1
+            self._step()
+
+            # the falling edge goes together with the writes,
+            # which does no harm since all domains are clocked on the rising edge
+            for domain in domains:
+                self._write(self._domains[domain].clk, 0)
+                edges[domain] += self._clocks[domain][0]
+            self._settle()
+
+        self._elapsed += time.perf_counter() - start
+
+    def cycles_per_second(self, domain="sync"):
+        return self.cycles[domain] / self._elapsed if self._elapsed else 0.0
+
+import random
+import shutil
+import unittest
+
+from amaranth.sim import Simulator
+
+from .bfm      import HSPIBusFunctionalModel
+from .loopback import HSPILoopback
+
+def _have_toolchain():
+    try:
+        find_yosys(lambda version: version >= (0, 10))
+    except Exception:
+        return False
+    return shutil.which(os.environ.get("CXX", "c++")) is not None
+
+@unittest.skipUnless(_have_toolchain(), "needs yosys and a C++ compiler")
+class CXXRTLSimulatorTest(unittest.TestCase):
+    """ runs the same loopback test on both simulators, which have to agree to the cycle """
+    PAYLOADS = [list(range(n, 2 * n)) for n in [1, 7, 0x40, 3, 0x21]]
+
+    def run_loopback(self, simulator):
+        dut = HSPILoopback(depth=256, streaming=True)
+        bfm = HSPIBusFunctionalModel(dut.hspi, rng=random.Random(0), valid_gap=0.1,
+                                     frame_gap=(0, 8), ready_delay=(0, 3), release_delay=(0, 2))
+        sim = simulator(dut, ports=signals(dut.hspi))
+        sim.add_clock(1e-8, domain="sync")
+
+        def run_bfm():
+            yield Passive()
+            yield from bfm.process()
+
+        # queued up front, so that it does not matter which process runs first
+        for payload in self.PAYLOADS:
+            bfm.send(payload)
+            bfm.expect(payload)
+
+        def stimulus():
+            while not bfm.idle:
+                yield
+
+        sim.add_sync_process(run_bfm, domain="sync")
+        sim.add_sync_process(stimulus, domain="sync")
+        sim.run()
+        return bfm
+
+    def test_loopback(self):
+        python = self.run_loopback(lambda dut, ports: Simulator(dut))
+        cxxrtl = self.run_loopback(CXXRTLSimulator)
+
+        self.assertEqual([frame.payload for frame in cxxrtl.received], self.PAYLOADS)
+        # the frames carry the cycles in which they started and ended
+        self.assertEqual(cxxrtl.received, python.received)
@@ -0,0 +1,180 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+import random
+
+from amaranth import *
+
+from amlib.stream import StreamInterface
+
+from .buffers import HSPIPacketBuffer
+
+class HSPIDemultiplexer(Elaboratable):
+    """ Distributes the frames of a HSPIReceiver to several output streams
+
+        table has one (value, mask) pair per output stream. A frame goes to the first
+        output for which the bits in mask of its header match value. The header is
+        laid out like on the bus: user data in bits 0 to 25, sequence number in bits 26 to 29,
+        TLL in bits 30 and 31. Frames which match nothing are dropped and counted
+        in unmatched_out.
+
+        Every output has its own HSPIPacketBuffer of depth words, so that a slow consumer
+        only holds up its own frames, and only frames with a correct CRC come out.
+        If the buffer of an output is full, the frames for it are dropped.
+    """
+    def __init__(self, *, table, depth=4096, max_frames=16):
+        if not table:
+            raise ValueError("the table of the demultiplexer needs at least one entry")
+
+        self.stream_in      = StreamInterface(name="demux_in", payload_width=32, extra_fields=[("crc_error", 1)])
+        self.user_data_in   = Signal(26)
+        self.sequence_nr_in = Signal(4)
+        self.tll_2b_in      = Signal(2)
+
+        self.buffers     = [HSPIPacketBuffer(depth=depth, max_frames=max_frames) for _ in table]
+        self.streams_out = [buffer.stream_out for buffer in self.buffers]
+
+        self.unmatched_out = Signal(16)
+
+        self.table = table
+
+    def connect_to_receiver(self, receiver):
+        stream = receiver.stream_out
+
+        return [
+            self.stream_in.payload   .eq(stream.payload),
+            self.stream_in.valid     .eq(stream.valid),
+            self.stream_in.first     .eq(stream.first),
+            self.stream_in.last      .eq(stream.last),
+            self.stream_in.crc_error .eq(stream.crc_error),
+
+            self.user_data_in   .eq(receiver.user_data_out),
+            self.sequence_nr_in .eq(receiver.sequence_nr_out),
+            self.tll_2b_in      .eq(receiver.tll_2b_out),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        comb = m.d.comb
+        sync = m.d.sync
+
+        stream_in = self.stream_in
+        outputs   = len(self.table)
+
+        for n, buffer in enumerate(self.buffers):
+            m.submodules[f"buffer{n}"] = buffer
+
+        header = Signal(32)
+        comb += header.eq(Cat(self.user_data_in, self.sequence_nr_in, self.tll_2b_in))
+
+        # the header fields could already belong to the next frame at the end of this one,
+        # so the output is chosen at the first word
+        in_frame    = Signal()
+        frame_route = Signal(range(outputs + 1))
+        route       = Signal.like(frame_route)
+        match       = Signal.like(frame_route)
+
+        comb += match.eq(outputs)
+        for n, (value, mask) in reversed(list(enumerate(self.table))):
+            with m.If((header & mask) == (value & mask)):
+                comb += match.eq(n)
+
+        comb += route.eq(Mux(in_frame, frame_route, match))
+
+        with m.If(stream_in.valid):
+            sync += [
+                in_frame.eq(1),
+                frame_route.eq(route),
+            ]
+        with m.If(stream_in.last):
+            sync += in_frame.eq(0)
+            with m.If(route == outputs):
+                sync += self.unmatched_out.eq(self.unmatched_out + 1)
+
+        for n, buffer in enumerate(self.buffers):
+            selected = route == n
+            comb += [
+                buffer.stream_in.payload   .eq(stream_in.payload),
+                buffer.stream_in.valid     .eq(stream_in.valid & selected),
+                buffer.stream_in.first     .eq(stream_in.first & selected),
+                buffer.stream_in.last      .eq(stream_in.last & selected),
+                buffer.stream_in.crc_error .eq(stream_in.crc_error),
+            ]
+
+        return m
+
+from amaranth.sim import Passive
+from amlib.test   import GatewareTestCase, sync_test_case
+
+class HSPIDemultiplexerTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPIDemultiplexer
+    FRAGMENT_ARGUMENTS  = dict(depth=64, table=[
+        # control frames with TLL 0
+        (0b00 << 30, 0b11 << 30),
+        # bulk frames with user id 0x3abcdef
+        (0x3abcdef,  0x3ffffff),
+    ])
+
+    def setUp(self):
+        super().setUp()
+        self.rng      = random.Random(0)
+        self.received = [[], []]
+        # the consumer of the control frames only starts late
+        self.sim.add_sync_process(self.collect(0, start=400))
+        self.sim.add_sync_process(self.collect(1, start=0))
+
+    def collect(self, output, *, start):
+        def process():
+            yield Passive()
+            stream = self.dut.streams_out[output]
+            yield from self.advance_cycles(start)
+            while True:
+                ready = self.rng.random() < 0.7
+                yield stream.ready.eq(ready)
+                yield
+                if ready and (yield stream.valid):
+                    if (yield stream.first):
+                        self.received[output].append([])
+                    self.received[output][-1].append((yield stream.payload))
+        return process
+
+    def send_frame(self, tll, user_data, payload, crc_error=False):
+        dut = self.dut
+        yield dut.tll_2b_in.eq(tll)
+        yield dut.user_data_in.eq(user_data)
+        yield from self.advance_cycles(2)
+        for i, word in enumerate(payload):
+            yield dut.stream_in.valid.eq(1)
+            yield dut.stream_in.first.eq(i == 0)
+            yield dut.stream_in.last.eq(i == len(payload) - 1)
+            yield dut.stream_in.crc_error.eq(crc_error and i == len(payload) - 1)
+            yield dut.stream_in.payload.eq(word)
+            yield
+        yield dut.stream_in.valid.eq(0)
+        yield dut.stream_in.last.eq(0)
+        yield dut.stream_in.crc_error.eq(0)
+        # the next header comes before the end of this frame is through
+        yield dut.user_data_in.eq(0)
+        yield dut.tll_2b_in.eq(0b11)
+        yield from self.advance_cycles(3)
+
+    @sync_test_case
+    def test_demultiplexer(self):
+        dut     = self.dut
+        control = [[0xc0 + n, n] for n in range(4)]
+        bulk    = [list(range(n << 8, (n << 8) + 24)) for n in range(8)]
+
+        for n, frame in enumerate(bulk):
+            yield from self.send_frame(0b11, 0x3abcdef, frame)
+            if n % 2:
+                yield from self.send_frame(0b00, 0x1234, control[n // 2])
+            if n == 3:
+                yield from self.send_frame(0b11, 0x3abcdef, [0xbad] * 4, crc_error=True)
+                yield from self.send_frame(0b01, 0x3333, [0xdead])
+
+        yield from self.advance_cycles(400)
+
+        # the bulk frames went through although nobody took the control frames
+        self.assertEqual(self.received, [control, bulk])
+        self.assertEqual((yield dut.unmatched_out), 1)
+        self.assertEqual((yield self.dut.buffers[1].dropped_crc_out), 1)
@@ -0,0 +1,665 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+import random
+
+from amaranth          import *
+from amaranth.lib.fifo import SyncFIFO, SyncFIFOBuffered
+from amaranth.hdl.rec  import DIR_FANIN, DIR_FANOUT
+
+from amlib.stream import StreamInterface
+
+# cycle type identifiers of Wishbone B4 registered feedback bursts
+CTI_CLASSIC = 0b000
+CTI_INCR    = 0b010
+CTI_END     = 0b111
+
+# words per descriptor in the descriptor rings
+DESCRIPTOR_WORDS = 4
+
+class WishboneInterface(Record):
+    """ Record that represents a 32 bit Wishbone B4 bus with word addresses, seen from the master """
+
+    LAYOUT = [
+        ("adr",   30, DIR_FANOUT),
+        ("dat_w", 32, DIR_FANOUT),
+        ("dat_r", 32, DIR_FANIN),
+        ("sel",    4, DIR_FANOUT),
+        ("cyc",    1, DIR_FANOUT),
+        ("stb",    1, DIR_FANOUT),
+        ("we",     1, DIR_FANOUT),
+        ("ack",    1, DIR_FANIN),
+        ("cti",    3, DIR_FANOUT),
+        ("bte",    2, DIR_FANOUT),
+    ]
+
+    def __init__(self, name=None):
+        super().__init__(self.LAYOUT, name=name)
+
+class HSPITransmitDMA(Elaboratable):
+    """ Reads the frames for a HSPITransmitter from memory
+
+        The frames to send are described in a ring of ring_size descriptors starting
+        at the word address ring_base_in. Each descriptor has DESCRIPTOR_WORDS words:
+        the word address of the payload, its length in words (1 to 4096),
+        and the header word of the frame, laid out like on the bus.
+        The last word is not used.
+
+        Software puts descriptors into the ring and then moves head_in past them.
+        tail_out is the index of the next descriptor to read. When it has moved past
+        a descriptor, the payload has been read completely and the buffer can be reused.
+        Since head_in == tail_out means that the ring is empty,
+        at most ring_size - 1 descriptors can be pending.
+
+        The payload is read from bus in incrementing bursts of up to burst words,
+        into a FIFO of fifo_depth words which feeds stream_out. A burst is only started
+        when it fits into the FIFO, so that the bus is never stalled by the transmitter.
+        The header fields of the frame at the head of stream_out are on
+        user_id_out, sequence_nr_out and tll_2b_out.
+
+        Descriptors with a length of 0 or of more than 4096 words are skipped without
+        sending anything, and counted in skipped_out.
+    """
+    def __init__(self, *, ring_size=16, burst=16, fifo_depth=64):
+        if ring_size & (ring_size - 1) or ring_size < 2:
+            raise ValueError(f"ring_size must be a power of two of at least 2, not {ring_size}")
+        if not 0 < burst <= fifo_depth:
+            raise ValueError(f"burst must be between 1 and the fifo_depth of {fifo_depth}, not {burst}")
+
+        self.bus          = WishboneInterface(name="tx_dma")
+        self.ring_base_in = Signal(30)
+        self.head_in      = Signal(range(ring_size))
+        self.tail_out     = Signal(range(ring_size))
+
+        self.stream_out      = StreamInterface(name="tx_dma_out", payload_width=32)
+        self.user_id_out     = Signal(26)
+        self.sequence_nr_out = Signal(4)
+        self.tll_2b_out      = Signal(2)
+
+        self.frames_out  = Signal(32)
+        self.skipped_out = Signal(16)
+
+        self.ring_size  = ring_size
+        self.burst      = burst
+        self.fifo_depth = fifo_depth
+
+    def connect_to_transmitter(self, transmitter):
+        return [
+            transmitter.stream_in.stream_eq(self.stream_out),
+            transmitter.user_id0_in    .eq(self.user_id_out),
+            transmitter.user_id1_in    .eq(self.user_id_out),
+            transmitter.sequence_nr_in .eq(self.sequence_nr_out),
+            transmitter.tll_2b_in      .eq(self.tll_2b_out),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        comb = m.d.comb
+        sync = m.d.sync
+
+        bus        = self.bus
+        stream_out = self.stream_out
+        tail       = self.tail_out
+
+        # payload with first and last, and the headers of the frames in it
+        m.submodules.fifo    = fifo    = SyncFIFOBuffered(width=34, depth=self.fifo_depth)
+        m.submodules.headers = headers = SyncFIFO(width=32, depth=4)
+
+        address    = Signal(30)
+        remaining  = Signal(13)
+        length     = Signal(13)
+        header     = Signal(32)
+        index      = Signal(2)
+        skip       = Signal()
+        burst_left = Signal(range(self.burst + 1))
+        burst_len  = Signal.like(burst_left)
+
+        comb += [
+            bus.sel.eq(0b1111),
+            bus.we.eq(0),
+            bus.bte.eq(0),
+
+            burst_len.eq(Mux(remaining < self.burst, remaining, self.burst)),
+            fifo.w_data.eq(Cat(bus.dat_r, remaining == length, remaining == 1)),
+
+            stream_out.valid   .eq(fifo.r_rdy & headers.r_rdy),
+            stream_out.payload .eq(fifo.r_data[:32]),
+            stream_out.first   .eq(fifo.r_data[32]),
+            stream_out.last    .eq(fifo.r_data[33]),
+            fifo.r_en          .eq(stream_out.ready & headers.r_rdy),
+
+            Cat(self.user_id_out, self.sequence_nr_out, self.tll_2b_out).eq(headers.r_data),
+            headers.r_en.eq(stream_out.valid & stream_out.ready & stream_out.last),
+            headers.w_data.eq(header),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If((self.head_in != tail) & headers.w_rdy):
+                    sync += [
+                        bus.adr.eq(self.ring_base_in + tail * DESCRIPTOR_WORDS),
+                        bus.cyc.eq(1),
+                        bus.stb.eq(1),
+                        bus.cti.eq(CTI_INCR),
+                        index.eq(0),
+                    ]
+                    m.next = "DESCRIPTOR"
+
+            with m.State("DESCRIPTOR"):
+                with m.If(bus.ack):
+                    sync += [
+                        bus.adr.eq(bus.adr + 1),
+                        index.eq(index + 1),
+                    ]
+                    with m.Switch(index):
+                        with m.Case(0):
+                            sync += address.eq(bus.dat_r)
+                        with m.Case(1):
+                            sync += [
+                                length.eq(bus.dat_r),
+                                remaining.eq(bus.dat_r),
+                                skip.eq((bus.dat_r == 0) | (bus.dat_r > 4096)),
+                                bus.cti.eq(CTI_END),
+                            ]
+                        with m.Case(2):
+                            sync += [
+                                header.eq(bus.dat_r),
+                                bus.cyc.eq(0),
+                                bus.stb.eq(0),
+                            ]
+                            with m.If(skip):
+                                sync += [
+                                    tail.eq(tail + 1),
+                                    self.skipped_out.eq(self.skipped_out + 1),
+                                ]
+                                m.next = "IDLE"
+                            with m.Else():
+                                m.next = "HEADER"
+
+            with m.State("HEADER"):
+                comb += headers.w_en.eq(1)
+                m.next = "PAYLOAD"
+
+            with m.State("PAYLOAD"):
+                with m.If(self.fifo_depth - fifo.w_level >= burst_len):
+                    sync += [
+                        bus.adr.eq(address),
+                        bus.cyc.eq(1),
+                        bus.stb.eq(1),
+                        bus.cti.eq(Mux(burst_len == 1, CTI_END, CTI_INCR)),
+                        burst_left.eq(burst_len),
+                    ]
+                    m.next = "BURST"
+
+            with m.State("BURST"):
+                comb += fifo.w_en.eq(bus.ack)
+
+                with m.If(bus.ack):
+                    sync += [
+                        bus.adr.eq(bus.adr + 1),
+                        address.eq(address + 1),
+                        remaining.eq(remaining - 1),
+                        burst_left.eq(burst_left - 1),
+                    ]
+                    with m.If(burst_left == 2):
+                        sync += bus.cti.eq(CTI_END)
+                    with m.If(burst_left == 1):
+                        sync += [
+                            bus.cyc.eq(0),
+                            bus.stb.eq(0),
+                        ]
+                        with m.If(remaining == 1):
+                            sync += [
+                                tail.eq(tail + 1),
+                                self.frames_out.eq(self.frames_out + 1),
+                            ]
+                            m.next = "IDLE"
+                        with m.Else():
+                            m.next = "PAYLOAD"
+
+        return m
+
+class HSPIReceiveDMA(Elaboratable):
+    """ Writes the frames of a HSPIReceiver into memory
+
+        The payload of the frames goes into a ring of data_size words starting at the
+        word address data_base_in, one frame after the other, wrapping around at its end.
+        For each frame, a completion descriptor is then written into a ring of ring_size
+        descriptors starting at the word address ring_base_in. Each descriptor has
+        DESCRIPTOR_WORDS words: the word address of the payload, its length in words with
+        bit 30 set if the frame was truncated and bit 31 set if it had a CRC error,
+        the header word of the frame, laid out like on the bus,
+        and the number of the frame, counting from 1.
+
+        data_head_out and ring_head_out are the offset of the next word and the index
+        of the next descriptor to write. Software moves data_tail_in and ring_tail_in
+        past the data and descriptors it is done with. As in the descriptor ring
+        of HSPITransmitDMA, one entry of each ring always stays empty, so data_size
+        has to be bigger than max_frame_words.
+
+        Since the receiver can not be stalled, the payload goes through a FIFO of fifo_depth
+        words, which is written to memory in incrementing bursts of up to burst words.
+        When the data ring is full, the FIFO fills up, and the words of a frame which
+        do not fit into it any more are thrown away, as are those beyond max_frame_words,
+        and the frame is marked as truncated. When max_frames frames are waiting for their
+        descriptor to be written, further frames are dropped completely and counted in dropped_out.
+    """
+    def __init__(self, *, data_size=8192, ring_size=16, burst=16, fifo_depth=64, max_frames=8, max_frame_words=4096):
+        for name, size in (("data_size", data_size), ("ring_size", ring_size)):
+            if size & (size - 1) or size < 2:
+                raise ValueError(f"{name} must be a power of two of at least 2, not {size}")
+        if data_size <= max_frame_words:
+            raise ValueError(f"data_size must be bigger than max_frame_words, which is {max_frame_words}")
+        if not 0 < burst <= fifo_depth:
+            raise ValueError(f"burst must be between 1 and the fifo_depth of {fifo_depth}, not {burst}")
+
+        self.bus           = WishboneInterface(name="rx_dma")
+        self.data_base_in  = Signal(30)
+        self.data_tail_in  = Signal(range(data_size))
+        self.data_head_out = Signal(range(data_size))
+        self.ring_base_in  = Signal(30)
+        self.ring_tail_in  = Signal(range(ring_size))
+        self.ring_head_out = Signal(range(ring_size))
+
+        self.stream_in      = StreamInterface(name="rx_dma_in", payload_width=32, extra_fields=[("crc_error", 1)])
+        self.user_data_in   = Signal(26)
+        self.sequence_nr_in = Signal(4)
+        self.tll_2b_in      = Signal(2)
+
+        self.frames_out    = Signal(32)
+        self.truncated_out = Signal(16)
+        self.dropped_out   = Signal(16)
+
+        self.data_size       = data_size
+        self.ring_size       = ring_size
+        self.burst           = burst
+        self.fifo_depth      = fifo_depth
+        self.max_frames      = max_frames
+        self.max_frame_words = max_frame_words
+
+    def connect_to_receiver(self, receiver):
+        stream = receiver.stream_out
+
+        return [
+            self.stream_in.payload   .eq(stream.payload),
+            self.stream_in.valid     .eq(stream.valid),
+            self.stream_in.first     .eq(stream.first),
+            self.stream_in.last      .eq(stream.last),
+            self.stream_in.crc_error .eq(stream.crc_error),
+
+            self.user_data_in   .eq(receiver.user_data_out),
+            self.sequence_nr_in .eq(receiver.sequence_nr_out),
+            self.tll_2b_in      .eq(receiver.tll_2b_out),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        comb = m.d.comb
+        sync = m.d.sync
+
+        bus       = self.bus
+        stream_in = self.stream_in
+        data_head = self.data_head_out
+        ring_head = self.ring_head_out
+
+        # the payload, and the header, length, truncation and CRC status of each frame
+        m.submodules.fifo   = fifo   = SyncFIFOBuffered(width=32, depth=self.fifo_depth)
+        m.submodules.frames = frames = SyncFIFO(width=32 + 13 + 2, depth=self.max_frames)
+
+        #
+        # take the frames from the receiver
+        #
+        in_frame    = Signal()
+        dropping    = Signal()
+        truncated   = Signal()
+        length      = Signal(range(self.max_frame_words + 1))
+        header      = Signal(32)
+
+        keep        = Signal()
+        write_word  = Signal()
+        refuse_word = Signal()
+        frame_words = Signal(13)
+
+        comb += [
+            # the header fields could already belong to the next frame at the end of this one
+            keep.eq(Mux(in_frame, ~dropping, frames.w_rdy)),
+            refuse_word.eq(stream_in.valid & keep & (truncated | ~fifo.w_rdy | (length == self.max_frame_words))),
+            write_word.eq(stream_in.valid & keep & ~refuse_word),
+
+            fifo.w_data.eq(stream_in.payload),
+            fifo.w_en.eq(write_word),
+
+            frame_words.eq(length + write_word),
+            frames.w_data.eq(Cat(
+                Mux(in_frame, header, Cat(self.user_data_in, self.sequence_nr_in, self.tll_2b_in)),
+                frame_words,
+                truncated | refuse_word,
+                stream_in.crc_error)),
+        ]
+
+        with m.If(stream_in.last):
+            with m.If(in_frame | stream_in.valid):
+                with m.If(keep):
+                    comb += frames.w_en.eq(1)
+                    with m.If(truncated | refuse_word):
+                        sync += self.truncated_out.eq(self.truncated_out + 1)
+                with m.Else():
+                    sync += self.dropped_out.eq(self.dropped_out + 1)
+
+            sync += [
+                in_frame.eq(0),
+                dropping.eq(0),
+                truncated.eq(0),
+                length.eq(0),
+            ]
+
+        with m.Elif(stream_in.valid):
+            sync += [
+                in_frame.eq(1),
+                dropping.eq(~keep),
+                length.eq(length + write_word),
+            ]
+            with m.If(~in_frame):
+                sync += header.eq(Cat(self.user_data_in, self.sequence_nr_in, self.tll_2b_in))
+            with m.If(refuse_word):
+                sync += truncated.eq(1)
+
+        #
+        # write them to memory
+        #
+        frame_header    = frames.r_data[:32]
+        frame_length    = frames.r_data[32:45]
+        frame_status    = frames.r_data[45:]
+
+        # words written to memory for which no descriptor has been written yet,
+        # and where the first of them is
+        unreported      = Signal(range(self.data_size + 1))
+        frame_start     = Signal.like(data_head)
+
+        data_space      = Signal.like(data_head)
+        burst_len       = Signal(range(self.burst + 1))
+        burst_left      = Signal.like(burst_len)
+        index           = Signal(2)
+        completion_word = Signal(32)
+
+        def minimum(*values):
+            result = values[0]
+            for value in values[1:]:
+                result = Mux(value < result, value, result)
+            return result
+
+        comb += [
+            bus.sel.eq(0b1111),
+            bus.bte.eq(0),
+
+            data_space.eq(self.data_tail_in - data_head - 1),
+            burst_len.eq(minimum(self.burst, fifo.r_level, data_space, self.data_size - data_head)),
+
+            completion_word.eq(Array([
+                self.data_base_in + frame_start,
+                Cat(frame_length, Const(0, 17), frame_status),
+                frame_header,
+                self.frames_out + 1,
+            ])[index]),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(frames.r_rdy & (unreported >= frame_length) &
+                          ((ring_head + 1)[:len(ring_head)] != self.ring_tail_in)):
+                    sync += [
+                        bus.adr.eq(self.ring_base_in + ring_head * DESCRIPTOR_WORDS),
+                        bus.cyc.eq(1),
+                        bus.stb.eq(1),
+                        bus.we.eq(1),
+                        bus.cti.eq(CTI_INCR),
+                        index.eq(0),
+                    ]
+                    m.next = "COMPLETION"
+                with m.Elif(burst_len != 0):
+                    sync += [
+                        bus.adr.eq(self.data_base_in + data_head),
+                        bus.cyc.eq(1),
+                        bus.stb.eq(1),
+                        bus.we.eq(1),
+                        bus.cti.eq(Mux(burst_len == 1, CTI_END, CTI_INCR)),
+                        burst_left.eq(burst_len),
+                    ]
+                    m.next = "DATA"
+
+            with m.State("COMPLETION"):
+                comb += bus.dat_w.eq(completion_word)
+
+                with m.If(bus.ack):
+                    sync += [
+                        bus.adr.eq(bus.adr + 1),
+                        index.eq(index + 1),
+                    ]
+                    with m.If(index == 2):
+                        sync += bus.cti.eq(CTI_END)
+                    with m.If(index == 3):
+                        comb += frames.r_en.eq(1)
+                        sync += [
+                            bus.cyc.eq(0),
+                            bus.stb.eq(0),
+                            bus.we.eq(0),
+                            ring_head.eq(ring_head + 1),
+                            frame_start.eq(frame_start + frame_length),
+                            unreported.eq(unreported - frame_length),
+                            self.frames_out.eq(self.frames_out + 1),
+                        ]
+                        m.next = "IDLE"
+
+            with m.State("DATA"):
+                comb += [
+                    bus.dat_w.eq(fifo.r_data),
+                    fifo.r_en.eq(bus.ack),
+                ]
+
+                with m.If(bus.ack):
+                    sync += [
+                        bus.adr.eq(bus.adr + 1),
+                        data_head.eq(data_head + 1),
+                        unreported.eq(unreported + 1),
+                        burst_left.eq(burst_left - 1),
+                    ]
+                    with m.If(burst_left == 2):
+                        sync += bus.cti.eq(CTI_END)
+                    with m.If(burst_left == 1):
+                        sync += [
+                            bus.cyc.eq(0),
+                            bus.stb.eq(0),
+                            bus.we.eq(0),
+                        ]
+                        m.next = "IDLE"
+
+        return m
+
+from amaranth.sim import Passive
+from amlib.test   import GatewareTestCase, sync_test_case
+
+def wishbone_memory(bus, memory, rng, wait=0.3):
+    """ simulation model of a memory with registered feedback on bus,
+        which inserts wait states with the probability wait
+
+        The values read after a clock edge are the ones from before it,
+        so the model acks in the cycle after the request, or right away
+        for the next word of an incrementing burst.
+    """
+    def process():
+        yield Passive()
+        ack = False
+        while True:
+            yield
+            request = (yield bus.cyc) and (yield bus.stb)
+            address = yield bus.adr
+            if ack and (yield bus.we):
+                memory[address] = yield bus.dat_w
+
+            if ack and (yield bus.cti) == CTI_INCR:
+                address += 1
+            elif not request or ack:
+                address = None
+
+            ack = address is not None and rng.random() >= wait
+            if ack and not (yield bus.we):
+                yield bus.dat_r.eq(memory.get(address, 0))
+            yield bus.ack.eq(ack)
+    return process
+
+class HSPITransmitDMATest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPITransmitDMA
+    FRAGMENT_ARGUMENTS  = dict(ring_size=4, burst=8, fifo_depth=16)
+
+    RING_BASE = 0x100
+
+    def setUp(self):
+        super().setUp()
+        self.rng      = random.Random(0)
+        self.memory   = {}
+        self.received = []
+        self.sim.add_sync_process(wishbone_memory(self.dut.bus, self.memory, self.rng))
+        self.sim.add_sync_process(self.sink)
+
+    def sink(self):
+        yield Passive()
+        dut    = self.dut
+        stream = dut.stream_out
+        while True:
+            ready = self.rng.random() < 0.8
+            yield stream.ready.eq(ready)
+            yield
+            if ready and (yield stream.valid):
+                if (yield stream.first):
+                    header = (yield dut.user_id_out) | (yield dut.sequence_nr_out) << 26 | (yield dut.tll_2b_out) << 30
+                    self.received.append((header, []))
+                self.received[-1][1].append((yield stream.payload))
+
+    @sync_test_case
+    def test_transmit_dma(self):
+        dut  = self.dut
+        yield dut.ring_base_in.eq(self.RING_BASE)
+
+        frames = []
+        for n in range(12):
+            address = 0x1000 * (n + 1)
+            payload = [self.rng.getrandbits(32) for _ in range(self.rng.choice([1, 2, 7, 8, 9, 30]))]
+            header  = 0xc0000000 | n << 26 | (0x3abcdef - n)
+            for i, word in enumerate(payload):
+                self.memory[address + i] = word
+            # descriptors which have to be skipped, with the payload of a frame behind them
+            length = {3: 0, 7: 0x10000 + len(payload), 8: 4097}.get(n, len(payload))
+
+            # wait for a free slot in the ring
+            while ((yield dut.tail_out) - (yield dut.head_in) - 1) % 4 == 0:
+                yield
+            slot = self.RING_BASE + (yield dut.head_in) * DESCRIPTOR_WORDS
+            self.memory[slot]     = address
+            self.memory[slot + 1] = length
+            self.memory[slot + 2] = header
+            yield dut.head_in.eq(((yield dut.head_in) + 1) % 4)
+            yield
+            if length == len(payload):
+                frames.append((header, payload))
+
+        while (yield dut.frames_out) != len(frames) or (yield dut.tail_out) != (yield dut.head_in):
+            yield
+        yield from self.advance_cycles(100)
+
+        self.assertEqual(self.received, frames)
+        self.assertEqual((yield dut.skipped_out), 3)
+
+class HSPIReceiveDMATest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPIReceiveDMA
+    FRAGMENT_ARGUMENTS  = dict(data_size=64, ring_size=8, burst=8, fifo_depth=32, max_frames=4, max_frame_words=32)
+
+    DATA_BASE = 0x1000
+    RING_BASE = 0x100
+
+    def setUp(self):
+        super().setUp()
+        self.rng       = random.Random(0)
+        self.memory    = {}
+        self.received  = []
+        self.consuming = True
+        self.sim.add_sync_process(wishbone_memory(self.dut.bus, self.memory, self.rng))
+        self.sim.add_sync_process(self.software)
+
+    def software(self):
+        """ takes the frames out of the rings, like the driver would """
+        yield Passive()
+        dut  = self.dut
+        tail = 0
+        while True:
+            yield
+            if not self.consuming or (yield dut.ring_head_out) == tail:
+                continue
+            slot = self.RING_BASE + tail * DESCRIPTOR_WORDS
+            address, status, header, number = (self.memory[slot + i] for i in range(DESCRIPTOR_WORDS))
+            length  = status & 0x1fff
+            payload = [self.memory[self.DATA_BASE + (address - self.DATA_BASE + i) % 64] for i in range(length)]
+            self.received.append((header, payload, status >> 30, number))
+
+            tail = (tail + 1) % 8
+            yield dut.ring_tail_in.eq(tail)
+            yield dut.data_tail_in.eq((address - self.DATA_BASE + length) % 64)
+
+    def send_frame(self, header, payload, crc_error=False):
+        dut = self.dut
+        yield dut.user_data_in.eq(header & 0x3ffffff)
+        yield dut.sequence_nr_in.eq(header >> 26 & 0xf)
+        yield dut.tll_2b_in.eq(header >> 30)
+        yield
+        for i, word in enumerate(payload):
+            # like from the receiver, last and crc_error come with the last word
+            yield dut.stream_in.valid.eq(1)
+            yield dut.stream_in.first.eq(i == 0)
+            yield dut.stream_in.last.eq(i == len(payload) - 1)
+            yield dut.stream_in.crc_error.eq(crc_error and i == len(payload) - 1)
+            yield dut.stream_in.payload.eq(word)
+            yield
+        yield dut.stream_in.valid.eq(0)
+        yield dut.stream_in.last.eq(0)
+        yield dut.stream_in.crc_error.eq(0)
+        yield from self.advance_cycles(2)
+
+    @sync_test_case
+    def test_receive_dma(self):
+        dut = self.dut
+        yield dut.data_base_in.eq(self.DATA_BASE)
+        yield dut.ring_base_in.eq(self.RING_BASE)
+
+        frames = [(0xc0000000 | (n & 0xf) << 26 | (0x3abcdef - n),
+                   [self.rng.getrandbits(32) for _ in range(self.rng.randint(1, 30))])
+                  for n in range(24)]
+
+        # a frame at a time, with every third one broken
+        for n, (header, payload) in enumerate(frames[:12]):
+            yield from self.send_frame(header, payload, crc_error=n % 3 == 2)
+            yield from self.advance_cycles(60)
+
+        self.assertEqual(self.received, [(header, payload, 2 if n % 3 == 2 else 0, n + 1)
+                                         for n, (header, payload) in enumerate(frames[:12])])
+
+        # the software stops taking frames, until the rings overflow
+        self.consuming = False
+        for header, payload in frames[12:]:
+            yield from self.send_frame(header, payload)
+        yield from self.advance_cycles(200)
+        self.consuming = True
+        yield from self.advance_cycles(200)
+
+        self.assertGreater((yield dut.truncated_out), 0)
+        self.assertGreater((yield dut.dropped_out), 0)
+        self.assertEqual((yield dut.frames_out) + (yield dut.dropped_out), len(frames))
+        self.assertEqual(len(self.received), (yield dut.frames_out))
+
+        # what made it into memory is in order, and complete unless marked as truncated
+        sent = iter(frames[12:])
+        for header, payload, status, number in self.received[12:]:
+            expected = next(frame for frame in sent if frame[0] == header)
+            if status & 1:
+                self.assertEqual(payload, expected[1][:len(payload)])
+                self.assertLess(len(payload), len(expected[1]))
+            else:
+                self.assertEqual(payload, expected[1])
@@ -0,0 +1,148 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+from amaranth import *
+
+from .hspi import HSPIInterface
+
+# the HSPI pads which are driven by the FPGA, all others are inputs, except hd, which is both
+OUTPUT_PADS = ["tx_ack", "tx_req", "tx_valid"]
+INPUT_PADS  = ["tx_ready", "rx_act", "rx_valid"]
+PADS        = ["hd"] + OUTPUT_PADS + INPUT_PADS
+
+# DEL_VALUE of the ECP5 input delay elements goes from 0 to 127 taps
+MAX_DELAY = 127
+
+class ECP5HSPIPads(Elaboratable):
+    """ IO cells for the HSPI bus on the ECP5
+
+        Takes the hspi resource requested with dir="-" for all of its pads, see PADS,
+        and offers them as the HSPIInterface hspi, so that the connect_to_pads() methods
+        of the HSPI cores can take it instead of the resource.
+
+        With registered=True, every input, output and output enable goes through a flip flop
+        in its IO cell, clocked by domain, so that nothing between the pins and the fabric
+        limits Fmax. This delays all inputs and outputs by one cycle, which makes
+        the handshakes with the CH569 two cycles slower.
+
+        hd_delays and control_delays put the inputs through a DELAYG with that many taps,
+        before the input register. hd_delays is a number for all bits of hd or
+        a list with one for each bit, control_delays a number for all of INPUT_PADS
+        or a dict with a number for some of them. Inputs without a delay have no delay element.
+        With dynamic=True, hd goes through DELAYF instead, which start at hd_delays,
+        or at 0 for bits without one, and move one tap in delay_direction_in
+        (1 for less delay) in each cycle of domain in which their bit in delay_move_in is set.
+        delay_load_in sets them back to where they started.
+    """
+    def __init__(self, pads, *, domain="sync", registered=True, hd_delays=None, control_delays=None, dynamic=False):
+        if hd_delays is None or isinstance(hd_delays, int):
+            hd_delays = [hd_delays] * 32
+        if len(hd_delays) != 32:
+            raise ValueError(f"hd_delays needs a delay for each of the 32 bits, not {len(hd_delays)}")
+
+        if control_delays is None or isinstance(control_delays, int):
+            control_delays = {name: control_delays for name in INPUT_PADS}
+        unknown = set(control_delays) - set(INPUT_PADS)
+        if unknown:
+            raise ValueError(f"control_delays can only delay {', '.join(INPUT_PADS)}, not {', '.join(sorted(unknown))}")
+
+        for delay in hd_delays + list(control_delays.values()):
+            if delay is not None and not 0 <= delay <= MAX_DELAY:
+                raise ValueError(f"input delays go from 0 to {MAX_DELAY} taps, not {delay}")
+
+        self.pads           = pads
+        self.hspi           = HSPIInterface(name="hspi_io")
+
+        self.delay_load_in      = Signal()
+        self.delay_move_in      = Signal(32)
+        self.delay_direction_in = Signal()
+
+        self.domain         = domain
+        self.registered     = registered
+        self.hd_delays      = hd_delays
+        self.control_delays = control_delays
+        self.dynamic        = dynamic
+
+    def elaborate(self, platform):
+        m = Module()
+        pads = self.pads
+        hspi = self.hspi
+        clk  = ClockSignal(self.domain)
+
+        def delay(name, pin, taps, dynamic=False, bit=0):
+            """ the input pin after a delay element with taps, if there is any """
+            if taps is None and not dynamic:
+                return pin
+            delayed = Signal(name=f"{name}_delayed")
+            if dynamic:
+                m.submodules[f"{name}_delay"] = Instance("DELAYF",
+                    p_DEL_MODE="USER_DEFINED",
+                    p_DEL_VALUE=taps or 0,
+                    i_A=pin,
+                    i_LOADN=~self.delay_load_in,
+                    i_MOVE=self.delay_move_in[bit],
+                    i_DIRECTION=self.delay_direction_in,
+                    o_Z=delayed)
+            else:
+                m.submodules[f"{name}_delay"] = Instance("DELAYG",
+                    p_DEL_MODE="USER_DEFINED",
+                    p_DEL_VALUE=taps,
+                    i_A=pin,
+                    o_Z=delayed)
+            return delayed
+
+        def register(name, d, q, kind):
+            """ q is d after the IO register of kind, IFS1P3DX or OFS1P3DX, or just d """
+            if not self.registered:
+                m.d.comb += q.eq(d)
+                return
+            m.submodules[f"{name}_register"] = Instance(kind,
+                i_SCLK=clk,
+                i_SP=Const(1),
+                i_CD=Const(0),
+                i_D=d,
+                o_Q=q)
+
+        def tristate_register(name, d, q):
+            """ q is d after an IO register which is set while domain is in reset,
+                so that the pin does not drive before the cores are running
+            """
+            if not self.registered:
+                m.d.comb += q.eq(d)
+                return
+            m.submodules[f"{name}_register"] = Instance("OFS1P3BX",
+                i_SCLK=clk,
+                i_SP=Const(1),
+                i_PD=ResetSignal(self.domain),
+                i_D=d,
+                o_Q=q)
+
+        for name in INPUT_PADS:
+            pin = Signal(name=f"{name}_pin")
+            m.submodules[f"{name}_buffer"] = Instance("IB", i_I=getattr(pads, name).io[0], o_O=pin)
+            register(name, delay(name, pin, self.control_delays.get(name)), getattr(hspi, name), "IFS1P3DX")
+
+        for name in OUTPUT_PADS:
+            pin = Signal(name=f"{name}_pin")
+            register(name, getattr(hspi, name), pin, "OFS1P3DX")
+            m.submodules[f"{name}_buffer"] = Instance("OB", i_I=pin, o_O=getattr(pads, name).io[0])
+
+        for bit in range(32):
+            name  = f"hd{bit}"
+            pin_i = Signal(name=f"{name}_pin_i")
+            pin_o = Signal(name=f"{name}_pin_o")
+            pin_t = Signal(name=f"{name}_pin_t")
+
+            # every bit has its own output enable register, so that it can be packed into its IO cell
+            register(f"{name}_o", hspi.hd.o[bit], pin_o, "OFS1P3DX")
+            tristate_register(f"{name}_t", ~hspi.hd.oe, pin_t)
+            m.submodules[f"{name}_buffer"] = Instance("BB",
+                i_T=pin_t,
+                i_I=pin_o,
+                o_O=pin_i,
+                io_B=pads.hd.io[bit])
+
+            delayed = delay(name, pin_i, self.hd_delays[bit], dynamic=self.dynamic, bit=bit)
+            register(f"{name}_i", delayed, hspi.hd.i[bit], "IFS1P3DX")
+
+        return m
@@ -0,0 +1,201 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+from amaranth import *
+
+class _SlotCounter(Elaboratable):
+    """ Finds the cycle boundaries of the slow domain in the fast domain.
+
+        Both domains have to come from the same PLL, with the fast clock running
+        at a whole multiple of the frequency of the slow clock and aligned rising edges.
+        load_out is high in the first fast cycle after a slow clock edge.
+    """
+    def __init__(self, *, domain, pad_domain):
+        self.domain     = domain
+        self.pad_domain = pad_domain
+        self.load_out   = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        toggle      = Signal()
+        toggle_seen = Signal()
+
+        slow = m.d.__getattr__(self.domain)
+        fast = m.d.__getattr__(self.pad_domain)
+
+        slow += toggle.eq(~toggle)
+        fast += toggle_seen.eq(toggle)
+        m.d.comb += self.load_out.eq(toggle != toggle_seen)
+
+        return m
+
+class HSPITransmitGearbox(Elaboratable):
+    """ Puts the wide transmit side of a HSPI core onto the HSPI bus of width bits.
+
+        Every cycle of domain carries words 32 bit words on the wide interface,
+        which go out on the narrow interface in the following words * 32 // width cycles
+        of pad_domain, word 0 first, and the lowest bits of a word first.
+        Words without tx_valid become gaps on the bus.
+    """
+    def __init__(self, *, wide, narrow, words, domain, pad_domain, width=32):
+        self.wide       = wide
+        self.narrow     = narrow
+        self.words      = words
+        self.domain     = domain
+        self.pad_domain = pad_domain
+        self.width      = width
+
+    def elaborate(self, platform):
+        m = Module()
+        wide   = self.wide
+        narrow = self.narrow
+        fast   = m.d.__getattr__(self.pad_domain)
+        width  = self.width
+        lanes  = 32 // width
+        slots  = self.words * lanes
+
+        m.submodules.slots = slot_counter = _SlotCounter(domain=self.domain, pad_domain=self.pad_domain)
+
+        data       = Signal(32 * self.words - width)
+        valid      = Signal(slots - 1)
+        slot_valid = Cat(wide.tx_valid[slot // lanes] for slot in range(slots))
+
+        with m.If(slot_counter.load_out):
+            fast += [
+                narrow.hd.o      .eq(wide.hd.o[:width]),
+                narrow.tx_valid  .eq(slot_valid[0]),
+                narrow.hd.oe     .eq(wide.hd.oe),
+                narrow.tx_req    .eq(wide.tx_req),
+                data             .eq(wide.hd.o[width:]),
+                valid            .eq(slot_valid[1:]),
+            ]
+        with m.Else():
+            fast += [
+                narrow.hd.o      .eq(data[:width]),
+                narrow.tx_valid  .eq(valid[0]),
+                data             .eq(data >> width),
+                valid            .eq(valid >> 1),
+            ]
+
+        tx_ready = Signal()
+        tx_ack   = Signal()
+        fast += [
+            tx_ready .eq(narrow.tx_ready),
+            tx_ack   .eq(narrow.tx_ack),
+        ]
+        m.d.comb += [
+            wide.tx_ready .eq(tx_ready),
+            wide.tx_ack   .eq(tx_ack),
+        ]
+
+        return m
+
+class HSPIReceiveGearbox(Elaboratable):
+    """ Collects the 32 bit HSPI bus into the wide receive side of a HSPI core.
+
+        Every cycle of domain sees the last words bus cycles of pad_domain on the wide interface,
+        the oldest in slot 0. The slots keep their rx_valid and rx_act strobes,
+        so the core has to skip the slots without rx_valid.
+    """
+    def __init__(self, *, wide, narrow, words, domain, pad_domain):
+        self.wide       = wide
+        self.narrow     = narrow
+        self.words      = words
+        self.domain     = domain
+        self.pad_domain = pad_domain
+
+    def elaborate(self, platform):
+        m = Module()
+        wide   = self.wide
+        narrow = self.narrow
+        fast   = m.d.__getattr__(self.pad_domain)
+
+        m.submodules.slots = slots = _SlotCounter(domain=self.domain, pad_domain=self.pad_domain)
+
+        # the previous words - 1 bus cycles
+        data   = Signal(32 * (self.words - 1))
+        valid  = Signal(self.words - 1)
+        active = Signal(self.words - 1)
+
+        fast += [
+            data   .eq(Cat(data,   narrow.hd.i)     [32:]),
+            valid  .eq(Cat(valid,  narrow.rx_valid) [1:]),
+            active .eq(Cat(active, narrow.rx_act)   [1:]),
+        ]
+
+        with m.If(slots.load_out):
+            fast += [
+                wide.hd.i      .eq(Cat(data,   narrow.hd.i)),
+                wide.rx_valid  .eq(Cat(valid,  narrow.rx_valid)),
+                wide.rx_act    .eq(Cat(active, narrow.rx_act)),
+            ]
+
+        fast += narrow.tx_ack.eq(wide.tx_ack)
+
+        return m
+
+class HSPIReceiveLaneGearbox(Elaboratable):
+    """ Collects an HSPI bus of width bits less than 32 into the 32 bit receive side of a HSPI core.
+
+        Every 32 // width bus cycles with rx_valid in pad_domain make a word, lowest bits first,
+        which shows up with rx_valid in the next cycle of domain. domain has to run
+        at most at pad_domain / (32 // width), so that it sees every word.
+        rx_act stays up until the cycle after the last word.
+    """
+    def __init__(self, *, wide, narrow, width, domain, pad_domain):
+        self.wide       = wide
+        self.narrow     = narrow
+        self.width      = width
+        self.domain     = domain
+        self.pad_domain = pad_domain
+
+    def elaborate(self, platform):
+        m = Module()
+        wide   = self.wide
+        narrow = self.narrow
+        fast   = m.d.__getattr__(self.pad_domain)
+        width  = self.width
+        lanes  = 32 // width
+
+        m.submodules.slots = slots = _SlotCounter(domain=self.domain, pad_domain=self.pad_domain)
+
+        # the lanes of the word coming in, and the last complete word
+        data     = Signal(32 - width)
+        lane     = Signal(range(lanes))
+        word     = Signal(32)
+        complete = Signal()
+        pending  = Signal()
+        active   = Signal()
+
+        new_word = Cat(data, narrow.hd.i)
+        m.d.comb += complete.eq(narrow.rx_valid & (lane == lanes - 1))
+
+        with m.If(narrow.rx_valid):
+            fast += [
+                data.eq(new_word[width:]),
+                lane.eq(Mux(lane == lanes - 1, 0, lane + 1)),
+            ]
+        with m.If(~narrow.rx_act):
+            fast += lane.eq(0)
+
+        with m.If(slots.load_out):
+            fast += [
+                wide.hd.i     .eq(Mux(complete, new_word, word)),
+                wide.rx_valid .eq(complete | pending),
+                wide.rx_act   .eq(active | narrow.rx_act | complete | pending),
+                pending       .eq(0),
+                active        .eq(0),
+            ]
+        with m.Else():
+            with m.If(complete):
+                fast += [
+                    word.eq(new_word),
+                    pending.eq(1),
+                ]
+            with m.If(narrow.rx_act):
+                fast += active.eq(1)
+
+        fast += narrow.tx_ack.eq(wide.tx_ack)
+
+        return m
@@ -2,7 +2,12 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import operator
-from functools import reduce
+import random
+import struct
+import zlib
+from collections import Counter
+from functools   import reduce, lru_cache
+from itertools   import combinations
 
 from amaranth          import *
 from amaranth.lib.cdc  import FFSynchronizer
@@ -13,51 +18,211 @@ from amaranth.build    import Platform
 
 from amlib.stream import StreamInterface
 
+from .gearbox import HSPITransmitGearbox, HSPIReceiveGearbox, HSPIReceiveLaneGearbox
+from .buffers import HSPIPacketBuffer, HSPIFrameBuffer
+
+def _crc_next_state_terms(polynomial, crc_size, datawidth):
+    """ Unrolls the bit serial CRC update over ``datawidth`` input bits.
+
+        Returns one bit mask per bit of the next CRC state. Bits 0 to crc_size - 1
+        of a mask select bits of the current CRC state, the bits above select bits of the input data.
+    """
+    state = [1 << j for j in range(crc_size)]
+    for i in range(datawidth):
+        inv = (1 << (crc_size + i)) ^ state[crc_size - 1]
+        state = [inv] + [
+            state[j] ^ inv if (polynomial >> (j + 1)) & 1 else state[j]
+            for j in range(crc_size - 1)
+        ]
+    return state
+
+@lru_cache(maxsize=None)
+def _crc_xor_network(polynomial, crc_size, datawidth, inputs="all"):
+    """ Computes the XOR network for the next CRC state.
+
+        inputs selects whether the network covers the contribution of the
+        current CRC state ("state"), of the input data ("data") or both ("all").
+        Common pairs of terms are extracted greedily (Paar's algorithm) into shared terms,
+        which get numbered after the state and data inputs.
+        Returns (shared, rows): shared is a list of term pairs, each of which forms a new term,
+        rows holds the list of terms which have to be XORed together for each state bit.
+    """
+    first_input, end_input = dict(
+        all   = (0,        crc_size + datawidth),
+        state = (0,        crc_size),
+        data  = (crc_size, crc_size + datawidth),
+    )[inputs]
+
+    rows = [
+        frozenset(bit for bit in range(first_input, end_input) if (mask >> bit) & 1)
+        for mask in _crc_next_state_terms(polynomial, crc_size, datawidth)
+    ]
+    next_term = crc_size + datawidth
+    shared    = []
+
+    while True:
+        pair_count = Counter(pair for row in rows for pair in combinations(sorted(row), 2))
+        if not pair_count:
+            break
+        pair, count = max(pair_count.items(), key=lambda item: (item[1], -item[0][0], -item[0][1]))
+        if count < 2:
+            break
+
+        shared.append(pair)
+        rows = [row - set(pair) | {next_term} if set(pair) <= row else row for row in rows]
+        next_term += 1
+
+    return shared, [sorted(row) for row in rows]
+
+def _xor_tree(terms):
+    """ XORs the terms together in a balanced tree """
+    terms = list(terms)
+    if not terms:
+        return Const(0)
+    while len(terms) > 1:
+        terms = [a ^ b for a, b in zip(terms[0::2], terms[1::2])] + terms[len(terms) & ~1:]
+    return terms[0]
+
+def _crc_update(polynomial, crc_size, state, data, datawidth):
+    """ Bit serial reference model of the CRC state update """
+    for i in range(datawidth):
+        inv   = ((data >> i) ^ (state >> (crc_size - 1))) & 1
+        state = ((state << 1) & ((1 << crc_size) - 1)) ^ (((polynomial & ~1) | 1) if inv else 0)
+    return state
+
+def _reverse_bits(value, width):
+    return int(f"{value:0{width}b}"[::-1], 2)
+
 class CRC(Elaboratable):
-    def __init__(self, *, polynomial, crc_size, datawidth, init=None, delay=False):
+    """ Parallel CRC generator.
+
+        The next state XOR matrix for the polynomial and data width is computed at elaboration time,
+        so every CRC bit is a single, balanced XOR tree over the current CRC state and the input data,
+        instead of a chain of datawidth bit serial update steps.
+
+        With latency > 0, the contribution of the input data is computed in a pipeline
+        of that many register stages and combined with the contribution of the CRC state
+        afterwards, so only the state part remains in the single cycle feedback loop.
+        data_in, enable_in and reset_in are delayed by the same number of cycles,
+        so crc_out is the same as without pipelining, just latency cycles later.
+
+        With words > 1, data_in carries that many datawidth wide words, word 0 first,
+        and enable_in has one bit per word. The enabled words have to be the lowest ones.
+        If no word is enabled, crc_out is the current CRC.
+    """
+    def __init__(self, *, polynomial, crc_size, datawidth, init=None, delay=False, latency=0, words=1):
         self.datawidth   = datawidth
         self.crc_size    = crc_size
         self.init        = init
         self.polynomial  = polynomial
         self.delay       = delay
+        self.latency     = latency
+        self.words       = words
 
         if init is None:
             self.init = (1 << crc_size) - 1
 
         self.reset_in  = Signal()
-        self.enable_in = Signal()
-        self.data_in   = Signal(datawidth)
+        self.enable_in = Signal(words)
+        self.data_in   = Signal(datawidth * words)
         self.crc_out   = Signal(crc_size)
 
+    @property
+    def residue(self):
+        """ The value of crc_out after a message followed by its own CRC, independent of the message """
+        crc   = _reverse_bits(self.init, self.crc_size) ^ self.init
+        state = _crc_update(self.polynomial, self.crc_size, self.init, crc, self.crc_size)
+        return _reverse_bits(state, self.crc_size) ^ self.init
+
+    def _xor_network(self, m, inputs, words, terms):
+        shared, rows = _crc_xor_network(self.polynomial, self.crc_size, self.datawidth * words, inputs)
+
+        terms = list(terms)
+        for a, b in shared:
+            term = Signal(name=f"{inputs}_term_{words}_{len(terms)}")
+            m.d.comb += term.eq(terms[a] ^ terms[b])
+            terms.append(term)
+
+        return [[terms[t] for t in row] for row in rows]
+
+    def _next_state(self, m, crcreg, words):
+        """ Computes the next CRC state after the first words input words """
+        inputs   = [*crcreg, *self.data_in[:self.datawidth * words]]
+        next_crc = Signal(self.crc_size, name=f"next_crc_{words}")
+
+        if self.latency == 0:
+            rows = self._xor_network(m, "all", words, inputs)
+            for j, row in enumerate(rows):
+                m.d.comb += next_crc[j].eq(_xor_tree(row))
+            return next_crc
+
+        state_rows = self._xor_network(m, "state", words, inputs)
+        data_rows  = self._xor_network(m, "data",  words, inputs)
+
+        # the data contribution of every CRC bit is split into 2**(latency - 1) partial terms
+        # in the first pipeline stage, every following stage XORs them together pairwise
+        partials = 2 ** (self.latency - 1)
+        stage = [Signal(self.crc_size, name=f"data_stage0_{words}_{g}") for g in range(partials)]
+        for j, row in enumerate(data_rows):
+            for g in range(partials):
+                m.d.sync += stage[g][j].eq(_xor_tree(row[g::partials]))
+
+        for s in range(1, self.latency):
+            previous = stage
+            stage = [Signal(self.crc_size, name=f"data_stage{s}_{words}_{g}") for g in range(len(previous) // 2)]
+            for g, partial in enumerate(stage):
+                m.d.sync += partial.eq(previous[2 * g] ^ previous[2 * g + 1])
+
+        for j, row in enumerate(state_rows):
+            m.d.comb += next_crc[j].eq(_xor_tree(row) ^ stage[0][j])
+
+        return next_crc
+
     def elaborate(self, platform):
         m = Module()
 
-        crcreg = [Signal(self.crc_size, reset=self.init) for i in range(self.datawidth + 1)]
-
-        for i in range(self.datawidth):
-            inv = self.data_in[i] ^ crcreg[i][self.crc_size - 1]
-            tmp = []
-            tmp.append(inv)
-            for j in range(self.crc_size - 1):
-                if((self.polynomial >> (j + 1)) & 1):
-                    tmp.append(crcreg[i][j] ^ inv)
-                else:
-                    tmp.append(crcreg[i][j])
-            m.d.comb += crcreg[i + 1].eq(Cat(*tmp))
-
-        with m.If(self.reset_in):
-            m.d.sync += crcreg[0].eq(self.init)
-        with m.Elif(self.enable_in):
-            m.d.sync += crcreg[0].eq(crcreg[self.datawidth])
+        crcreg     = Signal(self.crc_size, reset=self.init)
+        next_crc   = Signal(self.crc_size)
+
+        # reset and enable go through as many register stages as the data
+        reset  = self.reset_in
+        enable = self.enable_in
+        for stage in range(self.latency):
+            delayed_reset  = Signal(name=f"reset_stage{stage}")
+            delayed_enable = Signal.like(self.enable_in, name=f"enable_stage{stage}")
+            m.d.sync += [
+                delayed_reset  .eq(reset),
+                delayed_enable .eq(enable),
+            ]
+            reset, enable = delayed_reset, delayed_enable
+
+        if self.words == 1:
+            m.d.comb += next_crc.eq(self._next_state(m, crcreg, 1))
+        else:
+            next_states = [self._next_state(m, crcreg, words) for words in range(1, self.words + 1)]
+            m.d.comb += next_crc.eq(crcreg)
+            for words, next_state in enumerate(next_states, start=1):
+                with m.If(enable[words - 1]):
+                    m.d.comb += next_crc.eq(next_state)
+
+        with m.If(reset):
+            m.d.sync += crcreg.eq(self.init)
+        with m.Elif(enable.any()):
+            m.d.sync += crcreg.eq(next_crc)
 
         domain = m.d.sync if self.delay else m.d.comb
-        domain += self.crc_out.eq(crcreg[self.datawidth][::-1] ^ self.init)
+        domain += self.crc_out.eq(next_crc[::-1] ^ self.init)
 
         return m
 
 
 class HSPIInterface(Record):
-    """ Record that represents a HSPI interface. """
+    """ Record that represents a HSPI interface.
+
+        The CH569 can run the HSPI data bus hd with a width of 8, 16 or 32 bits.
+    """
+
+    WIDTHS = (8, 16, 32)
 
     LAYOUT = [
         ('hd', [('i', 32, DIR_FANIN), ('o', 32, DIR_FANOUT), ('oe', 1, DIR_FANOUT)]),
@@ -69,23 +234,124 @@ class HSPIInterface(Record):
         ("rx_valid",  1, DIR_FANIN),
     ]
 
-    def __init__(self, name=None):
-        super().__init__(self.LAYOUT, name=name)
+    @classmethod
+    def narrow_layout(cls, width):
+        """ Layout with a data bus of width bits """
+        return [('hd', [('i', width, DIR_FANIN), ('o', width, DIR_FANOUT), ('oe', 1, DIR_FANOUT)])] + cls.LAYOUT[1:]
+
+    @staticmethod
+    def wide_layout(words):
+        """ Layout which carries words bus cycles at once, slot 0 first """
+        return [
+            ('hd', [('i', 32 * words, DIR_FANIN), ('o', 32 * words, DIR_FANOUT), ('oe', 1, DIR_FANOUT)]),
+            ("tx_ack",    1,     DIR_FANOUT),
+            ("tx_ready",  1,     DIR_FANIN),
+            ("tx_req",    1,     DIR_FANOUT),
+            ("rx_act",    words, DIR_FANIN),
+            ("tx_valid",  words, DIR_FANOUT),
+            ("rx_valid",  words, DIR_FANIN),
+        ]
+
+    def __init__(self, name=None, words=1, width=32):
+        if width not in self.WIDTHS:
+            raise ValueError(f"the HSPI data bus can be {', '.join(map(str, self.WIDTHS))} bits wide, not {width}")
+        if words > 1 and width != 32:
+            raise ValueError("only a 32 bit HSPI interface can carry more than one word")
+        if words > 1:
+            layout = self.wide_layout(words)
+        elif width < 32:
+            layout = self.narrow_layout(width)
+        else:
+            layout = self.LAYOUT
+        super().__init__(layout, name=name)
 
 class HSPITransmitter(Elaboratable):
-    def __init__(self, name=None, domain=None):
+    """ HSPI transmitter core
+
+        With words > 1, stream_in carries that many 32 bit words per cycle of domain,
+        with one valid bit per word. Only the last beat of a packet may have less valid words,
+        which have to be the lowest ones. A gearbox puts the words onto the HSPI bus in pad_domain,
+        which has to run at words times the frequency of domain, from the same PLL.
+
+        With width 8 or 16, hspi_out is a HSPI bus of that width, which the CH569 has to be set to as well.
+        stream_in still carries 32 bit words, and a gearbox puts every word onto the bus
+        in 32 // width cycles of pad_domain, lowest bits first, so pad_domain has to run
+        at 32 // width times the frequency of domain. The header and the CRC are the same for all widths.
+
+        With streaming=True, the transmitter goes straight from the end of one frame
+        to the tx_req of the next one, as soon as tx_ready has dropped,
+        and sends the header in the cycle in which tx_ready comes up.
+        The header fields are sampled one cycle ahead for that.
+
+        states_out has one bit for each state in STATES, which is high while the transmitter is in it.
+
+        frame_overhead_out holds the number of cycles the last frame spent outside of TX_DATA,
+        from the CRC of the frame before up to and including its header,
+        not counting the cycles in which no input was waiting.
+
+        A frame carries at most max_frame_words data words. Normally, the rest of a longer
+        packet is discarded, and truncated_out is high for a cycle. With segment=True, it is sent in the following frames instead,
+        and the transmitter numbers the frames itself, ignoring sequence_nr_in.
+        Since the user id in the header follows bit 0 of the sequence number,
+        consecutive frames alternate between user_id0_in and user_id1_in.
+
+        With frame_buffer=True, stream_in goes into a HSPIFrameBuffer, and a frame is only
+        started when it is complete in the buffer, or when buffer_threshold words of it are,
+        so that the producer can not stall the bus in the middle of a frame.
+        frame_words_out holds the length of the next frame while frame_complete_out is high.
+    """
+    STATES = [
+        "WAIT_INPUT", "START", "WAIT_TX_READY", "TX_ACK", "ACK_DONE",
+        "TX_HEADER", "TX_DATA", "TX_CRC", "WAIT_HTRDY", "WAIT_LAST",
+    ]
+
+    def __init__(self, name=None, domain=None, crc_latency=0, words=1, pad_domain=None, streaming=False,
+                 max_frame_words=4096, segment=False, frame_buffer=False, buffer_threshold=None, width=32):
+        if words > 1 and pad_domain is None:
+            raise ValueError("a transmitter with more than one word per cycle needs a pad_domain")
+        if width < 32 and pad_domain is None:
+            raise ValueError(f"a transmitter with a {width} bit bus needs a pad_domain")
+        if width < 32 and words > 1:
+            raise ValueError("a transmitter with a bus narrower than 32 bits can only take one word per cycle")
+        if not 0 < max_frame_words <= 4096 or max_frame_words % words:
+            raise ValueError(f"max_frame_words must be a multiple of {words} between 1 and 4096, "
+                             f"not {max_frame_words}")
+
         self.send_ack       = Signal()
         self.ack_done       = Signal()
         self.tll_2b_in      = Signal(2)
         self.sequence_nr_in = Signal(4)
         self.user_id0_in    = Signal(26)
         self.user_id1_in    = Signal(26)
-        self.stream_in      = StreamInterface(name="tx_data_in", payload_width=32)
-        self.hspi_out       = HSPIInterface(name=name)
-
-        self.state          = Signal(3)
-
-        self.domain = domain
+        self.stream_in      = StreamInterface(name="tx_data_in", payload_width=32 * words, valid_width=words)
+        self.hspi_out       = HSPIInterface(name=name, width=width)
+
+        self.state              = Signal(4)
+        self.states_out         = Signal(len(self.STATES))
+        self.frame_overhead_out = Signal(16)
+        self.truncated_out      = Signal()
+
+        self.domain      = domain
+        self.crc_latency = crc_latency
+        self.words       = words
+        self.width       = width
+        self.pad_domain  = pad_domain
+        self.streaming   = streaming
+
+        self.max_frame_words = max_frame_words
+        self.segment         = segment
+        self.frame_buffer    = frame_buffer
+
+        self.frame_words_out    = Signal(range(max_frame_words + 1))
+        self.frame_complete_out = Signal()
+
+        if frame_buffer:
+            self.buffer    = HSPIFrameBuffer(max_frame_words=max_frame_words, threshold=buffer_threshold,
+                                             payload_width=32 * words, valid_width=words)
+            self.stream_in = self.buffer.stream_in
+            self._frames   = self.buffer.stream_out
+        else:
+            self._frames   = self.stream_in
 
     def connect_to_pads(self, hspi_pads):
         hspi_out = self.hspi_out
@@ -108,40 +374,90 @@ class HSPITransmitter(Elaboratable):
         sync   = m.d.__getattr__(domain)
         comb   = m.d.comb
 
-        m.submodules.crc = crc = DomainRenamer(domain)(CRC(polynomial=0x04C11DB7, crc_size=32, datawidth=32, delay=True))
+        m.submodules.crc = crc = DomainRenamer(domain)(
+            CRC(polynomial=0x04C11DB7, crc_size=32, datawidth=32, delay=True, latency=self.crc_latency, words=self.words))
+
+        if self.words == 1 and self.width == 32:
+            hspi = self.hspi_out
+        else:
+            hspi = HSPIInterface(name="wide", words=self.words)
+            m.submodules.gearbox = HSPITransmitGearbox(wide=hspi, narrow=self.hspi_out, words=self.words,
+                width=self.width, domain=domain, pad_domain=self.pad_domain)
+
+        if self.frame_buffer:
+            m.submodules.buffer = DomainRenamer(domain)(self.buffer)
+            comb += [
+                self.frame_words_out.eq(self.buffer.frame_words_out),
+                self.frame_complete_out.eq(self.buffer.frame_complete_out),
+            ]
 
-        hspi      = self.hspi_out
-        stream_in = self.stream_in
-        last_seen = Signal()
+        stream_in   = self._frames
+        last_seen   = Signal()
+        valid_words = Signal(range(self.words + 1))
 
         header       = Signal(32)
         user_id      = Signal(26)
         # maximum frame size is 4096 in
-        word_index   = Signal(range(4096))
+        word_index   = Signal(range(self.max_frame_words + 1))
+        # the packet continues in the next frame
+        continuation = Signal()
+
+        if self.segment:
+            sequence_nr = Signal.like(self.sequence_nr_in)
+        else:
+            sequence_nr = self.sequence_nr_in
 
         comb += [
             header.eq(Cat(
-                Mux(~self.sequence_nr_in[0], self.user_id0_in, self.user_id1_in),
-                self.sequence_nr_in,
-                self.tll_2b_in))
+                Mux(~sequence_nr[0], self.user_id0_in, self.user_id1_in),
+                sequence_nr,
+                self.tll_2b_in)),
+            valid_words.eq(sum(stream_in.valid)),
         ]
 
         ack_in_process = Signal()
         rx_complete    = Signal()
+        input_waiting  = Signal()
+        crc_wait       = Signal(range(self.crc_latency + 1))
+        header_sent    = Signal()
+        overhead       = Signal.like(self.frame_overhead_out)
+
+        if self.streaming:
+            next_header = Signal.like(header)
+            sync += next_header.eq(header)
+        else:
+            next_header = header
+
+        def send_header():
+            return [
+                hspi.hd.oe.eq(1),
+                hspi.hd.o.eq(next_header),
+                hspi.tx_valid.eq(1),
+
+                crc.data_in.eq(next_header),
+                crc.enable_in.eq(1),
+
+                header_sent.eq(1),
+            ]
 
         with m.FSM(domain=domain) as fsm:
             comb += [
                 self.state.eq(fsm.state),
                 rx_complete.eq(~hspi.tx_ack & ~hspi.tx_ready),
+                input_waiting.eq(stream_in.valid.any() & (stream_in.first | continuation)),
             ]
 
             with m.State("WAIT_INPUT"):
                 with m.If(self.send_ack):
                     sync += ack_in_process.eq(1)
                     m.next = "START"
-                with m.Elif(stream_in.valid & stream_in.first & rx_complete):
+                with m.Elif(input_waiting & rx_complete):
                     sync += last_seen.eq(0)
-                    m.next = "START"
+                    if self.streaming:
+                        sync += hspi.tx_req.eq(1)
+                        m.next = "WAIT_TX_READY"
+                    else:
+                        m.next = "START"
 
             with m.State("START"):
                 # wait until an ongoing RX is complete
@@ -154,7 +470,11 @@ class HSPITransmitter(Elaboratable):
                     with m.If(ack_in_process):
                         m.next = "TX_ACK"
                     with m.Else():
-                        m.next = "TX_HEADER"
+                        if self.streaming:
+                            comb += send_header()
+                            m.next = "TX_DATA"
+                        else:
+                            m.next = "TX_HEADER"
 
             with m.State("TX_ACK"):
                 comb += [
@@ -171,15 +491,7 @@ class HSPITransmitter(Elaboratable):
                 m.next = "WAIT_INPUT"
 
             with m.State("TX_HEADER"):
-                comb += [
-                    hspi.hd.oe.eq(1),
-                    hspi.hd.o.eq(header),
-                    hspi.tx_valid.eq(1),
-
-                    crc.data_in.eq(header),
-                    crc.enable_in.eq(1),
-                ]
-
+                comb += send_header()
                 m.next = "TX_DATA"
 
             with m.State("TX_DATA"):
@@ -190,32 +502,55 @@ class HSPITransmitter(Elaboratable):
                     hspi.hd.o.eq(stream_in.payload),
                     hspi.tx_valid.eq(stream_in.valid),
 
-                    crc.data_in.eq(stream_in.data),
-                    crc.enable_in.eq(1),
+                    crc.data_in.eq(stream_in.payload),
+                    crc.enable_in.eq(stream_in.valid),
                 ]
 
-                with m.If(stream_in.valid):
-                    sync += word_index.eq(word_index + 1)
+                with m.If(stream_in.valid.any()):
+                    sync += word_index.eq(word_index + valid_words)
 
-                with m.If(stream_in.last | (word_index == 4095)):
                     with m.If(stream_in.last):
                         sync += last_seen.eq(1)
-                    m.next = "TX_CRC"
+                        m.next = "TX_CRC"
+                    with m.Elif(word_index + valid_words == self.max_frame_words):
+                        if self.segment:
+                            sync += continuation.eq(1)
+                        else:
+                            comb += self.truncated_out.eq(1)
+                        m.next = "TX_CRC"
 
             with m.State("TX_CRC"):
-                comb += [
-                    hspi.hd.oe.eq(1),
-                    hspi.hd.o.eq(crc.crc_out),
-                    hspi.tx_valid.eq(1),
-                    crc.reset_in.eq(1),
-                ]
-                sync += hspi.tx_req.eq(0)
-                m.next = "WAIT_HTRDY"
+                comb += hspi.hd.oe.eq(1)
+
+                # with a pipelined CRC, the CRC of the last data word
+                # is only available crc_latency cycles later
+                with m.If(crc_wait == self.crc_latency):
+                    comb += [
+                        hspi.hd.o.eq(crc.crc_out),
+                        hspi.tx_valid.eq(1),
+                        crc.reset_in.eq(1),
+                    ]
+                    sync += [
+                        hspi.tx_req.eq(0),
+                        crc_wait.eq(0),
+                    ]
+                    if self.segment:
+                        sync += sequence_nr.eq(sequence_nr + 1)
+                    m.next = "WAIT_HTRDY"
+                with m.Else():
+                    sync += crc_wait.eq(crc_wait + 1)
 
             with m.State("WAIT_HTRDY"):
                 with m.If(~hspi.tx_ready):
-                    with m.If(~last_seen):
+                    with m.If(~last_seen & ~continuation):
                         m.next = "WAIT_LAST"
+                    if self.streaming:
+                        with m.Elif(input_waiting & ~hspi.tx_ack & ~self.send_ack):
+                            sync += [
+                                hspi.tx_req.eq(1),
+                                last_seen.eq(0),
+                            ]
+                            m.next = "WAIT_TX_READY"
                     with m.Else():
                         m.next = "WAIT_INPUT"
 
@@ -224,21 +559,83 @@ class HSPITransmitter(Elaboratable):
                 with m.If(stream_in.last):
                     m.next = "WAIT_INPUT"
 
+        with m.If(header_sent):
+            sync += [
+                self.frame_overhead_out.eq(overhead + 1),
+                overhead.eq(0),
+                word_index.eq(0),
+                continuation.eq(0),
+            ]
+        with m.Elif(~fsm.ongoing("TX_DATA") & ~(fsm.ongoing("WAIT_INPUT") & ~input_waiting)):
+            sync += overhead.eq(overhead + 1)
+
+        # the encoding of fsm.state follows the order in which the states are first mentioned,
+        # which depends on the configuration
+        comb += self.states_out.eq(Cat(fsm.ongoing(state) for state in self.STATES))
+
         return m
 
 class HSPIReceiver(Elaboratable):
-    def __init__(self, domain=None):
-        self.hspi_in           = HSPIInterface()
-        self.stream_out        = StreamInterface(name="rx_data_out", payload_width=32, extra_fields=[("crc_error", 1)])
+    """ HSPI receiver core
+
+        With words > 1, stream_out carries up to that many 32 bit words per cycle of domain,
+        with one valid bit per word. The valid words of a beat are always the lowest ones.
+        A gearbox collects the words from the HSPI bus in pad_domain,
+        which has to run at words times the frequency of domain, from the same PLL.
+
+        With width 8 or 16, hspi_in is a HSPI bus of that width. A gearbox collects
+        32 // width bus cycles of pad_domain into every 32 bit word of stream_out, lowest bits first,
+        so pad_domain has to run at 32 // width times the frequency of domain.
+
+        With buffer_frames > 0, the frames go through a HSPIPacketBuffer big enough
+        for that many frames of maximum size. stream_out then only carries frames
+        with a correct CRC, honors ready, and the dropped frames are counted in
+        dropped_crc_out and dropped_overflow_out. The header fields, num_words_out,
+        packet_done_out and crc_error_out, which is high with packet_done_out
+        if the frame had a CRC error, still belong to the frame just received.
+
+        states_out has one bit for each state in STATES, which is high while the receiver is in it.
+    """
+    STATES = ["WAIT", "RX"]
+
+    def __init__(self, domain=None, crc_latency=0, words=1, pad_domain=None, buffer_frames=0, width=32):
+        if words > 1 and pad_domain is None:
+            raise ValueError("a receiver with more than one word per cycle needs a pad_domain")
+        if width < 32 and pad_domain is None:
+            raise ValueError(f"a receiver with a {width} bit bus needs a pad_domain")
+        if width < 32 and words > 1:
+            raise ValueError("a receiver with a bus narrower than 32 bits can only deliver one word per cycle")
+
+        self.hspi_in           = HSPIInterface(width=width)
+        self.stream_out        = StreamInterface(name="rx_data_out", payload_width=32 * words, valid_width=words,
+                                                 extra_fields=[("crc_error", 1)])
         self.packet_done_out   = Signal(1)
         self.tll_2b_out        = Signal(2)
         self.sequence_nr_out   = Signal(4)
         self.user_data_out     = Signal(26)
         self.num_words_out     = Signal(13)
+        self.crc_error_out     = Signal()
 
-        self.state       = Signal(3)
+        self.dropped_crc_out      = Signal(16)
+        self.dropped_overflow_out = Signal(16)
 
-        self.domain = domain
+        self.state       = Signal(3)
+        self.states_out  = Signal(len(self.STATES))
+
+        self.domain        = domain
+        self.crc_latency   = crc_latency
+        self.words         = words
+        self.width         = width
+        self.pad_domain    = pad_domain
+        self.buffer_frames = buffer_frames
+
+        if buffer_frames > 0:
+            beats = buffer_frames * -(-4096 // words)
+            self.buffer  = HSPIPacketBuffer(depth=1 << (beats - 1).bit_length(),
+                                            payload_width=32 * words, valid_width=words)
+            self._frames = self.buffer.stream_in
+        else:
+            self._frames = self.stream_out
 
     def connect_to_pads(self, hspi_pads):
         hspi_in = self.hspi_in
@@ -254,31 +651,78 @@ class HSPIReceiver(Elaboratable):
         ]
 
     def elaborate(self, platform: Platform) -> Module:
+        if self.words > 1:
+            m = self.elaborate_wide(platform)
+        else:
+            m = self.elaborate_narrow(platform)
+
+        if self.buffer_frames > 0:
+            domain = "sync" if self.domain is None else self.domain
+            m.submodules.buffer = DomainRenamer(domain)(self.buffer)
+            m.d.comb += [
+                *self.stream_out.stream_eq(self.buffer.stream_out),
+                self.dropped_crc_out.eq(self.buffer.dropped_crc_out),
+                self.dropped_overflow_out.eq(self.buffer.dropped_overflow_out),
+            ]
+
+        return m
+
+    def elaborate_narrow(self, platform: Platform) -> Module:
         m = Module()
-        hspi       = self.hspi_in
-        stream_out = self.stream_out
+        stream_out = self._frames
         domain     = "sync" if self.domain is None else self.domain
         sync       = m.d.__getattr__(domain)
         comb       = m.d.comb
 
-        m.submodules.crc = crc = DomainRenamer(domain)(CRC(polynomial=0x04C11DB7, crc_size=32, datawidth=32, delay=True))
+        if self.width == 32:
+            hspi = self.hspi_in
+        else:
+            hspi = HSPIInterface(name="lanes")
+            m.submodules.gearbox = HSPIReceiveLaneGearbox(
+                wide=hspi, narrow=self.hspi_in, width=self.width, domain=domain, pad_domain=self.pad_domain)
+
+        m.submodules.crc = crc = DomainRenamer(domain)(
+            CRC(polynomial=0x04C11DB7, crc_size=32, datawidth=32, delay=True, latency=self.crc_latency))
 
         word_pos  = Signal(13)
         crc_equal = Signal()
-        valid     = Signal()
+        frame_end = Signal()
+        rx_word   = Signal()
+        num_words = Signal.like(self.num_words_out)
+
+        # a word is only known not to be the CRC word when the next one arrives,
+        # and the last payload word only when rx_act drops, so the last two words
+        # of the frame are held back. This way, last always comes with the last payload word,
+        # even when there are gaps before the CRC word.
+        held0       = Signal(32)
+        held1       = Signal(32)
+        held_count  = Signal(range(3))
+        held_first  = Signal()
+        out_valid   = Signal()
+        out_first   = Signal()
+
+        # the CRC of a received word is only available crc_latency cycles later,
+        # so everything which depends on the CRC check is delayed by the same amount
+        latency = self.crc_latency
+        delayed = lambda value: value if latency == 0 else Past(value, clocks=latency, domain=domain)
 
         with m.FSM(domain=domain) as fsm:
             comb += [
                 self.state.eq(fsm.state),
-                stream_out.payload .eq(Past(hspi.hd.i, clocks=2, domain=domain)),
-                stream_out.valid   .eq(Past(valid,     clocks=2, domain=domain)),
+                rx_word   .eq(fsm.ongoing("RX") & hspi.rx_valid),
+                num_words .eq(word_pos - 1),
+
+                stream_out.payload .eq(delayed(held0)),
+                stream_out.valid   .eq(delayed(out_valid)),
+                stream_out.first   .eq(delayed(out_first)),
             ]
 
             with m.State("WAIT"):
-                comb += stream_out.valid.eq(0),
+                comb += crc.reset_in.eq(1)
                 with m.If(hspi.rx_act):
                     sync += [
                         word_pos.eq(0),
+                        held_count.eq(0),
                         hspi.tx_ack.eq(1),
                     ]
                     m.next = "RX"
@@ -290,36 +734,275 @@ class HSPIReceiver(Elaboratable):
                         crc.enable_in.eq(1),
                         crc.data_in.eq(hspi.hd.i),
                     ]
-                    sync += crc_equal.eq(crc.crc_out == hspi.hd.i)
 
                 # extract header
                 with m.If(word_pos == 0):
                     sync += Cat(self.user_data_out, self.sequence_nr_out, self.tll_2b_out).eq(hspi.hd.i)
 
-                # don't include header in stream data.
-                # valid is delayed by 2, so this comes at the same time as first
-                with m.If(word_pos >= 1):
-                    comb += valid.eq(hspi.rx_valid)
-
-                with m.If(word_pos == 3):
-                    comb += stream_out.first.eq(1)
+                # don't include header in stream data
+                with m.If(hspi.rx_valid & (word_pos >= 1)):
+                    with m.Switch(held_count):
+                        with m.Case(0):
+                            sync += [
+                                held0.eq(hspi.hd.i),
+                                held_first.eq(1),
+                                held_count.eq(1),
+                            ]
+                        with m.Case(1):
+                            sync += [
+                                held1.eq(hspi.hd.i),
+                                held_count.eq(2),
+                            ]
+                        with m.Default():
+                            comb += [
+                                out_valid.eq(1),
+                                out_first.eq(held_first),
+                            ]
+                            sync += [
+                                held0.eq(held1),
+                                held1.eq(hspi.hd.i),
+                                held_first.eq(0),
+                            ]
 
                 with m.If(~hspi.rx_act):
+                    # the last held word is the CRC
                     comb += [
-                        stream_out.last.eq(1),
-                        self.packet_done_out.eq(1),
-                        stream_out.crc_error.eq(~crc_equal),
-                        self.num_words_out.eq(word_pos - 1),
-                    ]
-                    sync += [
-                        hspi.tx_ack.eq(0),
-                        crc_equal.eq(0),
+                        frame_end.eq(1),
+                        out_valid.eq(held_count == 2),
+                        out_first.eq(held_first),
                     ]
+                    sync += hspi.tx_ack.eq(0)
                     m.next = "WAIT"
 
+        # the CRC over the whole frame including its CRC word has to be the residue.
+        # It is checked right after every word, so that gaps before the CRC word do no harm
+        word_crc_done = Signal()
+        crc_check     = Signal()
+        comb += [
+            word_crc_done.eq(Past(rx_word, clocks=latency + 1, domain=domain)),
+            crc_check.eq(Mux(word_crc_done, crc.crc_out == crc.residue, crc_equal)),
+        ]
+        with m.If(word_crc_done):
+            sync += crc_equal.eq(crc_check)
+
+        with m.If(delayed(frame_end)):
+            comb += [
+                stream_out.last.eq(1),
+                self.packet_done_out.eq(1),
+                stream_out.crc_error.eq(~crc_check),
+                self.crc_error_out.eq(~crc_check),
+                self.num_words_out.eq(delayed(num_words)),
+            ]
+            sync += crc_equal.eq(0)
+
+        comb += self.states_out.eq(Cat(fsm.ongoing(state) for state in self.STATES))
+
         return m
 
-from amlib.test import GatewareTestCase, sync_test_case
+    def elaborate_wide(self, platform: Platform) -> Module:
+        """ Receiver for more than one word per cycle.
+
+            The valid words of every beat from the gearbox are compacted into the lowest slots.
+            The header is taken out of the stream, and the last word is always held back,
+            because the CRC word is only known to be the last one at the end of the frame.
+            Instead of comparing it with the CRC, the CRC is checked against its residue.
+        """
+        m = Module()
+        words      = self.words
+        stream_out = self._frames
+        domain     = "sync" if self.domain is None else self.domain
+        sync       = m.d.__getattr__(domain)
+        comb       = m.d.comb
+
+        hspi = HSPIInterface(name="wide", words=words)
+        m.submodules.gearbox = HSPIReceiveGearbox(
+            wide=hspi, narrow=self.hspi_in, words=words, domain=domain, pad_domain=self.pad_domain)
+
+        m.submodules.crc = crc = DomainRenamer(domain)(
+            CRC(polynomial=0x04C11DB7, crc_size=32, datawidth=32, delay=True, latency=self.crc_latency, words=words))
+
+        # bit masks of the lowest n words
+        masks = Array(Const((1 << n) - 1, words) for n in range(words + 1))
+
+        slot_words = [hspi.hd.i[32 * i:32 * (i + 1)] for i in range(words)]
+        compacted  = [Signal(32, name=f"compacted_{i}") for i in range(words)]
+        count      = Signal(range(words + 1))
+
+        comb += count.eq(sum(hspi.rx_valid))
+        for i in range(words):
+            position = sum(hspi.rx_valid[:i])
+            for j in range(i + 1):
+                with m.If(hspi.rx_valid[i] & (position == j)):
+                    comb += compacted[j].eq(slot_words[i])
+
+        in_frame  = Signal()
+        frame_end = Signal()
+        comb += [
+            self.state.eq(in_frame),
+            self.states_out.eq(Cat(~in_frame, in_frame)),
+            frame_end.eq(in_frame & ~hspi.rx_act[-1]),
+
+            crc.data_in.eq(Cat(*compacted)),
+            crc.enable_in.eq(masks[count]),
+            crc.reset_in.eq(~in_frame & ~hspi.rx_act.any()),
+        ]
+
+        # take the header out of the stream and hold back the last word,
+        # the words to go out are the lowest of sequence
+        have_header     = Signal()
+        take_header     = Signal()
+        have_held       = Signal()
+        held            = Signal(32)
+        payload         = Signal(32 * words)
+        sequence        = Signal(32 * (words + 1))
+        sequence_length = Signal(range(words + 2))
+        out_words       = Signal(range(words + 1))
+
+        comb += [
+            take_header.eq(~have_header & (count != 0)),
+            payload.eq(Mux(take_header, Cat(*compacted[1:], Const(0, 32)), Cat(*compacted))),
+            sequence.eq(Mux(have_held, Cat(held, payload), payload)),
+            sequence_length.eq(have_held + count - take_header),
+            out_words.eq(Mux(sequence_length != 0, sequence_length - 1, 0)),
+        ]
+
+        with m.If(take_header):
+            sync += [
+                Cat(self.user_data_out, self.sequence_nr_out, self.tll_2b_out).eq(compacted[0]),
+                have_header.eq(1),
+            ]
+
+        with m.If(sequence_length != 0):
+            sync += [
+                held.eq(Array(sequence[32 * i:32 * (i + 1)] for i in range(words + 1))[sequence_length - 1]),
+                have_held.eq(1),
+            ]
+
+        # every beat is held back until the next one arrives or the frame ends,
+        # so we know whether it is the last one
+        pending       = Signal(32 * words)
+        pending_valid = Signal(words)
+        pending_first = Signal()
+        pending_last  = Signal()
+        first_sent    = Signal()
+        new_beat      = Signal()
+
+        beat_payload  = Signal(32 * words)
+        beat_valid    = Signal(words)
+        beat_first    = Signal()
+        beat_last     = Signal()
+        beat_done     = Signal()
+
+        comb += new_beat.eq(out_words != 0)
+
+        with m.If(new_beat | frame_end | pending_last):
+            comb += [
+                beat_payload .eq(pending),
+                beat_valid   .eq(pending_valid),
+                beat_first   .eq(pending_first),
+                beat_last    .eq(pending_valid.any() & (pending_last | (frame_end & ~new_beat))),
+            ]
+            sync += [
+                pending       .eq(sequence[:32 * words]),
+                pending_valid .eq(masks[out_words]),
+                pending_first .eq(new_beat & ~first_sent),
+                pending_last  .eq(frame_end & new_beat),
+            ]
+
+        with m.If(new_beat):
+            sync += first_sent.eq(1)
+
+        comb += beat_done.eq(beat_last | (frame_end & ~new_beat & ~pending_valid.any()))
+
+        frame_words = Signal.like(self.num_words_out)
+        word_count  = Signal.like(self.num_words_out)
+
+        with m.If(frame_end):
+            sync += [
+                in_frame    .eq(0),
+                hspi.tx_ack .eq(0),
+                have_header .eq(0),
+                have_held   .eq(0),
+                first_sent  .eq(0),
+                word_count  .eq(0),
+                frame_words .eq(word_count + count - 1),
+            ]
+        with m.Else():
+            sync += word_count.eq(word_count + count)
+            with m.If(hspi.rx_act.any()):
+                sync += [
+                    in_frame    .eq(1),
+                    hspi.tx_ack .eq(1),
+                ]
+
+        # the CRC of the frame including its CRC word is ready latency + 1 cycles after its end
+        crc_ok = Signal()
+        with m.If(Past(frame_end, clocks=self.crc_latency + 1, domain=domain)):
+            sync += crc_ok.eq(crc.crc_out == crc.residue)
+
+        delay = self.crc_latency + 2
+        comb += [
+            stream_out.payload   .eq(Past(beat_payload, clocks=delay, domain=domain)),
+            stream_out.valid     .eq(Past(beat_valid,   clocks=delay, domain=domain)),
+            stream_out.first     .eq(Past(beat_first,   clocks=delay, domain=domain)),
+            stream_out.last      .eq(Past(beat_last,    clocks=delay, domain=domain)),
+            stream_out.crc_error .eq(stream_out.last & ~crc_ok),
+            self.packet_done_out .eq(Past(beat_done,    clocks=delay, domain=domain)),
+            self.crc_error_out   .eq(self.packet_done_out & ~crc_ok),
+        ]
+
+        with m.If(self.packet_done_out):
+            comb += self.num_words_out.eq(frame_words)
+
+        return m
+
+from amaranth.sim import Passive
+from amlib.test   import GatewareTestCase, sync_test_case
+
+from .codec import crc32
+
+class CRCTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = CRC
+    FRAGMENT_ARGUMENTS  = dict(polynomial=0x04C11DB7, crc_size=32, datawidth=32, delay=True)
+
+    @sync_test_case
+    def test_crc(self):
+        dut = self.dut
+
+        yield from self.advance_cycles(3)
+        yield dut.enable_in.eq(1)
+        for word in [0xc3abcdef] + list(range(0x80)):
+            yield dut.data_in.eq(word)
+            yield
+        yield dut.enable_in.eq(0)
+        yield
+        self.assertEqual((yield dut.crc_out), 0x1106c501)
+
+        yield from self.pulse(dut.reset_in)
+        yield dut.data_in.eq(0)
+        yield
+        yield
+        self.assertEqual((yield dut.crc_out), 0x2144df1c)
+
+class CodecCRCTest(GatewareTestCase):
+    """ checks the CRC of the host side codec against the gateware """
+    FRAGMENT_UNDER_TEST = CRC
+    FRAGMENT_ARGUMENTS  = dict(polynomial=0x04C11DB7, crc_size=32, datawidth=32, delay=True)
+
+    @sync_test_case
+    def test_crc(self):
+        dut   = self.dut
+        rng   = random.Random(0)
+        words = [rng.getrandbits(32) for _ in range(64)]
+
+        yield from self.advance_cycles(3)
+        yield dut.enable_in.eq(1)
+        for word in words:
+            yield dut.data_in.eq(word)
+            yield
+        yield dut.enable_in.eq(0)
+        yield
+        self.assertEqual((yield dut.crc_out), crc32(words))
 
 class HSPITransmitterTest(GatewareTestCase):
     FRAGMENT_UNDER_TEST = HSPITransmitter
@@ -399,3 +1082,492 @@ class HSPIReceiverTest(GatewareTestCase):
         yield
         yield
         yield
+
+class HSPITransmitterPipelinedCRCTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPITransmitter
+    FRAGMENT_ARGUMENTS  = dict(crc_latency=2)
+
+    @sync_test_case
+    def test_hspi_tx_pipelined_crc(self):
+        dut     = self.dut
+        hspi    = dut.hspi_out
+        payload = list(range(0x100, 0x140))
+
+        yield dut.tll_2b_in.eq(0b11)
+        yield dut.user_id0_in.eq(0x3ABCDEF)
+        yield dut.stream_in.valid.eq(1)
+        yield dut.stream_in.first.eq(1)
+        yield dut.stream_in.payload.eq(payload[0])
+
+        words = []
+        index = 0
+        while index < len(payload) or (yield hspi.tx_req):
+            yield
+            yield hspi.tx_ready.eq((yield hspi.tx_req))
+            if (yield hspi.tx_valid):
+                words.append((yield hspi.hd.o))
+            if (yield dut.stream_in.ready) and index < len(payload):
+                index += 1
+                yield dut.stream_in.first.eq(0)
+                yield dut.stream_in.valid.eq(index < len(payload))
+                yield dut.stream_in.last.eq(index == len(payload) - 1)
+                yield dut.stream_in.payload.eq(payload[index] if index < len(payload) else 0)
+
+        frame = [0xc3abcdef] + payload
+        self.assertEqual(words[:-1], frame)
+        self.assertEqual(words[-1], zlib.crc32(struct.pack(f"<{len(frame)}I", *frame)))
+
+class HSPIStreamingTransmitterTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPITransmitter
+    FRAGMENT_ARGUMENTS  = dict(streaming=True)
+    FRAME_OVERHEAD      = 5
+
+    @sync_test_case
+    def test_hspi_tx_streaming(self):
+        dut      = self.dut
+        hspi     = dut.hspi_out
+        payloads = [list(range(n << 8, (n << 8) + 8 + n)) for n in range(4)]
+        stream   = [(word, i == 0, i == len(payload) - 1) for payload in payloads for i, word in enumerate(payload)]
+
+        def present(index):
+            word, first, last = stream[index] if index < len(stream) else (0, 0, 0)
+            yield dut.stream_in.valid.eq(index < len(stream))
+            yield dut.stream_in.payload.eq(word)
+            yield dut.stream_in.first.eq(first)
+            yield dut.stream_in.last.eq(last)
+
+        yield dut.tll_2b_in.eq(0b11)
+        yield dut.user_id0_in.eq(0x3ABCDEF)
+        yield from present(0)
+
+        frames    = []
+        overheads = []
+        index     = 0
+        while len(frames) < len(payloads) or (yield hspi.tx_req):
+            yield
+            if (yield hspi.tx_req) and not (yield hspi.tx_ready):
+                frames.append([])
+            yield hspi.tx_ready.eq((yield hspi.tx_req))
+            if (yield hspi.tx_valid):
+                frames[-1].append((yield hspi.hd.o))
+            if (yield dut.stream_in.ready) and index < len(stream):
+                index += 1
+                yield from present(index)
+            overheads.append((yield dut.frame_overhead_out))
+
+        for payload, words in zip(payloads, frames):
+            frame = [0xc3abcdef] + payload
+            self.assertEqual(words[:-1], frame)
+            self.assertEqual(words[-1], zlib.crc32(struct.pack(f"<{len(frame)}I", *frame)))
+        self.assertEqual(overheads[-1], self.FRAME_OVERHEAD)
+
+class HSPINonStreamingTransmitterTest(HSPIStreamingTransmitterTest):
+    FRAGMENT_ARGUMENTS  = dict(streaming=False)
+    FRAME_OVERHEAD      = 8
+
+class HSPISegmentingTransmitterTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPITransmitter
+    FRAGMENT_ARGUMENTS  = dict(max_frame_words=16, segment=True)
+
+    @sync_test_case
+    def test_hspi_tx_segmenting(self):
+        dut     = self.dut
+        hspi    = dut.hspi_out
+        packets = [list(range(0x100, 0x128)), list(range(0x200, 0x210))]
+        stream  = [(word, i == 0, i == len(packet) - 1) for packet in packets for i, word in enumerate(packet)]
+
+        def present(index):
+            word, first, last = stream[index] if index < len(stream) else (0, 0, 0)
+            yield dut.stream_in.valid.eq(index < len(stream))
+            yield dut.stream_in.payload.eq(word)
+            yield dut.stream_in.first.eq(first)
+            yield dut.stream_in.last.eq(last)
+
+        yield dut.tll_2b_in.eq(0b11)
+        yield dut.user_id0_in.eq(0x3ABCDEF)
+        yield dut.user_id1_in.eq(0x3456789)
+        yield dut.sequence_nr_in.eq(0xf)
+        yield from present(0)
+
+        frames = []
+        index  = 0
+        for _ in range(300):
+            yield
+            if (yield hspi.tx_req) and not (yield hspi.tx_ready):
+                frames.append([])
+            yield hspi.tx_ready.eq((yield hspi.tx_req))
+            if (yield hspi.tx_valid):
+                frames[-1].append((yield hspi.hd.o))
+            if (yield dut.stream_in.ready) and index < len(stream):
+                index += 1
+                yield from present(index)
+
+        payloads = [packets[0][:16], packets[0][16:32], packets[0][32:], packets[1]]
+        self.assertEqual(len(frames), len(payloads))
+        for sequence_nr, (payload, words) in enumerate(zip(payloads, frames)):
+            user_id = 0x3456789 if sequence_nr & 1 else 0x3ABCDEF
+            frame   = [0b11 << 30 | sequence_nr << 26 | user_id] + payload
+            self.assertEqual(words[:-1], frame)
+            self.assertEqual(words[-1], zlib.crc32(struct.pack(f"<{len(frame)}I", *frame)))
+
+class HSPIStreamingSegmentingTransmitterTest(HSPISegmentingTransmitterTest):
+    FRAGMENT_ARGUMENTS  = dict(max_frame_words=16, segment=True, streaming=True)
+
+class HSPIBufferedTransmitterTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPITransmitter
+    FRAGMENT_ARGUMENTS  = dict(max_frame_words=16, segment=True, frame_buffer=True)
+
+    def setUp(self):
+        super().setUp()
+        self.rng     = random.Random(0)
+        self.packets = [list(range(0x100, 0x128)), list(range(0x200, 0x20a))]
+        self.sim.add_sync_process(self.send_packets)
+
+    def send_packets(self):
+        # a slow producer, which would stall the bus without the frame buffer
+        stream = self.dut.stream_in
+        for packet in self.packets:
+            for i, word in enumerate(packet):
+                while self.rng.random() < 0.5:
+                    yield stream.valid.eq(0)
+                    yield
+                yield stream.valid.eq(1)
+                yield stream.first.eq(i == 0)
+                yield stream.last.eq(i == len(packet) - 1)
+                yield stream.payload.eq(word)
+                yield
+                while not (yield stream.ready):
+                    yield
+        yield stream.valid.eq(0)
+
+    @sync_test_case
+    def test_hspi_tx_buffered(self):
+        dut  = self.dut
+        hspi = dut.hspi_out
+
+        yield dut.tll_2b_in.eq(0b11)
+        yield dut.user_id0_in.eq(0x3ABCDEF)
+        yield dut.user_id1_in.eq(0x3456789)
+
+        frames = []
+        for _ in range(400):
+            yield
+            if (yield hspi.tx_req) and not (yield hspi.tx_ready):
+                frames.append([])
+            yield hspi.tx_ready.eq((yield hspi.tx_req))
+            if (yield hspi.tx_valid):
+                frames[-1].append((yield hspi.hd.o))
+            elif frames and frames[-1] and (yield hspi.tx_req):
+                self.fail("gap in the middle of a frame")
+
+        payloads = [self.packets[0][:16], self.packets[0][16:32], self.packets[0][32:], self.packets[1]]
+        self.assertEqual(len(frames), len(payloads))
+        for sequence_nr, (payload, words) in enumerate(zip(payloads, frames)):
+            user_id = 0x3456789 if sequence_nr & 1 else 0x3ABCDEF
+            frame   = [0b11 << 30 | sequence_nr << 26 | user_id] + payload
+            self.assertEqual(words[:-1], frame)
+            self.assertEqual(words[-1], zlib.crc32(struct.pack(f"<{len(frame)}I", *frame)))
+
+class HSPIReceiverPipelinedCRCTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPIReceiver
+    FRAGMENT_ARGUMENTS  = dict(crc_latency=2)
+
+    def receive_frame(self, payload):
+        dut  = self.dut
+        hspi = dut.hspi_in
+
+        frame = [0xc3abcdef] + payload
+        crc   = zlib.crc32(struct.pack(f"<{len(frame)}I", *frame))
+
+        received = []
+        def step():
+            yield
+            if (yield dut.stream_out.valid):
+                received.append((yield dut.stream_out.payload))
+            if (yield dut.stream_out.last):
+                self.assertEqual((yield dut.stream_out.crc_error), 0)
+                return True
+            return False
+
+        yield hspi.rx_act.eq(1)
+        yield from self.advance_cycles(3)
+        yield hspi.rx_valid.eq(1)
+        for word in frame + [crc]:
+            yield hspi.hd.i.eq(word)
+            yield from step()
+        yield hspi.rx_valid.eq(0)
+        yield hspi.rx_act.eq(0)
+
+        for _ in range(10):
+            if (yield from step()):
+                return received
+        self.fail("no end of frame")
+
+    @sync_test_case
+    def test_hspi_rx_pipelined_crc(self):
+        for payload in [list(range(0x40)), list(range(0x40, 0x50))]:
+            yield from self.advance_cycles(3)
+            self.assertEqual((yield from self.receive_frame(payload)), payload)
+
+class HSPIBufferedReceiverTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPIReceiver
+    FRAGMENT_ARGUMENTS  = dict(buffer_frames=1)
+
+    @sync_test_case
+    def test_hspi_rx_buffered(self):
+        dut      = self.dut
+        hspi     = dut.hspi_in
+        payloads = [list(range(0x20)), list(range(0x100, 0x110)), list(range(0x200, 0x230))]
+
+        # nobody reads while the frames come in
+        for n, payload in enumerate(payloads):
+            frame = [0xc3abcdef] + payload
+            crc   = zlib.crc32(struct.pack(f"<{len(frame)}I", *frame)) ^ (n == 1)
+
+            yield hspi.rx_act.eq(1)
+            yield from self.advance_cycles(3)
+            yield hspi.rx_valid.eq(1)
+            for word in frame + [crc]:
+                yield hspi.hd.i.eq(word)
+                yield
+            yield hspi.rx_valid.eq(0)
+            yield hspi.rx_act.eq(0)
+            yield from self.advance_cycles(8)
+
+        received = []
+        yield dut.stream_out.ready.eq(1)
+        for _ in range(100):
+            yield
+            if (yield dut.stream_out.valid):
+                if (yield dut.stream_out.first):
+                    received.append([])
+                received[-1].append((yield dut.stream_out.payload))
+
+        self.assertEqual(received, [payloads[0], payloads[2]])
+        self.assertEqual((yield dut.dropped_crc_out), 1)
+
+class HSPIWideReceiverTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST  = HSPIReceiver
+    FRAGMENT_ARGUMENTS   = dict(words=2, domain="slow", pad_domain="sync")
+    SYNC_CLOCK_FREQUENCY = 100e6
+
+    def setUp(self):
+        super().setUp()
+        words = self.FRAGMENT_ARGUMENTS["words"]
+        self.sim.add_clock(words / self.SYNC_CLOCK_FREQUENCY, phase=0.5 / self.SYNC_CLOCK_FREQUENCY, domain="slow")
+        self.sim.add_sync_process(self.collect_frames, domain="slow")
+        self.frames = []
+
+    def collect_frames(self):
+        dut   = self.dut
+        words = self.FRAGMENT_ARGUMENTS["words"]
+        frame = []
+
+        yield Passive()
+        while True:
+            yield
+            valid = yield dut.stream_out.valid
+            data  = yield dut.stream_out.payload
+            frame += [(data >> (32 * i)) & 0xffffffff for i in range(words) if (valid >> i) & 1]
+            if (yield dut.stream_out.last):
+                self.frames.append((frame, (yield dut.stream_out.crc_error)))
+                frame = []
+
+    @sync_test_case
+    def test_hspi_rx_wide(self):
+        hspi     = self.dut.hspi_in
+        rng      = random.Random(0)
+        payloads = [list(range(n, 2 * n)) for n in [1, 2, 5, 0x40, 0x41]]
+
+        for n, payload in enumerate(payloads):
+            frame = [0xc3abcdef] + payload
+            crc   = zlib.crc32(struct.pack(f"<{len(frame)}I", *frame))
+            if n == 2:
+                crc ^= 1
+
+            yield hspi.rx_act.eq(1)
+            yield from self.advance_cycles(rng.randrange(1, 5))
+            for word in frame + [crc]:
+                while rng.random() < 0.3:
+                    yield hspi.rx_valid.eq(0)
+                    yield
+                yield hspi.hd.i.eq(word)
+                yield hspi.rx_valid.eq(1)
+                yield
+            yield hspi.rx_valid.eq(0)
+            yield hspi.rx_act.eq(0)
+            yield from self.advance_cycles(rng.randrange(8, 12))
+
+        yield from self.advance_cycles(16)
+        self.assertEqual(self.frames, [(payload, int(n == 2)) for n, payload in enumerate(payloads)])
+
+class HSPIQuadReceiverTest(HSPIWideReceiverTest):
+    FRAGMENT_ARGUMENTS = dict(words=4, domain="slow", pad_domain="sync", crc_latency=1)
+
+class HSPIWideTransmitterTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST  = HSPITransmitter
+    FRAGMENT_ARGUMENTS   = dict(words=2, domain="slow", pad_domain="sync")
+    SYNC_CLOCK_FREQUENCY = 100e6
+    PAYLOADS             = [list(range(n, 2 * n)) for n in [1, 2, 5, 0x40, 0x41]]
+
+    def setUp(self):
+        super().setUp()
+        words = self.FRAGMENT_ARGUMENTS["words"]
+        self.sim.add_clock(words / self.SYNC_CLOCK_FREQUENCY, phase=0.5 / self.SYNC_CLOCK_FREQUENCY, domain="slow")
+        self.sim.add_sync_process(self.send_packets, domain="slow")
+
+    def send_packets(self):
+        stream_in = self.dut.stream_in
+        words     = self.FRAGMENT_ARGUMENTS["words"]
+
+        yield self.dut.tll_2b_in.eq(0b11)
+        yield self.dut.user_id0_in.eq(0x3ABCDEF)
+
+        for payload in self.PAYLOADS:
+            beats = [payload[i:i + words] for i in range(0, len(payload), words)]
+            for n, beat in enumerate(beats):
+                yield stream_in.payload.eq(sum(word << (32 * i) for i, word in enumerate(beat)))
+                yield stream_in.valid.eq((1 << len(beat)) - 1)
+                yield stream_in.first.eq(n == 0)
+                yield stream_in.last.eq(n == len(beats) - 1)
+                yield
+                while not (yield stream_in.ready):
+                    yield
+            yield stream_in.valid.eq(0)
+
+    @sync_test_case
+    def test_hspi_tx_wide(self):
+        hspi   = self.dut.hspi_out
+        frames = []
+        frame  = []
+
+        while len(frames) < len(self.PAYLOADS):
+            yield
+            tx_req = yield hspi.tx_req
+            yield hspi.tx_ready.eq(tx_req)
+            if (yield hspi.tx_valid):
+                frame.append((yield hspi.hd.o))
+            if not tx_req and frame:
+                frames.append(frame)
+                frame = []
+
+        for frame, payload in zip(frames, self.PAYLOADS):
+            self.assertEqual(frame[:-1], [0xc3abcdef] + payload)
+            self.assertEqual(frame[-1], zlib.crc32(struct.pack(f"<{len(frame) - 1}I", *frame[:-1])))
+
+class HSPIQuadTransmitterTest(HSPIWideTransmitterTest):
+    FRAGMENT_ARGUMENTS = dict(words=4, domain="slow", pad_domain="sync", crc_latency=1)
+
+class HSPINarrowReceiverTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST  = HSPIReceiver
+    FRAGMENT_ARGUMENTS   = dict(width=8, domain="slow", pad_domain="sync")
+    SYNC_CLOCK_FREQUENCY = 100e6
+
+    def setUp(self):
+        super().setUp()
+        lanes = 32 // self.FRAGMENT_ARGUMENTS["width"]
+        self.sim.add_clock(lanes / self.SYNC_CLOCK_FREQUENCY, phase=0.5 / self.SYNC_CLOCK_FREQUENCY, domain="slow")
+        self.sim.add_sync_process(self.collect_frames, domain="slow")
+        self.frames = []
+
+    def collect_frames(self):
+        dut   = self.dut
+        frame = []
+
+        yield Passive()
+        while True:
+            yield
+            if (yield dut.stream_out.valid):
+                frame.append((yield dut.stream_out.payload))
+            if (yield dut.stream_out.last):
+                self.frames.append((frame, (yield dut.stream_out.crc_error)))
+                frame = []
+
+    @sync_test_case
+    def test_hspi_rx_narrow(self):
+        hspi     = self.dut.hspi_in
+        width    = self.FRAGMENT_ARGUMENTS["width"]
+        rng      = random.Random(0)
+        payloads = [list(range(n, 2 * n)) for n in [1, 2, 5, 0x20]]
+
+        for n, payload in enumerate(payloads):
+            frame = [0xc3abcdef] + payload
+            crc   = zlib.crc32(struct.pack(f"<{len(frame)}I", *frame))
+            if n == 2:
+                crc ^= 1 << 20
+
+            yield hspi.rx_act.eq(1)
+            yield from self.advance_cycles(rng.randrange(1, 5))
+            for word in frame + [crc]:
+                for lane in range(32 // width):
+                    while rng.random() < 0.3:
+                        yield hspi.rx_valid.eq(0)
+                        yield
+                    yield hspi.hd.i.eq((word >> (width * lane)) & ((1 << width) - 1))
+                    yield hspi.rx_valid.eq(1)
+                    yield
+            yield hspi.rx_valid.eq(0)
+            yield hspi.rx_act.eq(0)
+            yield from self.advance_cycles(rng.randrange(16, 24))
+
+        yield from self.advance_cycles(32)
+        self.assertEqual(self.frames, [(payload, int(n == 2)) for n, payload in enumerate(payloads)])
+
+class HSPI16BitReceiverTest(HSPINarrowReceiverTest):
+    FRAGMENT_ARGUMENTS = dict(width=16, domain="slow", pad_domain="sync", crc_latency=1)
+
+class HSPINarrowTransmitterTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST  = HSPITransmitter
+    FRAGMENT_ARGUMENTS   = dict(width=8, domain="slow", pad_domain="sync")
+    SYNC_CLOCK_FREQUENCY = 100e6
+    PAYLOADS             = [list(range(n, 2 * n)) for n in [1, 2, 5, 0x20]]
+
+    def setUp(self):
+        super().setUp()
+        lanes = 32 // self.FRAGMENT_ARGUMENTS["width"]
+        self.sim.add_clock(lanes / self.SYNC_CLOCK_FREQUENCY, phase=0.5 / self.SYNC_CLOCK_FREQUENCY, domain="slow")
+        self.sim.add_sync_process(self.send_packets, domain="slow")
+
+    def send_packets(self):
+        stream_in = self.dut.stream_in
+
+        yield self.dut.tll_2b_in.eq(0b11)
+        yield self.dut.user_id0_in.eq(0x3ABCDEF)
+
+        for payload in self.PAYLOADS:
+            for n, word in enumerate(payload):
+                yield stream_in.payload.eq(word)
+                yield stream_in.valid.eq(1)
+                yield stream_in.first.eq(n == 0)
+                yield stream_in.last.eq(n == len(payload) - 1)
+                yield
+                while not (yield stream_in.ready):
+                    yield
+            yield stream_in.valid.eq(0)
+
+    @sync_test_case
+    def test_hspi_tx_narrow(self):
+        hspi   = self.dut.hspi_out
+        width  = self.FRAGMENT_ARGUMENTS["width"]
+        lanes  = 32 // width
+        frames = []
+        frame  = []
+
+        while len(frames) < len(self.PAYLOADS):
+            yield
+            tx_req = yield hspi.tx_req
+            yield hspi.tx_ready.eq(tx_req)
+            if (yield hspi.tx_valid):
+                frame.append((yield hspi.hd.o))
+            if not tx_req and frame:
+                self.assertEqual(len(frame) % lanes, 0)
+                frames.append([sum(lane << (width * i) for i, lane in enumerate(frame[n:n + lanes]))
+                               for n in range(0, len(frame), lanes)])
+                frame = []
+
+        for frame, payload in zip(frames, self.PAYLOADS):
+            self.assertEqual(frame[:-1], [0xc3abcdef] + payload)
+            self.assertEqual(frame[-1], zlib.crc32(struct.pack(f"<{len(frame) - 1}I", *frame[:-1])))
+
+class HSPI16BitTransmitterTest(HSPINarrowTransmitterTest):
+    FRAGMENT_ARGUMENTS = dict(width=16, domain="slow", pad_domain="sync", crc_latency=1)
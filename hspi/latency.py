@@ -0,0 +1,290 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+from amaranth         import *
+from amaranth.lib.cdc import FFSynchronizer, PulseSynchronizer
+
+from .hspi import HSPITransmitter, HSPIReceiver
+
+# vendor requests to read the histogram over USB:
+# FREEZE stops updating it while wValue is 1, READ returns the bin with
+# the number in wIndex as four little endian bytes, and CLEAR sets all bins to zero.
+# Behind the bins, READ returns the number of samples, of frames sent without a matching
+# received frame, the biggest latency seen, and the bin_shift of the histogram
+VENDOR_REQUEST_HISTOGRAM_FREEZE = 0x13
+VENDOR_REQUEST_HISTOGRAM_READ   = 0x14
+VENDOR_REQUEST_HISTOGRAM_CLEAR  = 0x15
+
+HISTOGRAM_EXTRAS = ["samples", "unmatched", "max", "bin_shift"]
+
+class HSPILatencyHistogram(Elaboratable):
+    """ Histogram of the time from receiving a frame to sending one with the same sequence number
+
+        Takes a time stamp when rx_act rises, and when the frame has been received,
+        keeps it for its sequence number. When tx_req rises for a frame with that
+        sequence number, the cycles between both are counted in bin latency >> bin_shift
+        of a block RAM of bins counters, the last bin also counts all longer latencies.
+
+        The bins can be read in read_domain: value_out holds the bin with the number
+        select_in one cycle after it was set, and after the bins follow the values
+        in HISTOGRAM_EXTRAS. While freeze_in is high, nothing is updated, so that the
+        histogram can be read out consistently. A pulse on clear_in clears it,
+        which takes bins cycles of domain.
+    """
+    def __init__(self, *, domain=None, read_domain=None, bins=1024, bin_shift=3):
+        if bins & (bins - 1):
+            raise ValueError(f"bins must be a power of two, not {bins}")
+
+        self.rx_act_in         = Signal()
+        self.rx_done_in        = Signal()
+        self.rx_sequence_nr_in = Signal(4)
+        self.tx_req_in         = Signal()
+        self.tx_sequence_nr_in = Signal(4)
+
+        self.freeze_in = Signal()
+        self.clear_in  = Signal()
+        self.select_in = Signal(range(bins + len(HISTOGRAM_EXTRAS)))
+        self.value_out = Signal(32)
+
+        self.samples_out   = Signal(32)
+        self.unmatched_out = Signal(32)
+        self.max_out       = Signal(32)
+
+        self.domain      = domain
+        self.read_domain = read_domain
+        self.bins        = bins
+        self.bin_shift   = bin_shift
+
+    def connect(self, transmitter: HSPITransmitter, receiver: HSPIReceiver):
+        """ measures from the bus of receiver to the bus of transmitter, which has to
+            take the sequence numbers from sequence_nr_in, so not segment
+        """
+        return [
+            self.rx_act_in         .eq(receiver.hspi_in.rx_act),
+            self.rx_done_in        .eq(receiver.packet_done_out),
+            self.rx_sequence_nr_in .eq(receiver.sequence_nr_out),
+            self.tx_req_in         .eq(transmitter.hspi_out.tx_req),
+            self.tx_sequence_nr_in .eq(transmitter.sequence_nr_in),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        domain      = "sync" if self.domain is None else self.domain
+        read_domain = domain if self.read_domain is None else self.read_domain
+        sync        = m.d.__getattr__(domain)
+        read_sync   = m.d.__getattr__(read_domain)
+        comb        = m.d.comb
+
+        bins = self.bins
+
+        freeze = Signal()
+        clear  = Signal()
+        if read_domain == domain:
+            comb += [
+                freeze.eq(self.freeze_in),
+                clear.eq(self.clear_in),
+            ]
+        else:
+            m.submodules.freeze_synchronizer = FFSynchronizer(self.freeze_in, freeze, o_domain=domain)
+            m.submodules.clear_synchronizer  = clear_synchronizer = \
+                PulseSynchronizer(i_domain=read_domain, o_domain=domain)
+            comb += [
+                clear_synchronizer.i.eq(self.clear_in),
+                clear.eq(clear_synchronizer.o),
+            ]
+
+        #
+        # time stamps
+        #
+        now         = Signal(32)
+        rx_act_last = Signal()
+        tx_req_last = Signal()
+        rx_start    = Signal(32)
+        starts      = Array(Signal(32, name=f"start{n}") for n in range(16))
+        pending     = Signal(16)
+
+        sample      = Signal()
+        latency     = Signal(32)
+
+        sync += [
+            now.eq(now + 1),
+            rx_act_last.eq(self.rx_act_in),
+            tx_req_last.eq(self.tx_req_in),
+        ]
+
+        with m.If(self.rx_act_in & ~rx_act_last):
+            sync += rx_start.eq(now)
+
+        with m.If(self.rx_done_in):
+            sync += [
+                starts[self.rx_sequence_nr_in].eq(rx_start),
+                pending.bit_select(self.rx_sequence_nr_in, 1).eq(1),
+            ]
+
+        with m.If(self.tx_req_in & ~tx_req_last & ~freeze):
+            with m.If(pending.bit_select(self.tx_sequence_nr_in, 1)):
+                comb += [
+                    sample.eq(1),
+                    latency.eq(now - starts[self.tx_sequence_nr_in]),
+                ]
+                sync += pending.bit_select(self.tx_sequence_nr_in, 1).eq(0)
+            with m.Else():
+                sync += self.unmatched_out.eq(self.unmatched_out + 1)
+
+        #
+        # histogram
+        #
+        memory = Memory(width=32, depth=bins)
+        m.submodules.update_port = update_port = memory.read_port(domain=domain, transparent=False)
+        m.submodules.write_port  = write_port  = memory.write_port(domain=domain)
+        m.submodules.read_port   = read_port   = memory.read_port(domain=read_domain, transparent=False)
+
+        clearing    = Signal()
+        clear_index = Signal(range(bins))
+        bin_index   = Signal(range(bins))
+        update      = Signal()
+        update_bin  = Signal(range(bins))
+
+        comb += [
+            bin_index.eq(Mux(latency >> self.bin_shift >= bins - 1, bins - 1, latency >> self.bin_shift)),
+            update_port.addr.eq(bin_index),
+            update_port.en.eq(sample),
+        ]
+
+        # the bin is read in the cycle of the sample and written back in the next one
+        sync += [
+            update.eq(sample & ~clearing),
+            update_bin.eq(bin_index),
+        ]
+
+        with m.If(clearing):
+            comb += [
+                write_port.addr.eq(clear_index),
+                write_port.data.eq(0),
+                write_port.en.eq(1),
+            ]
+            sync += clear_index.eq(clear_index + 1)
+            with m.If(clear_index == bins - 1):
+                sync += clearing.eq(0)
+        with m.Else():
+            comb += [
+                write_port.addr.eq(update_bin),
+                write_port.data.eq(update_port.data + 1),
+                write_port.en.eq(update),
+            ]
+
+        with m.If(clear):
+            sync += [
+                clearing.eq(1),
+                clear_index.eq(0),
+                self.samples_out.eq(0),
+                self.unmatched_out.eq(0),
+                self.max_out.eq(0),
+            ]
+        with m.Elif(sample & ~clearing):
+            sync += self.samples_out.eq(self.samples_out + 1)
+            with m.If(latency > self.max_out):
+                sync += self.max_out.eq(latency)
+
+        #
+        # read out
+        #
+        extras = Array([self.samples_out, self.unmatched_out, self.max_out, Const(self.bin_shift, 32)])
+        extra  = Signal(range(len(HISTOGRAM_EXTRAS)))
+        is_bin = Signal()
+
+        comb += [
+            read_port.addr.eq(self.select_in),
+            self.value_out.eq(Mux(is_bin, read_port.data, extras[extra])),
+        ]
+        read_sync += [
+            is_bin.eq(self.select_in < bins),
+            extra.eq(self.select_in - bins),
+        ]
+
+        return m
+
+from amaranth.sim import Passive
+from amlib.test   import GatewareTestCase, sync_test_case
+
+class HSPILatencyHistogramTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPILatencyHistogram
+    FRAGMENT_ARGUMENTS  = dict(read_domain="usb", bins=16, bin_shift=2)
+
+    def setUp(self):
+        super().setUp()
+        self.values = None
+        self.read   = False
+        self.sim.add_sync_process(self.reader, domain="usb")
+
+    def reader(self):
+        yield Passive()
+        dut = self.dut
+        while True:
+            while not self.read:
+                yield
+            self.read = False
+            yield dut.freeze_in.eq(1)
+            yield from self.advance_cycles(4)
+            values = []
+            for n in range(16 + len(HISTOGRAM_EXTRAS)):
+                yield dut.select_in.eq(n)
+                yield
+                yield
+                values.append((yield dut.value_out))
+            yield dut.freeze_in.eq(0)
+            if self.clear:
+                yield dut.clear_in.eq(1)
+                yield
+                yield dut.clear_in.eq(0)
+                yield from self.advance_cycles(20)
+            self.values = values
+
+    def read_histogram(self, clear=False):
+        self.values = None
+        self.read   = True
+        self.clear  = clear
+        while self.values is None:
+            yield
+        return self.values
+
+    def frame(self, sequence_nr, length, turnaround):
+        """ a frame coming in, and going out again after turnaround cycles """
+        dut = self.dut
+        yield dut.rx_act_in.eq(1)
+        yield dut.rx_sequence_nr_in.eq(sequence_nr)
+        yield from self.advance_cycles(length)
+        yield dut.rx_act_in.eq(0)
+        yield from self.advance_cycles(2)
+        yield dut.rx_done_in.eq(1)
+        yield
+        yield dut.rx_done_in.eq(0)
+        yield from self.advance_cycles(turnaround - length - 3)
+        yield dut.tx_sequence_nr_in.eq(sequence_nr)
+        yield dut.tx_req_in.eq(1)
+        yield from self.advance_cycles(length)
+        yield dut.tx_req_in.eq(0)
+        yield
+
+    @sync_test_case
+    def test_histogram(self):
+        dut = self.dut
+        latencies = [10, 12, 13, 17, 40, 90, 11, 10]
+        for n, latency in enumerate(latencies):
+            yield from self.frame(n % 16, 5, latency)
+
+        # a frame going out without coming in
+        yield dut.tx_sequence_nr_in.eq(7)
+        yield dut.tx_req_in.eq(1)
+        yield from self.advance_cycles(3)
+        yield dut.tx_req_in.eq(0)
+
+        values = yield from self.read_histogram(clear=True)
+        expected = [0] * 16
+        for latency in latencies:
+            expected[min(latency >> 2, 15)] += 1
+        self.assertEqual(values[:16], expected)
+        self.assertEqual(values[16:], [len(latencies), 1, max(latencies), 2])
+
+        values = yield from self.read_histogram()
+        self.assertEqual(values, [0] * 19 + [2])
@@ -0,0 +1,198 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+import struct
+import zlib
+
+from amaranth          import *
+from amaranth.lib.fifo import SyncFIFOBuffered
+
+from amlib.stream import connect_stream_to_fifo
+
+from .hspi import HSPIInterface, HSPITransmitter, HSPIReceiver
+
+class HSPILoopback(Elaboratable):
+    """ Sends every frame received on the HSPI bus back
+
+        The payload goes through a FIFO of depth words. With threshold=None, a frame
+        is only forwarded to the transmitter once it is complete in the FIFO. Otherwise
+        forwarding starts as soon as threshold words of it have arrived, 0 forwards right
+        away. With buffer_frames > 0, the receiver's packet buffer is used instead of
+        the FIFO, which only sends back frames with a correct CRC.
+
+        Because the HSPI data bus is half duplex, the transmitter can not take the bus
+        before the received frame has ended. What cut-through saves is the time to
+        get the frame into the transmitter once it has, which together with
+        streaming=True gives the shortest turnaround.
+
+        latency_out holds the number of cycles from the first payload word
+        of the last frame on the bus into the loopback to the first one going back out.
+    """
+    def __init__(self, domain=None, depth=4096, threshold=None, buffer_frames=0, crc_latency=0, streaming=False):
+        self.hspi        = HSPIInterface()
+        self.latency_out = Signal(16)
+
+        self.tx = HSPITransmitter(domain=domain, crc_latency=crc_latency, streaming=streaming)
+        self.rx = HSPIReceiver(domain=domain, crc_latency=crc_latency, buffer_frames=buffer_frames)
+
+        self.domain        = domain
+        self.depth         = depth
+        self.threshold     = threshold
+        self.buffer_frames = buffer_frames
+
+    def connect_to_pads(self, hspi_pads):
+        hspi = self.hspi
+
+        return [
+            # HSPI inputs
+            hspi.tx_ready .eq(hspi_pads.tx_ready),
+            hspi.rx_act   .eq(hspi_pads.rx_act),
+            hspi.rx_valid .eq(hspi_pads.rx_valid),
+            hspi.hd.i     .eq(hspi_pads.hd.i),
+
+            # HSPI outputs
+            hspi_pads.tx_req   .eq(hspi.tx_req),
+            hspi_pads.tx_valid .eq(hspi.tx_valid),
+            hspi_pads.tx_ack   .eq(hspi.tx_ack),
+            hspi_pads.hd.oe    .eq(hspi.hd.oe),
+            hspi_pads.hd.o     .eq(hspi.hd.o),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        domain = "sync" if self.domain is None else self.domain
+        sync   = m.d.__getattr__(domain)
+        comb   = m.d.comb
+
+        m.submodules.hspi_rx = rx = self.rx
+        m.submodules.hspi_tx = tx = self.tx
+
+        comb += [
+            *rx.connect_to_pads(self.hspi),
+            *tx.connect_to_pads(self.hspi),
+        ]
+
+        if self.buffer_frames > 0:
+            comb += tx.stream_in.stream_eq(rx.stream_out)
+        else:
+            m.submodules.fifo = fifo = DomainRenamer(domain)(SyncFIFOBuffered(width=34, depth=self.depth))
+
+            # frames which are completely in the FIFO,
+            # and words of the frame which is coming in
+            complete_frames = Signal(range(self.depth + 1))
+            frame_words     = Signal(range(self.depth + 1))
+            last_written    = Signal()
+            last_read       = Signal()
+            release         = Signal()
+
+            comb += [
+                *connect_stream_to_fifo(rx.stream_out, fifo, firstBit=-2, lastBit=-1),
+
+                last_written.eq(fifo.w_en & fifo.w_rdy & rx.stream_out.last),
+                last_read.eq(fifo.r_en & fifo.r_rdy & fifo.r_data[-1]),
+
+                tx.stream_in.valid   .eq(fifo.r_rdy & release),
+                tx.stream_in.payload .eq(fifo.r_data[:32]),
+                tx.stream_in.first   .eq(fifo.r_data[-2]),
+                tx.stream_in.last    .eq(fifo.r_data[-1]),
+                fifo.r_en            .eq(tx.stream_in.ready & release),
+            ]
+
+            if self.threshold is None:
+                comb += release.eq(complete_frames != 0)
+            else:
+                comb += release.eq((complete_frames != 0) | (frame_words >= self.threshold))
+
+            sync += complete_frames.eq(complete_frames + last_written - last_read)
+            with m.If(last_written):
+                sync += frame_words.eq(0)
+            with m.Elif(fifo.w_en & fifo.w_rdy):
+                sync += frame_words.eq(frame_words + 1)
+
+        # measure the turnaround on the bus
+        hspi     = self.hspi
+        rx_index = Signal(2)
+        tx_index = Signal(2)
+        counter  = Signal.like(self.latency_out)
+        running  = Signal()
+
+        with m.If(~hspi.rx_act):
+            sync += rx_index.eq(0)
+        with m.Elif(hspi.rx_valid & (rx_index != 2)):
+            sync += rx_index.eq(rx_index + 1)
+
+        with m.If(~hspi.tx_req):
+            sync += tx_index.eq(0)
+        with m.Elif(hspi.tx_valid & (tx_index != 2)):
+            sync += tx_index.eq(tx_index + 1)
+
+        with m.If(running):
+            sync += counter.eq(counter + 1)
+
+        with m.If(hspi.rx_act & hspi.rx_valid & (rx_index == 1)):
+            sync += [
+                counter.eq(1),
+                running.eq(1),
+            ]
+        with m.Elif(running & hspi.tx_valid & (tx_index == 1)):
+            sync += [
+                self.latency_out.eq(counter),
+                running.eq(0),
+            ]
+
+        return m
+
+from amlib.test import GatewareTestCase, sync_test_case
+
+class HSPILoopbackTest(GatewareTestCase):
+    """ measures the round trip latency of the store and forward loopback
+
+        TURNAROUND is the latency on top of the time the frame takes on the bus
+    """
+    FRAGMENT_UNDER_TEST = HSPILoopback
+    FRAGMENT_ARGUMENTS  = dict(depth=256)
+    TURNAROUND          = 7
+
+    @sync_test_case
+    def test_loopback_latency(self):
+        dut  = self.dut
+        hspi = dut.hspi
+
+        for payload in [list(range(0x20)), list(range(0x100, 0x140))]:
+            frame = [0xc3abcdef] + payload
+            crc   = zlib.crc32(struct.pack(f"<{len(frame)}I", *frame))
+            cycle = 0
+
+            # the CH569 sends a frame
+            yield hspi.rx_act.eq(1)
+            yield from self.advance_cycles(3)
+            yield hspi.rx_valid.eq(1)
+            for word in frame + [crc]:
+                yield hspi.hd.i.eq(word)
+                yield
+                cycle += 1
+            yield hspi.rx_valid.eq(0)
+            yield hspi.rx_act.eq(0)
+
+            # and takes it back
+            words = []
+            while not words or (yield hspi.tx_req):
+                yield
+                cycle += 1
+                yield hspi.tx_ready.eq((yield hspi.tx_req))
+                if (yield hspi.tx_valid):
+                    words.append((yield hspi.hd.o))
+                    if len(words) == 2:
+                        # cycles from the first payload word going in to the first coming out
+                        latency = cycle - 2
+            yield hspi.tx_ready.eq(0)
+            yield from self.advance_cycles(4)
+
+            self.assertEqual(words[1:-1], payload)
+            self.assertEqual(words[-1], zlib.crc32(struct.pack(f"<{len(words) - 1}I", *words[:-1])))
+            self.assertEqual((yield dut.latency_out), latency)
+            self.assertEqual(latency - len(payload), self.TURNAROUND)
+
+class HSPICutThroughLoopbackTest(HSPILoopbackTest):
+    FRAGMENT_ARGUMENTS  = dict(depth=256, threshold=0, streaming=True)
+    TURNAROUND          = 5
@@ -0,0 +1,217 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+# Measures the FPGA resources and the Fmax of configurations of the cores,
+# with a local yosys and nextpnr-ecp5, see hspi-resources.py.
+
+import json
+import statistics
+import subprocess
+from pathlib import Path
+
+from amaranth            import Signal, Record
+from amaranth.back       import rtlil
+from amaranth._toolchain import require_tool
+
+from .hspi     import CRC, HSPITransmitter, HSPIReceiver
+from .loopback import HSPILoopback
+from .cxxrtl   import signals
+
+# the FPGA of the Colorlight i5
+DEVICE  = "25k"
+PACKAGE = "CABGA381"
+SPEED   = 6
+
+CRC_ARGUMENTS = dict(polynomial=0x04C11DB7, crc_size=32, datawidth=32, delay=True)
+
+CORES = dict(
+    crc         = lambda **arguments: CRC(**CRC_ARGUMENTS, **arguments),
+    transmitter = HSPITransmitter,
+    receiver    = HSPIReceiver,
+    loopback    = HSPILoopback,
+)
+
+# the configurations of each core, the others are compared to the first one
+VARIANTS = dict(
+    crc = [dict(latency=latency, words=words) for words in (1, 2) for latency in (0, 1, 2)],
+    transmitter = [
+        dict(),
+        dict(crc_latency=1),
+        dict(crc_latency=2),
+        dict(streaming=True),
+        dict(frame_buffer=True),
+        dict(words=2,  pad_domain="hspi"),
+        dict(width=16, pad_domain="hspi"),
+        dict(width=8,  pad_domain="hspi"),
+    ],
+    receiver = [
+        dict(),
+        dict(crc_latency=1),
+        dict(crc_latency=2),
+        dict(buffer_frames=4),
+        dict(words=2,  pad_domain="hspi"),
+        dict(width=16, pad_domain="hspi"),
+    ],
+    loopback = [dict(depth=depth) for depth in (4096, 2048, 1024, 512)] + [
+        dict(threshold=0),
+        dict(buffer_frames=4),
+        dict(crc_latency=1, streaming=True),
+    ],
+)
+
+# cells of synth_ecp5 and how many LUTs, flip flops and block RAMs each one takes
+CELLS = dict(
+    LUT4            = dict(luts=1),
+    CCU2C           = dict(luts=2),
+    TRELLIS_FF      = dict(ffs=1),
+    DP16KD          = dict(brams=1),
+    TRELLIS_DPR16X4 = dict(lutrams=1),
+    MULT18X18D      = dict(dsps=1),
+)
+
+def variant_name(arguments):
+    return " ".join(f"{name}={value}" for name, value in arguments.items()) or "default"
+
+def ports(elaboratable):
+    """ the signals of all signal and record attributes of elaboratable, which become the ports of the design """
+    result = []
+    seen   = set()
+    for value in vars(elaboratable).values():
+        if not isinstance(value, (Signal, Record)):
+            continue
+        for signal in signals(value):
+            if id(signal) not in seen:
+                seen.add(id(signal))
+                result.append(signal)
+    return result
+
+def resources(stat):
+    """ the LUTs, flip flops, block RAMs, LUT RAMs and multipliers in the output of yosys stat -json """
+    if "design" in stat:
+        cells = stat["design"].get("num_cells_by_type", {})
+    else:
+        cells = {}
+        for module in stat["modules"].values():
+            for cell, count in module.get("num_cells_by_type", {}).items():
+                cells[cell] = cells.get(cell, 0) + count
+
+    result = dict(luts=0, ffs=0, brams=0, lutrams=0, dsps=0)
+    for cell, count in cells.items():
+        for resource, amount in CELLS.get(cell, {}).items():
+            result[resource] += amount * count
+    return result
+
+def clock_domain(net):
+    """ the clock domain of a clock net in the report of nextpnr, or the net if it is none of ours """
+    name = net.replace("$glbnet$", "").split(".")[-1]
+    if name == "clk":
+        return "sync"
+    if name.endswith("_clk"):
+        return name[:-len("_clk")]
+    return net
+
+def fmax(report):
+    """ the achieved Fmax of each clock domain in MHz, from the JSON report of nextpnr """
+    result = {}
+    for net, clock in report.get("fmax", {}).items():
+        domain = clock_domain(net)
+        result[domain] = min(clock["achieved"], result.get(domain, clock["achieved"]))
+    return result
+
+def _run(command, build_dir, log):
+    with open(Path(build_dir) / log, "w") as f:
+        subprocess.run(command, cwd=build_dir, stdout=f, stderr=subprocess.STDOUT, check=True)
+
+def _place(build_dir, name, seeds, arguments):
+    """ places and routes name.json once for every seed, and returns the median Fmax of each domain """
+    nextpnr  = require_tool("nextpnr-ecp5")
+    achieved = {}
+    for seed in seeds:
+        report = f"{name}.{seed}.report.json"
+        _run([nextpnr, "--json", f"{name}.json", "--report", report, "--seed", str(seed),
+              "--timing-allow-fail", *arguments], build_dir, f"{name}.{seed}.nextpnr.log")
+        for domain, value in fmax(json.loads((Path(build_dir) / report).read_text())).items():
+            achieved.setdefault(domain, []).append(value)
+    return {domain: statistics.median(values) for domain, values in achieved.items()}
+
+def synthesize_core(design, arguments, build_dir, *, place=True, freq=96e6, seeds=(1,), synth_opts="-abc9"):
+    """ synthesizes a core of CORES for the ECP5 of the Colorlight board, out of context,
+        and returns its resources and, with place=True, the median Fmax over seeds of each clock domain
+
+        Since the core is not in a design with pins, its ports stay ports and nextpnr
+        places the core with --out-of-context, with freq as the target of all clocks.
+    """
+    build_dir = Path(build_dir)
+    build_dir.mkdir(parents=True, exist_ok=True)
+
+    elaboratable = CORES[design](**arguments)
+    (build_dir / "top.il").write_text(rtlil.convert(elaboratable, ports=ports(elaboratable)))
+    (build_dir / "top.ys").write_text(
+        f"read_rtlil top.il\n"
+        f"synth_ecp5 {synth_opts} -top top\n"
+        f"tee -q -o top.stat.json stat -json\n"
+        f"write_json top.json\n")
+    _run([require_tool("yosys"), "-q", "-l", "top.rpt", "top.ys"], build_dir, "top.yosys.log")
+
+    result = dict(design=design, variant=variant_name(arguments),
+                  **resources(json.loads((build_dir / "top.stat.json").read_text())))
+    if place:
+        result["fmax"] = _place(build_dir, "top", seeds,
+                                [f"--{DEVICE}", "--package", PACKAGE, "--speed", str(SPEED),
+                                 "--freq", f"{freq / 1e6:g}", "--out-of-context"])
+    return result
+
+def synthesize_platform(platform, elaboratable, build_dir, *, design, variant, place=True, seeds=(1,),
+                        synth_opts="-abc9"):
+    """ builds elaboratable for platform like top_level_cli does, once for every seed,
+        and returns its resources and, with place=True, the median Fmax over seeds of each clock domain
+    """
+    build_dir = Path(build_dir)
+    overrides = dict(synth_opts=synth_opts, script_after_synth="tee -q -o top.stat.json stat -json")
+
+    if not place:
+        platform.prepare(elaboratable, name="top", **overrides).extract(build_dir)
+        _run([require_tool("yosys"), "-q", "-l", "top.rpt", "top.ys"], build_dir, "top.yosys.log")
+        return dict(design=design, variant=variant,
+                    **resources(json.loads((build_dir / "top.stat.json").read_text())))
+
+    achieved = {}
+    for seed in seeds:
+        seed_dir = build_dir / f"seed-{seed}"
+        platform.build(elaboratable, name="top", build_dir=seed_dir, do_program=False, **overrides,
+                       nextpnr_opts=f"--timing-allow-fail --report top.report.json --seed {seed}")
+        for domain, value in fmax(json.loads((seed_dir / "top.report.json").read_text())).items():
+            achieved.setdefault(domain, []).append(value)
+
+    return dict(design=design, variant=variant,
+                **resources(json.loads((seed_dir / "top.stat.json").read_text())),
+                fmax={domain: statistics.median(values) for domain, values in achieved.items()})
+
+import unittest
+
+class ResourcesTest(unittest.TestCase):
+    def test_resources(self):
+        stat = dict(design=dict(num_cells_by_type=dict(LUT4=100, CCU2C=8, TRELLIS_FF=50, DP16KD=8, PFUMX=3)))
+        self.assertEqual(resources(stat), dict(luts=116, ffs=50, brams=8, lutrams=0, dsps=0))
+
+        stat = dict(modules={"\\top": dict(num_cells_by_type=dict(LUT4=10)),
+                             "\\sub": dict(num_cells_by_type=dict(LUT4=5, TRELLIS_DPR16X4=2))})
+        self.assertEqual(resources(stat), dict(luts=15, ffs=0, brams=0, lutrams=2, dsps=0))
+
+    def test_fmax(self):
+        report = dict(fmax={
+            "clk":                   dict(achieved=180.5, constraint=96.0),
+            "$glbnet$hspi_clk":      dict(achieved=150.2, constraint=96.0),
+            "car.usb_clk":           dict(achieved=90.0,  constraint=60.0),
+            "$glbnet$clk25$TRELLIS_IO_IN": dict(achieved=300.0, constraint=25.0),
+        })
+        self.assertEqual(fmax(report), {"sync": 180.5, "hspi": 150.2, "usb": 90.0,
+                                        "$glbnet$clk25$TRELLIS_IO_IN": 300.0})
+
+    def test_variants(self):
+        # every variant has to elaborate, or the whole run fails after the first few builds
+        for design, variants in VARIANTS.items():
+            for arguments in variants:
+                with self.subTest(design=design, variant=variant_name(arguments)):
+                    elaboratable = CORES[design](**arguments)
+                    self.assertIn("module", rtlil.convert(elaboratable, ports=ports(elaboratable)))
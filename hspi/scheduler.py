@@ -0,0 +1,213 @@
+# Copyright (c) 2021 Hans Baier <hansfbaier@gmail.com>
+# SPDX-License-Identifier: BSD-3-Clause
+
+import random
+
+from amaranth import *
+
+from amlib.stream import StreamInterface
+
+class HSPIScheduler(Elaboratable):
+    """ Chooses which of several sources a HSPITransmitter sends the next frame from
+
+        Every source has its own stream in streams_in, and the user id and TLL for the
+        header of its frames in user_id_in and tll_2b_in, which are taken
+        when its frame is chosen. Once chosen, a frame goes out on stream_out
+        up to its last word, with its header fields on user_id_out and tll_2b_out.
+
+        With policy="priority", the source with the lowest index which has a frame
+        waiting always goes first. With policy="round_robin", the sources take turns,
+        and source n may send weights[n] frames in a row when it is its turn.
+
+        starved_out counts the cycles in which a source had a frame waiting
+        while another one was sending or chosen instead, words_out the words it has sent.
+    """
+    def __init__(self, *, sources=2, policy="priority", weights=None):
+        if policy not in ("priority", "round_robin"):
+            raise ValueError(f"policy must be 'priority' or 'round_robin', not {policy!r}")
+        if weights is None:
+            weights = [1] * sources
+        if len(weights) != sources or min(weights) < 1:
+            raise ValueError(f"weights needs a positive weight for each of the {sources} sources")
+
+        self.streams_in  = [StreamInterface(name=f"source{n}_in", payload_width=32) for n in range(sources)]
+        self.user_id_in  = [Signal(26, name=f"user_id{n}_in") for n in range(sources)]
+        self.tll_2b_in   = [Signal(2,  name=f"tll_2b{n}_in")  for n in range(sources)]
+
+        self.stream_out  = StreamInterface(name="scheduler_out", payload_width=32)
+        self.user_id_out = Signal(26)
+        self.tll_2b_out  = Signal(2)
+        self.source_out  = Signal(range(sources))
+
+        self.starved_out   = [Signal(32, name=f"starved{n}_out")   for n in range(sources)]
+        self.words_out     = [Signal(32, name=f"words{n}_out")     for n in range(sources)]
+
+        self.sources = sources
+        self.policy  = policy
+        self.weights = weights
+
+    def connect_to_transmitter(self, transmitter):
+        return [
+            transmitter.stream_in.stream_eq(self.stream_out),
+            # with both user ids the same, the header does not depend on the sequence number
+            transmitter.user_id0_in .eq(self.user_id_out),
+            transmitter.user_id1_in .eq(self.user_id_out),
+            transmitter.tll_2b_in   .eq(self.tll_2b_out),
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+        comb = m.d.comb
+        sync = m.d.sync
+
+        sources    = self.sources
+        streams_in = self.streams_in
+        stream_out = self.stream_out
+        source     = self.source_out
+
+        active  = Signal()
+        waiting = Signal(sources)
+        choice  = Signal(range(sources))
+
+        comb += waiting.eq(Cat(stream.valid & stream.first for stream in streams_in))
+
+        if self.policy == "priority":
+            for n in reversed(range(sources)):
+                with m.If(waiting[n]):
+                    comb += choice.eq(n)
+        else:
+            # the source whose turn it is, and how many frames it has sent in this turn
+            turn    = Signal(range(sources))
+            sent    = Signal(range(max(self.weights) + 1))
+            weights = Array(Const(weight, sent.shape()) for weight in self.weights)
+            count   = Signal.like(sent)
+
+            with m.Switch(turn):
+                for start in range(sources):
+                    with m.Case(start):
+                        for offset in reversed(range(sources)):
+                            n = (start + offset) % sources
+                            with m.If(waiting[n]):
+                                comb += choice.eq(n)
+
+            # a source which was skipped because it had nothing to send
+            # loses the rest of its turn
+            comb += count.eq(Mux(choice == turn, sent, 0) + 1)
+
+            with m.If(~active & waiting.any()):
+                with m.If(count == weights[choice]):
+                    sync += [
+                        turn.eq(Mux(choice == sources - 1, 0, choice + 1)),
+                        sent.eq(0),
+                    ]
+                with m.Else():
+                    sync += [
+                        turn.eq(choice),
+                        sent.eq(count),
+                    ]
+
+        with m.If(~active & waiting.any()):
+            sync += [
+                active.eq(1),
+                source.eq(choice),
+                self.user_id_out.eq(Array(self.user_id_in)[choice]),
+                self.tll_2b_out.eq(Array(self.tll_2b_in)[choice]),
+            ]
+
+        with m.Switch(source):
+            for n, stream in enumerate(streams_in):
+                with m.Case(n):
+                    comb += [
+                        stream_out.payload .eq(stream.payload),
+                        stream_out.valid   .eq(active & stream.valid),
+                        stream_out.first   .eq(stream.first),
+                        stream_out.last    .eq(stream.last),
+                        stream.ready       .eq(active & stream_out.ready),
+                    ]
+
+        with m.If(stream_out.valid & stream_out.ready & stream_out.last):
+            sync += active.eq(0)
+
+        for n in range(sources):
+            with m.If(waiting[n] & ~(active & (source == n))):
+                sync += self.starved_out[n].eq(self.starved_out[n] + 1)
+            with m.If(stream_out.valid & stream_out.ready & (source == n)):
+                sync += self.words_out[n].eq(self.words_out[n] + 1)
+
+        return m
+
+from amaranth.sim import Passive
+from amlib.test   import GatewareTestCase, sync_test_case
+
+class HSPISchedulerTest(GatewareTestCase):
+    FRAGMENT_UNDER_TEST = HSPIScheduler
+    FRAGMENT_ARGUMENTS  = dict(sources=3, policy="priority")
+    FRAMES              = [2, 6, 3]
+
+    def setUp(self):
+        super().setUp()
+        self.rng    = random.Random(0)
+        self.frames = [[list(range((n << 12) | (i << 8), (n << 12) | (i << 8) + self.rng.randint(1, 12)))
+                        for i in range(count)]
+                       for n, count in enumerate(self.FRAMES)]
+        self.received = []
+        for n in range(len(self.FRAMES)):
+            self.sim.add_sync_process(self.source(n))
+        self.sim.add_sync_process(self.sink)
+
+    def source(self, n):
+        def process():
+            yield Passive()
+            stream = self.dut.streams_in[n]
+            yield self.dut.user_id_in[n].eq(0x100 + n)
+            yield self.dut.tll_2b_in[n].eq(n)
+            for frame in self.frames[n]:
+                for i, word in enumerate(frame):
+                    yield stream.valid.eq(1)
+                    yield stream.first.eq(i == 0)
+                    yield stream.last.eq(i == len(frame) - 1)
+                    yield stream.payload.eq(word)
+                    yield
+                    while not (yield stream.ready):
+                        yield
+            yield stream.valid.eq(0)
+        return process
+
+    def sink(self):
+        yield Passive()
+        stream = self.dut.stream_out
+        while True:
+            ready = self.rng.random() < 0.8
+            yield stream.ready.eq(ready)
+            yield
+            if ready and (yield stream.valid):
+                if (yield stream.first):
+                    source = yield self.dut.source_out
+                    self.assertEqual((yield self.dut.user_id_out), 0x100 + source)
+                    self.assertEqual((yield self.dut.tll_2b_out), source)
+                    self.received.append((source, []))
+                self.received[-1][1].append((yield stream.payload))
+
+    def expected_order(self):
+        return [0] * 2 + [1] * 6 + [2] * 3
+
+    @sync_test_case
+    def test_scheduler(self):
+        dut = self.dut
+        yield from self.advance_cycles(400)
+
+        self.assertEqual([source for source, _ in self.received], self.expected_order())
+        for n, frames in enumerate(self.frames):
+            self.assertEqual([frame for source, frame in self.received if source == n], frames)
+            self.assertEqual((yield dut.words_out[n]), sum(map(len, frames)))
+
+        # the lowest priority waited for all the others
+        self.assertGreater((yield dut.starved_out[2]), (yield dut.starved_out[1]))
+        self.assertGreater((yield dut.starved_out[1]), (yield dut.starved_out[0]))
+
+class HSPIRoundRobinSchedulerTest(HSPISchedulerTest):
+    FRAGMENT_ARGUMENTS  = dict(sources=3, policy="round_robin", weights=[1, 2, 1])
+
+    def expected_order(self):
+        # source 0 runs out of frames after its second turn
+        return [0, 1, 1, 2, 0, 1, 1, 2, 1, 1, 2]